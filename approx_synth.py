@@ -0,0 +1,403 @@
+#!/usr/bin/env python3
+"""
+Approximate synthesis: simplifies an exact circuit as long as its error stays within a budget
+
+    python approx_synth.py --circuit multiply4x4_exact --metric med --budget 1.5 --out approx.npz
+    python approx_synth.py --circuit mac --metric error_rate --budget 0.05 --vectors 4096
+
+Starting from the exact netlist, every round tries to replace a signal by a constant 0 or 1 (e.g. a
+carry that is dropped), by one of the inputs of its gate (the gate is dropped) or by a neighbouring
+signal computed from the same inputs. The error of every replacement is measured by simulating the
+fanout cone of the signal on bit vectors of all input vectors at once, relative to the outputs of the
+exact circuit. Among the replacements within the budget the one reducing the estimated compiled cost
+(dse.estimate_costs) the most is applied; constants are propagated and dead gates removed before the
+circuit is scheduled again. The search stops when no replacement reduces the cost any more.
+"""
+
+import argparse
+import contextlib
+import functools
+import io
+import json
+
+import numpy as np
+
+import dse
+import gates
+import netlist_io
+
+CONST0 = -2     # replacements by constants, see FlatCircuit.simplify
+CONST1 = -3
+CONSTANT_LABELS = {CONST0: "CONST0", CONST1: "CONST1"}
+
+OR = netlist_io.GATE_CODES["OR"]
+AND = netlist_io.GATE_CODES["AND"]
+XOR = netlist_io.GATE_CODES["XOR"]
+NOT = netlist_io.GATE_CODES["NOT"]
+
+OBJECTIVES = {"lines": ("lines", "memristors"), "memristors": ("memristors", "lines"), "steps": ("steps", "memristors")}
+
+# circuits that can be approximated from the command line: function building the outputs and widths of its operands
+CIRCUITS = {"multiply4x4_exact": (gates.traceable_multiply4x4_exact, [4, 4]),
+            "mult8x8_from4x4": (gates.mult8x8_from4x4, [8, 8]),
+            "dadda8x8": (gates.traceable_dadda_multiplier, [8, 8]),
+            "mac": (functools.partial(gates.MAC_unit, ApproximateAdder=False), [8, 8, 16])}
+
+
+def evaluate_gate(code: int, values: list):
+    if code == OR:
+        return values[0] | values[1]
+    if code == AND:
+        return values[0] & values[1]
+    if code == XOR:
+        return values[0] ^ values[1]
+    return 1 - values[0]
+
+
+class FlatCircuit():
+    '''
+        circuit of OR/AND/XOR/NOT gates in topological order, gate g creates signal num_inputs + g
+
+        constants: input index : value of the inputs added for constants that could not be propagated
+    '''
+    def __init__(self, labels: list[str], num_inputs: int, gate_types: list[int], gate_inputs: list[list[int]], outputs: list[int],
+                 output_labels: list[str], constants: dict=None):
+        self.labels = labels
+        self.num_inputs = num_inputs
+        self.gate_types = gate_types
+        self.gate_inputs = gate_inputs
+        self.outputs = outputs
+        self.output_labels = output_labels
+        self.constants = {} if constants is None else constants
+
+    def from_netlist(netlist: netlist_io.Netlist):
+        labels, gate_types, gate_inputs, outputs, output_labels = netlist.flat_gates()
+        constants = {index: 1 if label == "CONST1" else 0 for index, label in enumerate(labels[:netlist.num_inputs]) if label in CONSTANT_LABELS.values()}
+        return FlatCircuit(labels, netlist.num_inputs, gate_types, gate_inputs, outputs, output_labels, constants)
+
+    def to_netlist(self, maxGatesPerStage: int=1) -> netlist_io.Netlist:
+        return netlist_io.schedule_gates(self.labels, self.num_inputs, self.gate_types, self.gate_inputs, self.outputs,
+                                         self.output_labels, maxGatesPerStage)
+
+    def num_gates(self) -> int:
+        return len(self.gate_types)
+
+    def input_values(self, values: list) -> list:
+        # values of the original inputs followed by the constants
+        values = list(values)
+        for index in range(len(values), self.num_inputs):
+            values.append(np.full_like(values[0], self.constants[index]))
+        return values
+
+    def evaluate(self, input_values: list) -> list:
+        values = self.input_values(input_values)
+        for code, inputs in zip(self.gate_types, self.gate_inputs):
+            values.append(evaluate_gate(code, [values[signal] for signal in inputs]))
+        return values
+
+    def evaluate_replacement(self, values: list, signal: int, replacement: int) -> list:
+        '''
+            outputs after replacing signal by replacement, only the fanout cone of signal is evaluated again
+
+            expects:
+                values: values of all signals, see evaluate
+        '''
+        ones = np.ones_like(values[0])
+        changed = {signal: ones * 0 if replacement == CONST0 else ones if replacement == CONST1 else values[replacement]}
+        for gate in range(signal - self.num_inputs + 1, self.num_gates()):
+            inputs = self.gate_inputs[gate]
+            if any(input in changed for input in inputs):
+                changed[self.num_inputs + gate] = evaluate_gate(self.gate_types[gate], [changed.get(input, values[input]) for input in inputs])
+        return [changed.get(output, values[output]) for output in self.outputs]
+
+    def candidates(self, neighbours: int=2):
+        '''
+            generator of replacements (signal, replacement) for every gate: the constants, the inputs of the
+            gate and up to neighbours earlier gates reading one of the same inputs
+        '''
+        readers = {}
+        for gate, inputs in enumerate(self.gate_inputs):
+            signal = self.num_inputs + gate
+            yield signal, CONST0
+            yield signal, CONST1
+            found = []
+            for input in inputs:
+                if input not in found:
+                    yield signal, input
+                    found.append(input)
+            for input in inputs:
+                for reader in reversed(readers.get(input, [])):
+                    if len(found) >= len(inputs) + neighbours:
+                        break
+                    if reader not in found:
+                        yield signal, reader
+                        found.append(reader)
+            for input in set(inputs):
+                readers.setdefault(input, []).append(signal)
+
+    def simplify(self, replacements: dict):
+        '''
+            applies replacements (signal : signal or constant), propagates constants and removes gates that no
+            output depends on
+
+            returns:
+                new FlatCircuit, constants that reach an output become inputs CONST0/CONST1 (one per output)
+        '''
+        resolved = {}
+        gates = []      # (code, inputs, label) with inputs as old signals, new gates or constants
+        def resolve(signal):
+            while signal in replacements:
+                signal = replacements[signal]
+            if signal in self.constants:
+                return CONST1 if self.constants[signal] else CONST0
+            return resolved.get(signal, signal)
+
+        for gate, (code, inputs) in enumerate(zip(self.gate_types, self.gate_inputs)):
+            signal = self.num_inputs + gate
+            if signal in replacements:
+                continue
+            inputs = [resolve(input) for input in inputs]
+            result = simplify_gate(code, inputs)
+            if result is None:
+                resolved[signal] = ("gate", len(gates))
+                gates.append((code, inputs, self.labels[signal]))
+            elif result[0] == "not":
+                resolved[signal] = ("gate", len(gates))
+                gates.append((NOT, [result[1]], self.labels[signal]))
+            else:
+                resolved[signal] = result[1]
+        outputs = [resolve(output) for output in self.outputs]
+        # every output is read from its own memristor, so a signal several outputs read is copied by two NOT gates
+        for index, output in enumerate(outputs):
+            if output not in (CONST0, CONST1) and output in outputs[:index]:
+                gates.append((NOT, [output], f"{self.output_labels[index]}_inverted"))
+                gates.append((NOT, [("gate", len(gates) - 1)], f"{self.output_labels[index]}_copy"))
+                outputs[index] = ("gate", len(gates) - 1)
+
+        # only gates the outputs depend on are kept
+        live = set()
+        pending = [output for output in outputs if isinstance(output, tuple)]
+        while len(pending) > 0:
+            node = pending.pop()
+            if node not in live:
+                live.add(node)
+                pending.extend(input for input in gates[node[1]][1] if isinstance(input, tuple))
+
+        # the constant inputs follow the original inputs and are added again for the constants still read
+        constants = {}
+        labels = self.labels[:self.num_inputs - len(self.constants)]
+        def constant_input(value, fresh=False):
+            for index, constant in constants.items():
+                if constant == value and not fresh:
+                    return index
+            constants[len(labels)] = value
+            labels.append(CONSTANT_LABELS[CONST1 if value else CONST0])
+            return len(labels) - 1
+        used = [input for index, (_, inputs, _) in enumerate(gates) if ("gate", index) in live for input in inputs] + outputs
+        for constant in (CONST0, CONST1):
+            if constant in used:
+                constant_input(1 if constant == CONST1 else 0)
+        output_constants = {index: constant_input(1 if output == CONST1 else 0, fresh=output in outputs[:index])
+                            for index, output in enumerate(outputs) if output in (CONST0, CONST1)}
+
+        num_inputs = len(labels)
+        signals = {}
+        def signal_of(node):
+            if isinstance(node, tuple):
+                return signals[node]
+            if node < 0:
+                return constant_input(1 if node == CONST1 else 0)
+            return node
+        gate_types = []
+        gate_inputs = []
+        for index, (code, inputs, label) in enumerate(gates):
+            if ("gate", index) in live:
+                gate_inputs.append([signal_of(input) for input in inputs])
+                gate_types.append(code)
+                signals[("gate", index)] = num_inputs + len(gate_types) - 1
+                labels.append(label)
+        return FlatCircuit(labels, num_inputs, gate_types, gate_inputs, [output_constants[index] if index in output_constants else signal_of(output) for index, output in enumerate(outputs)],
+                           list(self.output_labels), constants)
+
+def simplify_gate(code: int, inputs: list):
+    '''
+        simplifies a gate with constant or equal inputs
+
+        returns:
+            None if the gate is kept, ("signal", x) if it equals x (a signal or constant), ("not", x) for NOT x
+    '''
+    if code == NOT:
+        if inputs[0] in (CONST0, CONST1):
+            return "signal", CONST1 if inputs[0] == CONST0 else CONST0
+        return None
+    a, b = inputs
+    if b in (CONST0, CONST1):
+        a, b = b, a
+    if code == OR:
+        if a == CONST1:
+            return "signal", CONST1
+        if a == CONST0 or a == b:
+            return "signal", b
+    elif code == AND:
+        if a == CONST0:
+            return "signal", CONST0
+        if a == CONST1 or a == b:
+            return "signal", b
+    elif code == XOR:
+        if a == b:
+            return "signal", CONST0
+        if a == CONST0:
+            return "signal", b
+        if a == CONST1:
+            return ("signal", CONST0) if b == CONST1 else ("not", b)
+    return None
+
+
+# Search
+
+def output_word(outputs: list) -> np.ndarray:
+    # outputs are bits of an unsigned number, most significant bit first
+    if len(outputs) > 62:
+        raise Exception(f"ERROR: Outputs with {len(outputs)} bits do not fit into a 64 bit word!")
+    word = np.zeros(len(outputs[0]), dtype=np.int64)
+    for bits in outputs:
+        word = (word << 1) | bits
+    return word
+
+def approximate(netlist: netlist_io.Netlist, input_values: list, metric: str="med", budget: float=0.0, objective: str="lines",
+                parallelism: int=1, neighbours: int=2, maxEvaluations: int=64, reference: np.ndarray=None) -> tuple[netlist_io.Netlist, list[dict]]:
+    '''
+        greedily simplifies a circuit while its error stays within budget
+
+        expects:
+            input_values: numpy bit array of every input, one bit per input vector
+            metric: error metric of dse.error_metrics, applied to the outputs read as one unsigned number
+            objective: cost that is reduced, "lines", "memristors" or "steps" (see dse.estimate_costs)
+            maxEvaluations: replacements within the budget whose cost is estimated per round, lowest errors first
+            reference: exact results of the input vectors, by default the outputs of netlist
+
+        returns:
+            netlist: approximated circuit
+            history: applied replacements with the error and the estimated costs after them
+    '''
+    if metric not in dse.ERROR_METRICS:
+        raise Exception(f"ERROR: Unknown error metric {metric}, expected one of {dse.ERROR_METRICS}!")
+    if objective not in OBJECTIVES:
+        raise Exception(f"ERROR: Unknown objective {objective}, expected one of {list(OBJECTIVES)}!")
+
+    def costs(circuit):
+        estimate = dse.estimate_costs(circuit.to_netlist(parallelism), parallelism)
+        return tuple(estimate[key] for key in OBJECTIVES[objective]), estimate
+
+    current = FlatCircuit.from_netlist(netlist)
+    values = current.evaluate(input_values)
+    if reference is None:
+        reference = output_word([values[output] for output in current.outputs])
+    width = len(current.outputs)
+    cost, estimate = costs(current)
+    history = [{"replaced": None, "by": None, metric: dse.error_metrics(output_word([values[output] for output in current.outputs]), reference, width)[metric], **estimate}]
+
+    while True:
+        feasible = []
+        for signal, replacement in current.candidates(neighbours):
+            error = dse.error_metrics(output_word(current.evaluate_replacement(values, signal, replacement)), reference, width)[metric]
+            if error <= budget:
+                feasible.append((error, signal, replacement))
+        feasible.sort(key=lambda candidate: candidate[0])
+
+        best = None
+        for error, signal, replacement in feasible[:maxEvaluations]:
+            circuit = current.simplify({signal: replacement})
+            candidate_cost, candidate_estimate = costs(circuit)
+            if candidate_cost < cost and (best is None or (candidate_cost, error) < (best[0], best[1])):
+                best = (candidate_cost, error, signal, replacement, circuit, candidate_estimate)
+        if best is None:
+            break
+
+        cost, error, signal, replacement, circuit, estimate = best
+        history.append({"replaced": current.labels[signal],
+                        "by": CONSTANT_LABELS.get(replacement) or current.labels[replacement],
+                        metric: error, **estimate})
+        current = circuit
+        values = current.evaluate(input_values)
+    return current.to_netlist(parallelism), history
+
+
+# Circuits of the command line
+
+def build_circuit(function, widths: list[int], parallelism: int=1) -> tuple[netlist_io.Netlist, list[int]]:
+    '''
+        builds function applied to operands of the given widths, with an OUT layer
+
+        returns:
+            netlist: gate tables of the circuit
+            operands: input index of every operand bit (most significant bit first), None if unused
+    '''
+    gates.Gate.reset()
+    gates.Register.reset()
+    gates.maxGatesPerStage = parallelism
+    operands = [gates.NumToBinRegisters(0, width) for width in widths]
+    operandLabels = [register.getLabel() for operand in operands for register in operand]
+    gates.add_OUT_layer(function(*[list(operand) for operand in operands]))
+    with contextlib.redirect_stdout(io.StringIO()):
+        netlist = gates.CircuitConfig().toNetlist()
+    inputs = {str(label): index for index, label in enumerate(netlist.labels[:netlist.num_inputs])}
+    return netlist, [inputs.get(label) for label in operandLabels]
+
+def operand_inputs(netlist: netlist_io.Netlist, operands: list[int], widths: list[int], vectors: int=None, seed: int=0) -> tuple[list, list[np.ndarray]]:
+    # bit arrays of all inputs: every combination of the operands or vectors random ones, other inputs are 0
+    rng = np.random.default_rng(seed)
+    if vectors is None:
+        combinations = np.arange(2**sum(widths), dtype=np.int64)
+        values = []
+        for width in reversed(widths):
+            combinations, value = np.divmod(combinations, 2**width)
+            values.insert(0, value)
+    else:
+        values = [rng.integers(0, 2**width, size=vectors, dtype=np.int64) for width in widths]
+
+    bits = [bit for value, width in zip(values, widths) for bit in dse.to_bits(value, width)]
+    inputs = [np.zeros(len(values[0]), dtype=np.uint8) for _ in range(netlist.num_inputs)]
+    for index, bit in zip(operands, bits):
+        if index is not None:
+            inputs[index] = bit
+    return inputs, values
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(description="Approximate synthesis under an error budget")
+    parser.add_argument("--circuit", choices=list(CIRCUITS), default="multiply4x4_exact")
+    parser.add_argument("--metric", choices=dse.ERROR_METRICS, default="med")
+    parser.add_argument("--budget", type=float, required=True, help="largest allowed value of the error metric")
+    parser.add_argument("--objective", choices=list(OBJECTIVES), default="lines")
+    parser.add_argument("--parallelism", type=int, default=1)
+    parser.add_argument("--vectors", type=int, default=None, help="random input vectors (default: all if the operands have at most 16 bits, else 4096)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--neighbours", type=int, default=2)
+    parser.add_argument("--max-evaluations", type=int, default=64)
+    parser.add_argument("--out", default=None, help="write the approximated circuit to this config (.json, .jsonl or .npz)")
+    parser.add_argument("--history", default=None, help="write the applied replacements as JSON to this file")
+    args = parser.parse_args(argv)
+
+    function, widths = CIRCUITS[args.circuit]
+    netlist, operands = build_circuit(function, widths, args.parallelism)
+    vectors = args.vectors
+    if vectors is None and sum(widths) > 16:
+        vectors = 4096
+    inputs, _ = operand_inputs(netlist, operands, widths, vectors, args.seed)
+
+    approximated, history = approximate(netlist, inputs, args.metric, args.budget, args.objective, args.parallelism,
+                                        args.neighbours, args.max_evaluations)
+    for step in history:
+        print(f"{str(step['replaced']):>12s} -> {str(step['by']):12s} {args.metric} {step[args.metric]:<12.6g} lines {step['lines']:6d}  memristors {step['memristors']:4d}")
+
+    if args.out is not None:
+        if args.out.endswith(".npz"):
+            approximated.save(args.out)
+        else:
+            netlist_io.write_config(args.out, approximated.input_registers(), approximated.labelled_stages())
+    if args.history is not None:
+        with open(args.history, "w") as f:
+            json.dump(history, f, indent=4)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,269 @@
+#!/usr/bin/env python3
+"""
+Benchmark harness: speed and peak memory of building, exporting, compiling and evaluating circuits,
+together with the quality of the compiled programs (imply lines, memristors).
+
+    python benchmark.py --out results.json
+    python benchmark.py --quick --baseline results.json
+
+Series:
+    mac/<variant>         build, export (CircuitConfig.writeToFile), compile (compile_circuit) and
+                          evaluate (batched Netlist.evaluate and MAC_Wrap) the four MAC variants
+    multiplier/<kind>/<width>
+                          build and compile NxN array, Wallace and Dadda multipliers, width 4 ... 64
+    dag/<gates>           generate and compile random DAGs, 10^3 ... 10^6 gates
+
+Times are the best of --repeat runs, peak memory is measured by tracemalloc in a separate run.
+All inputs are generated from fixed seeds, so results of different revisions are comparable.
+With --baseline the results are compared to an earlier run, the exit code is 1 on regressions.
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import subprocess
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+import compiler
+import gates
+import netlist_io
+
+MULTIPLIER_WIDTHS = [4, 8, 16, 32, 64]
+DAG_SIZES = [10**3, 10**4, 10**5, 10**6]
+QUICK_MULTIPLIER_WIDTHS = [4, 8, 16]
+QUICK_DAG_SIZES = [10**3, 10**4]
+MULTIPLIERS = {"array": gates.traceable_array_multiplier,
+               "wallace": gates.traceable_wallace_multiplier,
+               "dadda": gates.traceable_dadda_multiplier}
+MIN_COMPARED_SECONDS = 0.01     # shorter timings are too noisy to be compared with a baseline
+
+results = []
+
+
+def measure(function, repeat: int=1, memory: bool=True):
+    '''
+        runs function repeat times, output of the function is discarded
+
+        returns:
+            seconds: best wall time
+            peak_bytes: peak of traced memory during an additional run, None without memory
+            result: return value of the last run
+    '''
+    seconds = float("inf")
+    with contextlib.redirect_stdout(io.StringIO()):
+        for _ in range(repeat):
+            start = time.perf_counter()
+            result = function()
+            seconds = min(seconds, time.perf_counter() - start)
+
+        peak_bytes = None
+        if memory:
+            tracemalloc.start()
+            try:
+                result = function()
+                peak_bytes = tracemalloc.get_traced_memory()[1]
+            finally:
+                tracemalloc.stop()
+    return seconds, peak_bytes, result
+
+def record(name: str, seconds: float, peak_bytes: int, **metrics) -> None:
+    results.append({"name": name, "seconds": seconds, "peak_bytes": peak_bytes, "metrics": metrics})
+    print(f"{name:40s} {seconds*1e3:10.2f} ms  {'' if peak_bytes is None else f'{peak_bytes/2**20:8.2f} MiB'}  {metrics}")
+
+def compile_metrics() -> dict:
+    return {"memristors": compiler.num_registers, "lines": compiler.num_lines,
+            "gates": {label: count for label, count in zip(netlist_io.GATE_TYPES, compiler.gate_counts) if count > 0}}
+
+def num_built_gates() -> int:
+    return sum(len(stage) for stage in gates.Gate.usedGates.values())
+
+
+# Random DAGs
+
+def random_netlist(num_gates: int, num_inputs: int=64, num_outputs: int=64, window: int=256, seed: int=0) -> netlist_io.Netlist:
+    '''
+        generates a random circuit of OR/AND/XOR/NOT gates directly as gate tables
+
+        Gates read signals created at most window signals before them, gates are placed in the stage
+        of their level. Signals are freed after their last use, unused signals right after their stage.
+        The last num_outputs signals are read by OUT gates.
+    '''
+    rng = np.random.default_rng(seed)
+    codes = np.array([netlist_io.GATE_CODES[label] for label in ["OR", "AND", "XOR", "NOT"]], dtype=np.uint8)
+    gate_types = rng.choice(codes, size=num_gates, p=[0.3, 0.3, 0.3, 0.1])
+    signals = num_inputs + np.arange(num_gates)
+    gate_inputs = np.maximum(signals[:, None] - rng.integers(1, window + 1, size=(num_gates, 2)), 0)
+    gate_inputs[gate_types == netlist_io.GATE_CODES["NOT"], 1] = netlist_io.NO_SIGNAL
+
+    # level of every signal, inputs have level 0
+    levels = [0] * (num_inputs + num_gates)
+    for gate, (first, second) in enumerate(gate_inputs.tolist()):
+        levels[num_inputs + gate] = max(levels[first], levels[second]) + 1
+    levels = np.array(levels, dtype=np.int64)
+
+    # gates ordered by stage, signal ids follow the new order
+    order = np.argsort(levels[num_inputs:], kind="stable")
+    renumber = np.arange(num_inputs + num_gates)
+    renumber[num_inputs + order] = signals
+    gate_types = gate_types[order]
+    gate_inputs = gate_inputs[order]
+    gate_inputs = np.where(gate_inputs == netlist_io.NO_SIGNAL, netlist_io.NO_SIGNAL, renumber[np.maximum(gate_inputs, 0)])
+    levels = levels[np.argsort(renumber)]
+    num_stages = int(levels.max())
+
+    # a signal is freed after the stage of its last use, the stage of level l is l - 1
+    last_use = np.maximum(levels - 1, 0)
+    used = gate_inputs[gate_inputs != netlist_io.NO_SIGNAL]
+    np.maximum.at(last_use, used, levels[num_inputs:][np.flatnonzero(gate_inputs != netlist_io.NO_SIGNAL) // 2] - 1)
+    outputs = np.arange(num_inputs + num_gates - num_outputs, num_inputs + num_gates)
+    freed = np.setdiff1d(np.arange(num_inputs + num_gates), outputs)
+    freed = freed[np.argsort(last_use[freed], kind="stable")]
+
+    stage_offsets = np.concatenate([[0], np.cumsum(np.bincount(levels[num_inputs:] - 1, minlength=num_stages)), [num_gates + num_outputs]])
+    free_offsets = np.concatenate([[0], np.cumsum(np.bincount(last_use[freed], minlength=num_stages)), [len(freed)]])
+
+    labels = np.concatenate([np.char.add("IN", np.arange(num_inputs).astype(str)),
+                             np.char.add("G", np.arange(num_gates).astype(str)),
+                             np.char.add("OUT", np.arange(num_outputs).astype(str))])
+    out_inputs = np.full((num_outputs, 2), netlist_io.NO_SIGNAL)
+    out_inputs[:, 0] = outputs
+    return netlist_io.Netlist(labels, num_inputs,
+                              np.concatenate([gate_types, np.full(num_outputs, netlist_io.OUT_CODE, dtype=np.uint8)]),
+                              np.concatenate([gate_inputs, out_inputs]).astype(np.int32),
+                              stage_offsets.astype(np.int64),
+                              freed.astype(np.int32),
+                              free_offsets.astype(np.int64))
+
+
+# Series
+
+def mac_series(workDir: str, repeat: int, memory: bool, vectors: int) -> None:
+    for variant, kwargs in gates.MAC_variants.items():
+        configPath = os.path.join(workDir, f"{variant}.json")
+        outfile = os.path.join(workDir, f"{variant}.txt")
+
+        seconds, peak, _ = measure(lambda: gates.MAC_Circuit(0, 0, 0, **kwargs), repeat, memory)
+        record(f"mac/{variant}/build", seconds, peak, gates=num_built_gates())
+
+        seconds, peak, _ = measure(lambda: gates.CircuitConfig.writeToFile(configPath), repeat, memory)
+        record(f"mac/{variant}/export", seconds, peak, bytes=os.path.getsize(configPath))
+
+        seconds, peak, _ = measure(lambda: compiler.compile_circuit(configPath, outfile), repeat, memory)
+        record(f"mac/{variant}/compile", seconds, peak, **compile_metrics())
+
+        # every input signal carries the bits of all vectors
+        netlist = netlist_io.load_netlist(configPath)
+        rng = np.random.default_rng(0)
+        inputs = list(rng.integers(0, 2, size=(netlist.num_inputs, vectors), dtype=np.uint8))
+        seconds, peak, _ = measure(lambda: netlist.evaluate_outputs(inputs), repeat, memory)
+        record(f"mac/{variant}/evaluate", seconds, peak, vectors=vectors, vectors_per_second=vectors / seconds)
+
+        operands = rng.integers(0, [256, 256, 65536], size=(16, 3)).tolist()
+        seconds, peak, _ = measure(lambda: [gates.MAC_Wrap(a, b, c, **kwargs) for a, b, c in operands], repeat, memory)
+        record(f"mac/{variant}/evaluate_builder", seconds, peak, vectors=len(operands), vectors_per_second=len(operands) / seconds)
+
+def build_multiplier(multiplier, width: int) -> None:
+    gates.Gate.reset()
+    gates.Register.reset()
+    a = gates.NumToBinRegisters(0, width)
+    b = gates.NumToBinRegisters(0, width)
+    gates.add_OUT_layer(multiplier(a, b))
+
+def multiplier_series(workDir: str, widths: list, repeat: int, memory: bool) -> None:
+    outfile = os.path.join(workDir, "multiplier.bin")
+    for kind, multiplier in MULTIPLIERS.items():
+        for width in widths:
+            seconds, peak, _ = measure(lambda: build_multiplier(multiplier, width), repeat, memory)
+            record(f"multiplier/{kind}/{width}/build", seconds, peak, gates=num_built_gates())
+
+            with contextlib.redirect_stdout(io.StringIO()):
+                netlist = gates.CircuitConfig().toNetlist()
+            seconds, peak, _ = measure(lambda: compiler.compile_netlist(netlist, outfile, "binary"), repeat, memory)
+            record(f"multiplier/{kind}/{width}/compile", seconds, peak, stages=netlist.num_stages(), **compile_metrics())
+
+def dag_series(workDir: str, sizes: list, repeat: int, memory: bool) -> None:
+    outfile = os.path.join(workDir, "dag.bin")
+    for size in sizes:
+        seconds, peak, netlist = measure(lambda: random_netlist(size), repeat, memory)
+        record(f"dag/{size}/generate", seconds, peak, gates=netlist.num_gates(), stages=netlist.num_stages())
+
+        seconds, peak, _ = measure(lambda: compiler.compile_netlist(netlist, outfile, "binary"), repeat, memory)
+        record(f"dag/{size}/compile", seconds, peak, **compile_metrics())
+
+
+# Results
+
+def metadata() -> dict:
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        commit = ""
+    return {"timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"), "commit": commit,
+            "python": platform.python_version(), "numpy": np.__version__, "platform": platform.platform(),
+            "parallelism": compiler.parallelism, "allocator": compiler.allocator}
+
+def compare(current: list, baseline: list, tolerance: float) -> list[str]:
+    '''
+        compares results with a baseline
+
+        returns:
+            regressions: benchmarks that got slower than (1 + tolerance) times the baseline (if they
+            take at least MIN_COMPARED_SECONDS), or compiled into more lines or memristors
+    '''
+    regressions = []
+    previous = {result["name"]: result for result in baseline}
+    for result in current:
+        old = previous.get(result["name"])
+        if old is None:
+            continue
+        ratio = result["seconds"] / old["seconds"] if old["seconds"] > 0 else 1.0
+        print(f"{result['name']:40s} {ratio:6.2f}x")
+        if ratio > 1 + tolerance and old["seconds"] >= MIN_COMPARED_SECONDS:
+            regressions.append(f"{result['name']}: {ratio:.2f}x slower")
+        for metric in ("lines", "memristors"):
+            if metric in old["metrics"] and result["metrics"].get(metric, 0) > old["metrics"][metric]:
+                regressions.append(f"{result['name']}: {metric} {old['metrics'][metric]} -> {result['metrics'][metric]}")
+    return regressions
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmarks of the imply logic compiler")
+    parser.add_argument("--out", default="benchmark_results.json", help="JSON file the results are written to")
+    parser.add_argument("--quick", action="store_true", help=f"multipliers up to {QUICK_MULTIPLIER_WIDTHS[-1]} bit, DAGs up to {QUICK_DAG_SIZES[-1]} gates")
+    parser.add_argument("--series", nargs="+", choices=["mac", "multiplier", "dag"], default=["mac", "multiplier", "dag"])
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--no-memory", action="store_true", help="skip the tracemalloc runs")
+    parser.add_argument("--vectors", type=int, default=4096, help="input vectors per batched evaluation")
+    parser.add_argument("--baseline", default=None, help="results of an earlier run to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed slowdown relative to the baseline")
+    args = parser.parse_args(argv)
+
+    memory = not args.no_memory
+    results.clear()
+    with tempfile.TemporaryDirectory() as workDir:
+        if "mac" in args.series:
+            mac_series(workDir, args.repeat, memory, args.vectors)
+        if "multiplier" in args.series:
+            multiplier_series(workDir, QUICK_MULTIPLIER_WIDTHS if args.quick else MULTIPLIER_WIDTHS, args.repeat, memory)
+        if "dag" in args.series:
+            dag_series(workDir, QUICK_DAG_SIZES if args.quick else DAG_SIZES, args.repeat, memory)
+
+    with open(args.out, "w") as f:
+        json.dump({"meta": metadata(), "results": results}, f, indent=4)
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f)["results"], args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        return 1 if len(regressions) > 0 else 0
+    return 0
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+"""
+Command line entry point: build -> export -> compile -> report
+
+    python cli.py build --variant exactAdder_exactMultiplier --config config.npz
+    python cli.py compile config.npz --out out/atomic_config.txt --parallelism 1
+    python cli.py compile config.npz --out out/atomic_config.txt --banks 4
+    python cli.py compile config.npz --out out/atomic_config.txt --reorder
+    python cli.py compile multiplier.aig --out out/multiplier.txt --parallelism 2
+    python cli.py report out/program.bin
+    python cli.py run --variant approxAdder_approxMultiplier
+
+Compilations are cached in --cache-dir (default .imply_cache), see compile_cache.py.
+"""
+
+import argparse
+import json
+import os
+
+import numpy as np
+
+import compiler
+import gate_order
+import gates
+import netlist_io
+from compile_cache import CompileCache
+from compile_profile import CompileProfile, gate_paths
+
+
+def build(args) -> None:
+    gates.maxGatesPerStage = args.max_gates_per_stage
+    gates.traceCalls = args.trace_calls
+    gates.MAC_Circuit(args.a, args.b, args.c, **gates.MAC_variants[args.variant], adder=args.adder, hierarchical=args.hierarchical)
+    gates.CircuitConfig.writeToFile(args.config)
+    print(f"Configuration file '{args.config}' has been created.")
+
+def compile_report(netlist: netlist_io.Netlist, cache: CompileCache=None) -> dict:
+    # summary of the last compilation, outputs are the registers read by OUT gates
+    # with several banks every output is stored once per bank
+    outputs = {}
+    for signal in netlist.output_signals():
+        registers = [compiler.bank_register(compiler.signal_register[signal], bank) for bank in range(compiler.banks)]
+        outputs[str(netlist.labels[signal])] = registers[0] if compiler.banks == 1 else registers
+
+    report = {"memristors": compiler.num_registers * compiler.banks,
+              "banks": compiler.banks,
+              "lines": compiler.num_lines,
+              "gates": {label: count for label, count in zip(netlist_io.GATE_TYPES, compiler.gate_counts)},
+              "outputs": outputs}
+    if cache is not None:
+        report["cache"] = {"program_hit": cache.programHit, "segment_hits": cache.segmentHits, "segment_misses": cache.segmentMisses}
+    return report
+
+def compile_config(args) -> dict:
+    compiler.parallelism = args.parallelism
+    compiler.banks = args.banks
+    compiler.allocator = args.allocator
+    # profiles record every compiled stage, a cache hit compiles none, so they bypass the cache
+    attribution = args.attribution is not None or args.flamegraph is not None
+    profiling = attribution or args.profile is not None or args.profile_csv is not None or args.profile_trace is not None
+    compiler.profile = CompileProfile() if profiling else None
+    netlist = compiler.timed("load", netlist_io.load_netlist, args.config, args.parallelism)
+    if args.reorder:
+        netlist, order = compiler.timed("reorder", gate_order.reorder_netlist, netlist, args.parallelism, args.allocator)
+
+    outDir = os.path.dirname(args.out)
+    if outDir != "" and not os.path.exists(outDir):
+        os.makedirs(outDir)
+
+    if args.no_cache or profiling:
+        cache = None
+        compiler.compile_netlist(netlist, outfile=args.out, outputFormat=args.format)
+    else:
+        cache = CompileCache(args.cache_dir)
+        cache.compile(netlist, outfile=args.out, outputFormat=args.format)
+
+    if profiling:
+        write_profile(compiler.profile, netlist, args)
+        compiler.profile = None
+    report = compile_report(netlist, cache)
+    if args.reorder:
+        report["order"] = order
+    return report
+
+def write_profile(profile: CompileProfile, netlist: netlist_io.Netlist, args) -> None:
+    if args.profile is not None:
+        profile.to_json(args.profile)
+    if args.profile_csv is not None:
+        profile.to_csv(args.profile_csv)
+    if args.profile_trace is not None:
+        profile.to_chrome_trace(args.profile_trace)
+    if args.attribution is not None:
+        with open(args.attribution, "w") as f:
+            json.dump(profile.rollup(gate_paths(netlist)), f, indent=4)
+    if args.flamegraph is not None:
+        profile.to_folded(args.flamegraph, gate_paths(netlist))
+
+def print_report(report: dict, jsonPath: str=None) -> None:
+    if jsonPath is not None:
+        with open(jsonPath, "w") as f:
+            json.dump(report, f, indent=4)
+    for key, value in report.items():
+        print(f"{key}: {value}")
+
+def report(args) -> None:
+    header, _, program_gates = compiler.load_program(args.program)
+    counts = np.bincount(np.asarray(program_gates[:, 3]), minlength=len(netlist_io.GATE_TYPES))
+    banks = max(int(header["banks"]), 1)
+    print_report({"memristors": int(header["num_registers"]) * banks,
+                  "banks": banks,
+                  "lines": int(header["num_lines"]),
+                  "parallelism": int(header["parallelism"]),
+                  "gates": {label: int(count) for label, count in zip(netlist_io.GATE_TYPES, counts)}}, args.json)
+
+def run(args) -> None:
+    args.max_gates_per_stage = args.parallelism
+    build(args)
+    print_report(compile_config(args), args.json)
+
+
+def add_build_arguments(parser) -> None:
+    parser.add_argument("--variant", choices=list(gates.MAC_variants), default="exactAdder_exactMultiplier")
+    parser.add_argument("--a", type=int, default=0, help="value of the 8 bit input a")
+    parser.add_argument("--b", type=int, default=0, help="value of the 8 bit input b")
+    parser.add_argument("--c", type=int, default=0, help="value of the 16 bit input c")
+    parser.add_argument("--adder", choices=gates.MAC_ADDERS, default="ripple", help="adder of the accumulator")
+    parser.add_argument("--config", default="config.json", help="config file (.json, .jsonl or .npz)")
+    parser.add_argument("--hierarchical", action="store_true", help="instantiate the 4x4 multipliers as modules")
+    parser.add_argument("--trace-calls", action="store_true", help="tag every gate with the subcircuits it was created in")
+
+def add_compile_arguments(parser) -> None:
+    parser.add_argument("--out", default="out/atomic_config.txt")
+    parser.add_argument("--format", choices=["text", "binary"], default="text")
+    parser.add_argument("--parallelism", type=int, default=1)
+    parser.add_argument("--banks", type=int, default=1, help="independent data lanes, each on its own memristors, running the same program")
+    parser.add_argument("--allocator", choices=list(compiler.ALLOCATORS), default="reuse")
+    parser.add_argument("--reorder", action="store_true", help="reorder the gates to need fewer memristors with --allocator (see gate_order.py), drops call paths, netlists with modules are kept as they are")
+    parser.add_argument("--cache-dir", default=".imply_cache")
+    parser.add_argument("--no-cache", action="store_true")
+    parser.add_argument("--json", default=None, help="also write the report to this file")
+    parser.add_argument("--profile", default=None, help="write compiler instrumentation as JSON to this file")
+    parser.add_argument("--profile-csv", default=None, help="write per stage instrumentation as CSV to this file")
+    parser.add_argument("--profile-trace", default=None, help="write a Chrome trace of the compilation to this file")
+    parser.add_argument("--attribution", default=None, help="write costs per subcircuit as JSON to this file (needs --trace-calls)")
+    parser.add_argument("--flamegraph", default=None, help="write imply steps per subcircuit as folded stacks to this file")
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(description="Imply logic compiler for the ATOMIC tool")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    parser_build = commands.add_parser("build", help="build a MAC circuit and export its config")
+    add_build_arguments(parser_build)
+    parser_build.add_argument("--max-gates-per-stage", type=int, default=1)
+
+    parser_compile = commands.add_parser("compile", help="compile a config into imply logic")
+    parser_compile.add_argument("config", help="config file (.json, .jsonl or .npz) or circuit to import (.blif, .aag or .aig)")
+    add_compile_arguments(parser_compile)
+
+    parser_report = commands.add_parser("report", help="summarise a binary program")
+    parser_report.add_argument("program")
+    parser_report.add_argument("--json", default=None)
+
+    parser_run = commands.add_parser("run", help="build, export, compile and report")
+    add_build_arguments(parser_run)
+    add_compile_arguments(parser_run)
+
+    args = parser.parse_args(argv)
+    if args.command == "build":
+        build(args)
+    elif args.command == "compile":
+        print_report(compile_config(args), args.json)
+    elif args.command == "report":
+        report(args)
+    elif args.command == "run":
+        run(args)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+"""
+Co-compilation of several circuits into one imply program over one memristor array
+
+    python cocompile.py --out out/mac_variants.txt
+    python cocompile.py --variants exactAdder_exactMultiplier approxAdder_approxMultiplier --parallelism 3
+
+The circuits are merged by merge_circuits: inputs with the same name are shared, and gates that
+compute the same function of the same signals (same type, same inputs, up to the order of the inputs)
+are created only once, so identical subcircuits like the exact 4x4 multipliers of several MAC
+variants are deduplicated. The merged circuit is scheduled again and compiled as a single program,
+every output keeps the name of its circuit ("<circuit>/<label>").
+
+For the MAC variants the operand bits are named a0..a7, b0..b7 and c0..c15 (bit weight) and the
+constant inputs CONST0/CONST1, so all variants read the same input memristors.
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+
+import numpy as np
+
+import compiler
+import dse
+import gates
+import netlist_io
+
+COMMUTATIVE = {netlist_io.GATE_CODES["OR"], netlist_io.GATE_CODES["AND"], netlist_io.GATE_CODES["XOR"]}
+
+
+def merge_circuits(circuits: dict, maxGatesPerStage: int=1) -> tuple[netlist_io.Netlist, dict]:
+    '''
+        merges circuits into one netlist with shared inputs and deduplicated gates
+
+        expects:
+            circuits: circuit name : (Netlist without instances, name of every input of the netlist)
+
+        returns:
+            netlist: merged circuit, inputs in order of their first appearance
+            outputs: circuit name : labels of its outputs in the merged netlist, equal outputs of several
+                     circuits are the same OUT gate
+    '''
+    flat = {name: (netlist.flat_gates(), netlist.num_inputs, input_names) for name, (netlist, input_names) in circuits.items()}
+
+    input_ids = {}
+    for (_, num_inputs, input_names) in flat.values():
+        if len(input_names) != num_inputs:
+            raise Exception(f"ERROR: {num_inputs} inputs need {num_inputs} names, given {len(input_names)}!")
+        for input_name in input_names:
+            input_ids.setdefault(input_name, len(input_ids))
+
+    labels = list(input_ids)
+    num_inputs = len(labels)
+    gate_types = []
+    gate_inputs = []
+    structure = {}      # (type, inputs) : signal id in the merged circuit
+    merged_outputs = []
+    output_labels = []
+    shared_outputs = {}     # signal id : label of the OUT gate reading it
+    outputs = {}
+    for name, ((circuit_labels, circuit_types, circuit_inputs, circuit_outputs, circuit_output_labels), circuit_num_inputs, input_names) in flat.items():
+        signals = [input_ids[input_name] for input_name in input_names]
+        for gate, (code, inputs) in enumerate(zip(circuit_types, circuit_inputs)):
+            inputs = [signals[signal] for signal in inputs]
+            key = (code, tuple(sorted(inputs)) if code in COMMUTATIVE else tuple(inputs))
+            if key not in structure:
+                structure[key] = num_inputs + len(gate_types)
+                gate_types.append(code)
+                gate_inputs.append(inputs)
+                labels.append(f"{name}/{circuit_labels[circuit_num_inputs + gate]}")
+            signals.append(structure[key])
+        # outputs computed by several circuits share their OUT gate and memristor
+        outputs[name] = []
+        for signal, label in zip(circuit_outputs, circuit_output_labels):
+            signal = signals[signal]
+            if signal not in shared_outputs:
+                shared_outputs[signal] = f"{name}/{label}"
+                merged_outputs.append(signal)
+                output_labels.append(shared_outputs[signal])
+            outputs[name].append(shared_outputs[signal])
+
+    netlist = netlist_io.schedule_gates(labels, num_inputs, gate_types, gate_inputs, merged_outputs, output_labels, maxGatesPerStage)
+    return netlist, outputs
+
+
+# MAC variants
+
+def mac_circuit(variant: str, parallelism: int=1) -> tuple[netlist_io.Netlist, list[str]]:
+    '''
+        builds a MAC variant of gates.MAC_variants
+
+        returns:
+            netlist: gate tables of the variant
+            input_names: a0..a7, b0..b7, c0..c15 for the operand bits (by weight), CONST0/CONST1 for constants
+    '''
+    gates.maxGatesPerStage = parallelism
+    gates.MAC_Circuit(0, 0, 0, **gates.MAC_variants[variant])
+    names = {}
+    for operand, width in (("a", dse.A_BITS), ("b", dse.B_BITS), ("c", dse.C_BITS)):
+        for weight in range(width - 1, -1, -1):
+            names[gates.Register.inputRegisters[len(names)].getLabel()] = f"{operand}{weight}"
+    for register in gates.Register.inputRegisters[len(names):]:
+        names[register.getLabel()] = f"CONST{register.getValue()}"
+    with contextlib.redirect_stdout(io.StringIO()):
+        netlist = gates.CircuitConfig().toNetlist()
+    return netlist, [names[label] for label in netlist.input_registers()]
+
+def compile_costs(netlist: netlist_io.Netlist, parallelism: int, outfile: str=None, outputFormat: str="text") -> dict:
+    compiler.parallelism = parallelism
+    with contextlib.redirect_stdout(io.StringIO()):
+        compiler.compile_netlist(netlist, outfile=outfile, outputFormat=outputFormat)
+    return {"memristors": compiler.num_registers, "lines": compiler.num_lines, "gates": netlist.num_gates() - netlist.num_outputs()}
+
+def compare_outputs(netlist: netlist_io.Netlist, outputs: dict, vectors: int=4096, seed: int=0) -> dict:
+    # error metrics of every circuit against the exact a*b + c, all circuits evaluated in one simulation
+    a, b, c = dse.operand_vectors(vectors, seed)
+    bits = {}
+    for operand, values, width in (("a", a, dse.A_BITS), ("b", b, dse.B_BITS), ("c", c, dse.C_BITS)):
+        for weight, value in zip(range(width - 1, -1, -1), dse.to_bits(values, width)):
+            bits[f"{operand}{weight}"] = value
+    inputs = [bits[label] if label in bits else np.full(len(a), int(label == "CONST1"), dtype=np.uint8) for label in netlist.input_registers()]
+    values = netlist.evaluate(inputs)
+
+    exact = (a * b + c) % 2**dse.RESULT_BITS
+    metrics = {}
+    for name, labels in outputs.items():
+        result = np.zeros(len(a), dtype=np.int64)
+        for label in labels:
+            result = (result << 1) | values[netlist.signal_id(label)]
+        metrics[name] = dse.error_metrics(result, exact)
+    return metrics
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(description="Compile several MAC variants into one imply program")
+    parser.add_argument("--variants", nargs="+", choices=list(gates.MAC_variants), default=list(gates.MAC_variants))
+    parser.add_argument("--parallelism", type=int, default=1)
+    parser.add_argument("--out", default="out/shared_config.txt")
+    parser.add_argument("--format", choices=["text", "binary"], default="text")
+    parser.add_argument("--vectors", type=int, default=4096, help="random operands the outputs are compared on")
+    parser.add_argument("--json", default=None, help="also write the report to this file")
+    args = parser.parse_args(argv)
+
+    circuits = {variant: mac_circuit(variant, args.parallelism) for variant in args.variants}
+    separate = {variant: compile_costs(netlist, args.parallelism) for variant, (netlist, _) in circuits.items()}
+    netlist, outputs = merge_circuits(circuits, args.parallelism)
+    outDir = os.path.dirname(args.out)
+    if outDir != "" and not os.path.exists(outDir):
+        os.makedirs(outDir)
+    shared = compile_costs(netlist, args.parallelism, args.out, args.format)
+
+    report = {"separate": separate,
+              "separate_total": {key: sum(costs[key] for costs in separate.values()) for key in ("memristors", "lines", "gates")},
+              "shared": shared,
+              "outputs": {name: [compiler.signal_register[netlist.signal_id(label)] for label in labels] for name, labels in outputs.items()},
+              "errors": compare_outputs(netlist, outputs, args.vectors)}
+    if args.json is not None:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=4)
+    for key, value in report.items():
+        print(f"{key}: {value}")
+
+if __name__ == "__main__":
+    main()
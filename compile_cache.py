@@ -0,0 +1,282 @@
+import hashlib
+import heapq
+import json
+import os
+import shutil
+import zlib
+from array import array
+
+import numpy as np
+
+import compiler
+import netlist_io
+
+# Content addressed cache of compiled programs
+#
+# Whole programs are cached under a hash of the netlist and the compiler options. Below that the
+# stages are split into segments at content defined boundaries, so inserting or changing a block of
+# the circuit does not move the boundaries of the other segments. A segment is cached under a hash of
+# its gates and of the register state it starts from, both expressed in memristor indices. If an edit
+# only changes some segments, the other segments are taken from the cache as soon as the register
+# state before them matches again.
+#
+#   <cacheDir>/programs/<key>.bin    binary program (see compiler.load_program)
+#   <cacheDir>/programs/<key>.json   number of memristors, lines and gates per type
+#   <cacheDir>/programs/<key>.npy    memristor of every signal after compilation
+#   <cacheDir>/segments/<key>.npz    compiled segment and the register state after it
+
+CACHE_VERSION = 3
+
+SEGMENT_MIN_STAGES = 16
+SEGMENT_AVG_STAGES = 64
+SEGMENT_MAX_STAGES = 1024
+
+KEEP = -2   # register of a segment state still holds the value it held before the segment
+
+
+def stage_fingerprint(stage) -> int:
+    # only relative signal ids are used, so the fingerprint does not change if gates are inserted earlier
+    gates, free = stage
+    fingerprint = [len(free)]
+    for gate in gates:
+        code, inputs, output = gate[0], gate[1], gate[2]
+        if code == netlist_io.INST_CODE:
+            fingerprint.append(gate[3])
+            output = output[0]
+        fingerprint.append(code)
+        fingerprint.extend(output - signal for signal in inputs)
+    return zlib.crc32(repr(fingerprint).encode())
+
+def split_segments(stages):
+    '''
+        splits stages into segments at content defined boundaries
+
+        returns:
+            generator of lists of stages
+    '''
+    segment = []
+    for stage in stages:
+        segment.append(stage)
+        if len(segment) >= SEGMENT_MAX_STAGES or (len(segment) >= SEGMENT_MIN_STAGES and stage_fingerprint(stage) % SEGMENT_AVG_STAGES == 0):
+            yield segment
+            segment = []
+    if len(segment) > 0:
+        yield segment
+
+def register_order():
+    # registers sorted by rank, only the order of ranks influences the allocation
+    return sorted(range(compiler.num_registers), key=compiler.register_rank.__getitem__)
+
+
+class CompileCache():
+    def __init__(self, cacheDir: str=".imply_cache"):
+        self.cacheDir = cacheDir
+        self.programHit = False
+        self.segmentHits = 0
+        self.segmentMisses = 0
+        self.moduleKeys = {}    # module name : hash of its body, for the netlist that is compiled
+        os.makedirs(os.path.join(cacheDir, "programs"), exist_ok=True)
+        os.makedirs(os.path.join(cacheDir, "segments"), exist_ok=True)
+
+    def options_key(self) -> bytes:
+        # everything besides the netlist that changes the compiled program
+        options = [CACHE_VERSION, compiler.parallelism, compiler.allocator]
+        for template in compiler.gate_templates:
+            options.append([template.label, template.code.tolist(), template.num_work, template.result, template.to_be_freed])
+        return json.dumps(options).encode()
+
+    def update_tables(self, key, netlist: netlist_io.Netlist) -> None:
+        key.update(np.int64(netlist.num_inputs).tobytes())
+        key.update(np.ascontiguousarray(netlist.gate_types, dtype=np.uint8).tobytes())
+        key.update(np.ascontiguousarray(netlist.gate_inputs, dtype=np.int32).tobytes())
+        key.update(np.ascontiguousarray(netlist.stage_offsets, dtype=np.int64).tobytes())
+        key.update(np.ascontiguousarray(netlist.free_registers, dtype=np.int32).tobytes())
+        key.update(np.ascontiguousarray(netlist.free_offsets, dtype=np.int64).tobytes())
+        key.update(np.ascontiguousarray(netlist.instance_modules, dtype=np.int32).tobytes())
+        key.update(np.ascontiguousarray(netlist.instance_offsets, dtype=np.int64).tobytes())
+        key.update(np.ascontiguousarray(netlist.instance_inputs, dtype=np.int32).tobytes())
+        key.update(json.dumps(netlist.module_names).encode())
+
+    def netlist_key(self, netlist: netlist_io.Netlist) -> str:
+        # bodies of the modules are part of the key, their names only through the instances referencing them
+        self.moduleKeys = {}
+        for name, module in netlist.modules.items():
+            key = hashlib.blake2b(digest_size=8)
+            self.update_tables(key, module)
+            key.update(json.dumps([self.moduleKeys[used] for used in module.module_names]).encode())
+            self.moduleKeys[name] = key.hexdigest()
+
+        key = hashlib.blake2b(self.options_key(), digest_size=20)
+        self.update_tables(key, netlist)
+        key.update(json.dumps(self.moduleKeys).encode())
+        return key.hexdigest()
+
+    def segment_key(self, segment, first_signal: int) -> str:
+        '''
+            hashes the register state and the gates of a segment
+
+            signals created before the segment are replaced by the memristor that stores them,
+            signals created inside of the segment are numbered relative to its first signal
+        '''
+        signal_register = compiler.signal_register
+        content = array("q", [compiler.num_registers])
+        content.extend(register_order())
+        content.extend(compiler.register_free)
+        for gates, free in segment:
+            content.append(len(gates))
+            for gate in gates:
+                code, inputs = gate[0], gate[1]
+                content.append(code)
+                if code == netlist_io.INST_CODE:
+                    content.append(int(self.moduleKeys[gate[3]], 16) >> 1)
+                content.append(len(inputs))
+                content.extend(signal_register[signal] if signal < first_signal else -2 - (signal - first_signal) for signal in inputs)
+            content.append(len(free))
+            content.extend(signal_register[signal] if signal < first_signal else -2 - (signal - first_signal) for signal in free)
+
+        key = hashlib.blake2b(self.options_key(), digest_size=20)
+        key.update(content.tobytes())
+        return key.hexdigest()
+
+    def compile(self, netlist: netlist_io.Netlist, outfile: str="out/atomic_config.txt", outputFormat: str="text") -> int:
+        '''
+            compiles a netlist like compiler.compile_netlist, reusing cached programs and segments
+
+            returns:
+                amount of memristors used for this circuit, in all banks
+        '''
+        path = os.path.join(self.cacheDir, "programs", self.netlist_key(netlist))
+        self.programHit = os.path.exists(path + ".json")
+        if not self.programHit:
+            self.compile_segments(netlist, path)
+        self.restore(netlist, path)
+        if compiler.profile is not None:
+            compiler.profile.finish()
+
+        # cached programs are compiled for one bank, the banks are only a field of the header
+        if outfile is not None:
+            if outputFormat == "binary":
+                shutil.copyfile(path + ".bin", outfile)
+                header = np.memmap(outfile, dtype=compiler.PROGRAM_HEADER, mode="r+", shape=(1,))
+                header["banks"] = compiler.banks
+                header.flush()
+            else:
+                compiler.render_program(path + ".bin", outfile, num_banks=compiler.banks)
+
+        print(f"Number of Memristors: {compiler.num_registers * compiler.banks}")
+        return compiler.num_registers * compiler.banks
+
+    def compile_segments(self, netlist: netlist_io.Netlist, path: str) -> None:
+        compiler.timed("modules", compiler.compile_modules, netlist.modules)
+        compiler.circuit = netlist
+        compiler.reset_compiler(netlist.num_inputs)
+
+        writer = compiler.BinaryProgramWriter(path + ".bin.tmp", compiler.parallelism)
+        first_signal = netlist.num_inputs
+        for segment in split_segments(netlist.stages()):
+            key = self.segment_key(segment, first_signal)
+            segmentPath = os.path.join(self.cacheDir, "segments", key + ".npz")
+            counts = np.array(compiler.gate_counts)
+            if os.path.exists(segmentPath):
+                self.segmentHits = self.segmentHits + 1
+                entry = np.load(segmentPath)
+                self.apply_segment(entry, first_signal)
+            else:
+                self.segmentMisses = self.segmentMisses + 1
+                entry = self.compile_segment(segment, first_signal)
+                np.savez(segmentPath + ".tmp.npz", **entry)
+                os.replace(segmentPath + ".tmp.npz", segmentPath)
+
+            # counts of the gates are stored relative to the segment
+            gates = np.array(entry["gates"], dtype=np.int64)
+            gates[:, 4] = gates[:, 4] + counts[gates[:, 3]]
+            writer.write(compiler.decode_instructions(entry["words"]), gates)
+            first_signal = first_signal + sum(netlist_io.num_signals(stage_gates) for stage_gates, _ in segment)
+        writer.close(compiler.num_registers)
+        os.replace(path + ".bin.tmp", path + ".bin")
+
+        np.save(path + ".npy", np.array(compiler.signal_register, dtype=np.int32))
+        with open(path + ".json", "w") as f:
+            json.dump({"num_registers": compiler.num_registers, "num_lines": compiler.num_lines, "gate_counts": compiler.gate_counts}, f)
+
+    def compile_segment(self, segment, first_signal: int) -> dict:
+        num_registers = compiler.num_registers
+        register_signal = list(compiler.register_signal)
+        counts = np.array(compiler.gate_counts)
+        num_lines = compiler.num_lines
+
+        instructions, gates = compiler.concatenate_chunks(list(compiler.compile_stages(segment)))
+        gates[:, 4] = gates[:, 4] - counts[gates[:, 3]]
+
+        content = []
+        for index, signal in enumerate(compiler.register_signal):
+            if index < num_registers and signal == register_signal[index]:
+                content.append(KEEP)
+            elif signal == compiler.NO_REG:
+                content.append(compiler.NO_REG)
+            else:
+                content.append(signal - first_signal)
+
+        return {"words": compiler.encode_instructions(instructions),
+                "gates": gates,
+                "order": np.array(register_order(), dtype=np.int64),
+                "free": np.array(compiler.register_free, dtype=bool),
+                "content": np.array(content, dtype=np.int64),
+                "counts": np.array(compiler.gate_counts) - counts,
+                "lines": np.array(compiler.num_lines - num_lines),
+                "signals": np.array(sum(netlist_io.num_signals(stage_gates) for stage_gates, _ in segment))}
+
+    def apply_segment(self, entry, first_signal: int) -> None:
+        # brings the register state of the compiler to the state after a cached segment
+        content = entry["content"].tolist()
+        num_registers = len(content)
+        for _ in range(compiler.num_registers, num_registers):
+            compiler.register_signal.append(compiler.NO_REG)
+            compiler.register_rank.append(0)
+            compiler.register_free.append(False)
+        compiler.num_registers = num_registers
+
+        signal_register = compiler.signal_register
+        last_signal = first_signal + int(entry["signals"])
+        if len(signal_register) < last_signal:
+            signal_register.extend([compiler.NO_REG] * (last_signal - len(signal_register)))
+
+        for index, signal in enumerate(content):
+            if signal == KEEP:
+                continue
+            old = compiler.register_signal[index]
+            if old != compiler.NO_REG and signal_register[old] == index:
+                signal_register[old] = compiler.NO_REG
+            if signal == compiler.NO_REG:
+                compiler.register_signal[index] = compiler.NO_REG
+            else:
+                compiler.register_signal[index] = first_signal + signal
+                signal_register[first_signal + signal] = index
+
+        for position, index in enumerate(entry["order"].tolist()):
+            compiler.register_rank[index] = compiler.next_rank + position
+        compiler.next_rank = compiler.next_rank + num_registers
+
+        compiler.register_free[:] = entry["free"].tolist()
+        compiler.free_heap = [(compiler.register_rank[index], index) for index in range(num_registers) if compiler.register_free[index]]
+        heapq.heapify(compiler.free_heap)
+        compiler.num_free_registers = len(compiler.free_heap)
+
+        for code, count in enumerate(entry["counts"].tolist()):
+            compiler.gate_counts[code] = compiler.gate_counts[code] + count
+        compiler.num_lines = compiler.num_lines + int(entry["lines"])
+
+    def restore(self, netlist: netlist_io.Netlist, path: str) -> None:
+        # makes the results of a cached program available through the compiler (e.g. getOutputIndices)
+        with open(path + ".json") as f:
+            meta = json.load(f)
+        compiler.circuit = netlist
+        compiler.signal_register = np.load(path + ".npy").tolist()
+        compiler.num_registers = meta["num_registers"]
+        compiler.num_lines = meta["num_lines"]
+        compiler.gate_counts = meta["gate_counts"]
+
+    def clear(self) -> None:
+        shutil.rmtree(self.cacheDir)
+        os.makedirs(os.path.join(self.cacheDir, "programs"))
+        os.makedirs(os.path.join(self.cacheDir, "segments"))
@@ -0,0 +1,275 @@
+import csv
+import json
+import time
+from array import array
+
+import numpy as np
+
+import compiler
+import netlist_io
+
+# Instrumentation of the compiler
+#
+# Attach a profile before compiling and export it afterwards:
+#
+#   compiler.profile = CompileProfile()
+#   compiler.compile_circuit("config.json")
+#   compiler.profile.to_json("profile.json")
+#
+# Recorded are the wall times of the phases (load, modules, emit, write), and for every stage the
+# wall time of process_stage, its imply lines, the busy steps per gate type, the padding nops, the
+# live memristors after the stage and the memristors allocated so far. Times are seconds relative to
+# the creation of the profile. Allocator statistics are taken from compiler.allocator_stats.
+#
+# Costs are also kept per gate in compile order: imply steps, the share of the stage's lines
+# (proportional to the steps, exact without parallelism) and the memristors newly allocated for the
+# gate. rollup combines them with the call paths of the gates (see gates.traceCalls) into costs per
+# subcircuit, to_folded writes them as folded stacks for flame graph tools. An instance of a module is
+# followed by the gates of its body, which share the lines of the instance and continue the call path
+# of its caller (see gate_paths), the memristors the instance allocates are kept on the instance.
+
+ROOT_PATH = "circuit"
+
+def gate_paths(netlist) -> list[str]:
+    '''
+        call path of every gate in compile order, every instance is followed by the gates of its module
+        without their OUT gates, which only rename inside the module
+
+        The body of a module is traced from the function it wraps on, so its paths continue the path of the
+        caller of the instance (the instance path without the module name). Gates of the body outside of any
+        traced function get the path of the instance.
+    '''
+    return [path for path, _ in linked_gates(netlist)]
+
+def linked_gates(netlist) -> list[tuple[str, int]]:
+    # (call path, type code) of every gate in compile order, see gate_paths
+    gates = []
+    instance_modules = [netlist.module_names[module] for module in np.asarray(netlist.instance_modules).tolist()]
+    for path, code, inputs in zip(netlist.paths(), np.asarray(netlist.gate_types).tolist(), np.asarray(netlist.gate_inputs).tolist()):
+        gates.append((path, code))
+        if code != compiler.INST_CODE:
+            continue
+        caller = path.rpartition("/")[0]
+        for body, body_code in linked_gates(netlist.modules[instance_modules[inputs[0]]]):
+            if body_code != netlist_io.OUT_CODE:
+                gates.append((path if not body else f"{caller}/{body}" if caller else body, body_code))
+    return gates
+
+class CompileProfile():
+    def __init__(self):
+        self.origin = time.perf_counter()
+        self.step_types = [template.label for template in compiler.gate_templates]
+
+        self.phase_names = []           # name of every phase event
+        self.phase_start = array("d")
+        self.phase_time = array("d")
+        self.phase_totals = {}          # name : accumulated seconds
+
+        self.stage_start = array("d")
+        self.stage_time = array("d")    # process_stage
+        self.stage_load = array("d")    # reading the stage from its source
+        self.stage_first_line = array("q")
+        self.stage_lines = array("q")
+        self.stage_gates = array("q")
+        self.stage_nops = array("q")
+        self.stage_live = array("q")
+        self.stage_registers = array("q")
+        self.stage_steps = [array("q") for _ in self.step_types]
+        self.load_time = 0.0
+
+        self.gate_steps = array("q")
+        self.gate_lines = array("d")
+        self.gate_memristors = array("q")   # appended by compiler.process_stage
+        self.gate_codes = array("b")
+
+        self.summary_values = {}
+
+    def add_phase(self, name: str, start: float, stop: float) -> None:
+        self.phase_names.append(name)
+        self.phase_start.append(start - self.origin)
+        self.phase_time.append(stop - start)
+        self.phase_totals[name] = self.phase_totals.get(name, 0.0) + stop - start
+
+    def stages(self, stages):
+        # passes the stages through, the time to produce each of them is added to its record
+        stages = iter(stages)
+        while True:
+            start = time.perf_counter()
+            try:
+                stage = next(stages)
+            except StopIteration:
+                return
+            self.load_time = time.perf_counter() - start
+            self.phase_totals["load"] = self.phase_totals.get("load", 0.0) + self.load_time
+            yield stage
+
+    def add_stage(self, start: float, stop: float, first_line: int, num_lines: int, gates: list, placements: list) -> None:
+        gate_steps = []
+        fragments = []
+        for gate in gates:
+            if gate[0] == compiler.INST_CODE:
+                fragment = compiler.circuit.modules[gate[3]].fragments[(compiler.parallelism, compiler.allocator)]
+                gate_steps.append(fragment.num_steps)
+                fragments.append(fragment)
+            else:
+                gate_steps.append(compiler.gate_templates[gate[0]].length)
+                fragments.append(None)
+        busy = sum(gate_steps)
+
+        # memristors were appended by process_stage for the gates of the stage, instances are expanded
+        first = len(self.gate_memristors) - len(gates)
+        gate_memristors = self.gate_memristors[first:]
+        del self.gate_memristors[first:]
+        for gate, fragment, steps, memristors in zip(gates, fragments, gate_steps, gate_memristors):
+            lines = num_lines * steps / busy if busy > 0 else 0.0
+            self.gate_codes.append(gate[0])
+            if fragment is None or fragment.gate_costs is None:
+                self.gate_steps.append(steps)
+                self.gate_lines.append(lines)
+                self.gate_memristors.append(memristors)
+                continue
+            body_steps, body_lines, body_codes = fragment.gate_costs
+            share = lines / fragment.num_lines if fragment.num_lines > 0 else 0.0
+            self.gate_steps.append(0)
+            self.gate_lines.append(0.0)
+            self.gate_memristors.append(memristors)
+            self.gate_steps.extend(body_steps)
+            self.gate_lines.extend(body * share for body in body_lines)
+            self.gate_memristors.extend([0] * len(body_steps))
+            self.gate_codes.extend(body_codes)
+
+        steps = [0] * len(self.step_types)
+        for placement in placements:
+            code = placement[0]
+            if code == compiler.INST_CODE:
+                for inner, count in enumerate(placement[1][1].steps[:len(steps)]):
+                    steps[inner] = steps[inner] + count
+            else:
+                steps[code] = steps[code] + compiler.gate_templates[code].length
+
+        self.stage_start.append(start - self.origin)
+        self.stage_time.append(stop - start)
+        self.stage_load.append(self.load_time)
+        self.stage_first_line.append(first_line)
+        self.stage_lines.append(num_lines)
+        self.stage_gates.append(len(placements))
+        self.stage_nops.append(num_lines * compiler.parallelism - sum(steps))
+        self.stage_live.append(compiler.num_registers - compiler.num_free_registers)
+        self.stage_registers.append(compiler.num_registers)
+        for column, count in zip(self.stage_steps, steps):
+            column.append(count)
+        self.phase_totals["stages"] = self.phase_totals.get("stages", 0.0) + stop - start
+        self.load_time = 0.0
+
+    def finish(self) -> None:
+        # called by the compiler after the last stage, takes over the totals of the compilation
+        steps = {label: int(sum(column)) for label, column in zip(self.step_types, self.stage_steps)}
+        busy = sum(steps.values())
+        slots = compiler.num_lines * compiler.parallelism
+        self.summary_values = {"memristors": compiler.num_registers,
+                               "lines": compiler.num_lines,
+                               "parallelism": compiler.parallelism,
+                               "allocator": compiler.allocator,
+                               "stages": len(self.stage_lines),
+                               "steps": steps,
+                               "nops": int(sum(self.stage_nops)),
+                               "utilisation": busy / slots if slots > 0 else 0.0,
+                               "peak_live_memristors": max(self.stage_live, default=0),
+                               "allocator_stats": dict(compiler.allocator_stats)}
+
+    def summary(self) -> dict:
+        summary = dict(self.summary_values)
+        summary["phases"] = dict(self.phase_totals)
+        return summary
+
+    def stage_columns(self) -> dict:
+        columns = {"stage": list(range(len(self.stage_lines))),
+                   "first_line": self.stage_first_line.tolist(),
+                   "lines": self.stage_lines.tolist(),
+                   "gates": self.stage_gates.tolist(),
+                   "nops": self.stage_nops.tolist(),
+                   "live_memristors": self.stage_live.tolist(),
+                   "memristors": self.stage_registers.tolist(),
+                   "load_seconds": self.stage_load.tolist(),
+                   "process_seconds": self.stage_time.tolist()}
+        for label, column in zip(self.step_types, self.stage_steps):
+            columns[f"steps_{label}"] = column.tolist()
+        return columns
+
+    def to_json(self, path: str) -> None:
+        with open(path, "w") as f:
+            json.dump({"summary": self.summary(), "stages": self.stage_columns()}, f)
+
+    def to_csv(self, path: str) -> None:
+        # one row per stage
+        columns = self.stage_columns()
+        with open(path, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(list(columns))
+            writer.writerows(zip(*columns.values()))
+
+    def rollup(self, paths: list) -> dict:
+        '''
+            rolls the costs of the gates up per call path
+
+            expects:
+                paths: call path of every gate in compile order, see gate_paths
+
+            returns:
+                call path : {"gates", "steps", "lines", "memristors"} including all nested paths, with the
+                same keys prefixed by "self_" for the gates created directly in the path. Paths start
+                with ROOT_PATH, which covers the whole circuit
+        '''
+        if len(paths) != len(self.gate_steps):
+            raise Exception(f"ERROR: Profile holds costs of {len(self.gate_steps)} gates, but {len(paths)} paths are given!")
+
+        metrics = ("gates", "steps", "lines", "memristors")
+        costs = {}
+        for path, steps, lines, memristors in zip(paths, self.gate_steps, self.gate_lines, self.gate_memristors):
+            path = f"{ROOT_PATH}/{path}" if path else ROOT_PATH
+            if path not in costs:
+                costs[path] = dict.fromkeys(metrics, 0)
+            for metric, value in zip(metrics, (1, steps, lines, memristors)):
+                costs[path][metric] = costs[path][metric] + value
+
+        rolled = {}
+        for path, cost in costs.items():
+            parts = path.split("/")
+            for depth in range(1, len(parts) + 1):
+                prefix = "/".join(parts[:depth])
+                if prefix not in rolled:
+                    rolled[prefix] = dict.fromkeys(metrics + tuple(f"self_{metric}" for metric in metrics), 0)
+                for metric in metrics:
+                    rolled[prefix][metric] = rolled[prefix][metric] + cost[metric]
+            for metric in metrics:
+                rolled[path][f"self_{metric}"] = cost[metric]
+        return dict(sorted(rolled.items()))
+
+    def to_folded(self, path: str, paths: list, metric: str="steps") -> None:
+        # folded stacks ("circuit;MAC_unit;mult8x8_from4x4 1234") of the costs directly created in every path
+        with open(path, "w") as f:
+            for call_path, cost in self.rollup(paths).items():
+                value = round(cost[f"self_{metric}"])
+                if value > 0:
+                    f.write(f"{call_path.replace('/', ';')} {value}\n")
+
+    def to_chrome_trace(self, path: str) -> None:
+        '''
+            writes a timeline in the Chrome trace event format (chrome://tracing, Perfetto)
+
+            phases are on thread 0, stages on thread 1, live memristors are a counter track
+        '''
+        events = [{"name": "thread_name", "ph": "M", "pid": 0, "tid": 0, "args": {"name": "phases"}},
+                  {"name": "thread_name", "ph": "M", "pid": 0, "tid": 1, "args": {"name": "stages"}}]
+        for name, start, duration in zip(self.phase_names, self.phase_start, self.phase_time):
+            events.append({"name": name, "ph": "X", "pid": 0, "tid": 0, "ts": start * 1e6, "dur": duration * 1e6})
+
+        columns = self.stage_columns()
+        for stage, (start, duration) in enumerate(zip(self.stage_start, self.stage_time)):
+            events.append({"name": f"stage {stage}", "ph": "X", "pid": 0, "tid": 1, "ts": start * 1e6, "dur": duration * 1e6,
+                           "args": {"lines": columns["lines"][stage], "gates": columns["gates"][stage], "nops": columns["nops"][stage]}})
+            events.append({"name": "memristors", "ph": "C", "pid": 0, "ts": (start + duration) * 1e6,
+                           "args": {"live": columns["live_memristors"][stage], "allocated": columns["memristors"][stage]}})
+
+        with open(path, "w") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms", "otherData": self.summary()}, f)
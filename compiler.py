@@ -1,298 +1,758 @@
-import json
 import os
+import heapq
+import shutil
+import tempfile
+import time
 
-circuit = json.load(open('config.json'))
+import numpy as np
+
+import netlist_io
+
+circuit = None # config of the circuit that is compiled, see netlist_io.read_config
 
 parallelism = 1 # number of gates that can maximally be executed in parallel
 
-registers_translation = {label:index for index, label in enumerate(circuit["input_registers"])}
-reservable_registers = {label:False for label in circuit["input_registers"]} # label of register : is register free to use
+banks = 1 # independent data lanes, every bank executes the same instructions on its own memristors (see bank_register)
 
-num_registers = len(registers_translation)
-num_free_registers = 0
+profile = None # instrumentation of the compilation, see compile_profile.CompileProfile
+
+# Imply instructions are held as integer records (op, operand1, operand2)
+OP_NOP = 0      # nop
+OP_FALSE = 1    # F<operand1>[,<operand2>]   resets one or two memristors to 0
+OP_IMPLY = 2    # I<operand1>,<operand2>     operand2 = operand1 -> operand2
+NO_REG = -1     # unused operand
+
+NOP_RECORD = (OP_NOP, NO_REG, NO_REG)
 
-imply_logic_strings_parallel = []
-AND_count = 0
-OR_count = 0
-NOT_count = 0
-XOR_count = 0
+# number of gates that are instantiated together in one batch
+CHUNK_SIZE = 4096
 
 # Helper functions to administer registers
+#
+# Memristors are administered by their index, values of the circuit by their signal id (see
+# netlist_io). Every memristor remembers the signal it currently stores and a rank that reflects
+# when that signal was assigned. Free registers are handed out lowest rank first.
+
+signal_register = []        # signal id : index of memristor storing it (NO_REG if not stored)
+register_signal = []        # index of memristor : signal id of stored value (NO_REG for work registers)
+register_rank = []          # index of memristor : rank used to order free registers
+register_free = []          # index of memristor : is register free to use
+free_heap = []              # (rank, index) of free registers
+next_rank = 0
+
+num_registers = 0
+num_free_registers = 0
 
-def allocate_registers(num_alloc):
-    global num_registers, num_free_registers, reservable_registers
-    # allocate new registers if needed
-    startRegisterLabel = len(registers_translation)-len(circuit["input_registers"])
-    for i in range(num_alloc):
-        new_register_label = f"w{startRegisterLabel+i}"
-        new_register_idx = num_registers
+gate_counts = []    # number of compiled gates per type code
+num_lines = 0       # number of imply lines compiled so far
+
+# "reuse" hands out freed registers again, "fresh" never frees a register so every value stays measurable
+ALLOCATORS = ("reuse", "fresh")
+allocator = "reuse"
 
-        registers_translation.update({new_register_label:new_register_idx})
-        reservable_registers.update({new_register_label:True})
+# registers reserved, newly allocated, freed and renamed, stale heap entries skipped while reserving
+allocator_stats = {"reserved": 0, "allocated": 0, "freed": 0, "renamed": 0, "stale": 0}
 
+def reset_registers(num_inputs):
+    global signal_register, register_signal, register_rank, register_free, free_heap, next_rank
+    global num_registers, num_free_registers
+    signal_register = list(range(num_inputs))
+    register_signal = list(range(num_inputs))
+    register_rank = list(range(num_inputs))
+    register_free = [False] * num_inputs
+    free_heap = []
+    next_rank = num_inputs
+
+    num_registers = num_inputs
+    num_free_registers = 0
+    allocator_stats.update(dict.fromkeys(allocator_stats, 0))
+
+def allocate_registers(num_alloc):
+    global num_registers, num_free_registers, next_rank
+    # allocate new registers if needed
+    allocator_stats["allocated"] = allocator_stats["allocated"] + num_alloc
+    for _ in range(num_alloc):
+        register_signal.append(NO_REG)
+        register_rank.append(next_rank)
+        register_free.append(True)
+        heapq.heappush(free_heap, (next_rank, num_registers))
+
+        next_rank = next_rank + 1
         num_registers = num_registers + 1
         num_free_registers = num_free_registers + 1
 
 def reserve_registers(num_req_registers):
-    global num_registers, num_free_registers, reservable_registers
+    global num_free_registers
     # check if enough free registers are available
     if num_req_registers > num_free_registers:
         allocate_registers(num_req_registers - num_free_registers)
 
     reserved_registers = []
-    for _ in range(num_req_registers):
-        # look for a free register
-        for register, status in reservable_registers.items():
-            if status == False:
-                continue
-            
-            reserved_registers.append(register)
-            reservable_registers[register] = False
-            num_free_registers = num_free_registers - 1
-            break
-
+    while len(reserved_registers) < num_req_registers:
+        rank, index = heapq.heappop(free_heap)
+        # skip entries that became stale because the register was renamed meanwhile
+        if not register_free[index] or rank != register_rank[index]:
+            allocator_stats["stale"] = allocator_stats["stale"] + 1
+            continue
+        register_free[index] = False
+        reserved_registers.append(index)
+
+    num_free_registers = num_free_registers - num_req_registers
+    allocator_stats["reserved"] = allocator_stats["reserved"] + num_req_registers
     return reserved_registers
 
 def free_registers(registers):
-    global reservable_registers, num_free_registers
-    for register in registers:
-        reservable_registers[register] = True
+    global num_free_registers
+    if allocator == "fresh":
+        return
+    for index in registers:
+        if register_free[index]:
+            continue
+        register_free[index] = True
+        heapq.heappush(free_heap, (register_rank[index], index))
         num_free_registers = num_free_registers + 1
+        allocator_stats["freed"] = allocator_stats["freed"] + 1
 
-def rename_register(old, new):
-    global registers_translation, reservable_registers
+def free_signals(signals):
+    # signals whose register was renamed by an OUT gate are no longer stored and stay reserved
+    free_registers([signal_register[signal] for signal in signals if signal_register[signal] != NO_REG])
 
-    tmp = registers_translation[old]
-    del registers_translation[old]
-    registers_translation.update({new:tmp})
+def rename_register(index, signal):
+    global next_rank
+    old = register_signal[index]
+    if old != NO_REG and signal_register[old] == index:
+        signal_register[old] = NO_REG
+    if signal >= len(signal_register):
+        signal_register.extend([NO_REG] * (signal + 1 - len(signal_register)))
+    signal_register[signal] = index
+    register_signal[index] = signal
 
-    tmp = reservable_registers[old]
-    del reservable_registers[old]
-    reservable_registers.update({new:tmp})
+    register_rank[index] = next_rank
+    next_rank = next_rank + 1
+    allocator_stats["renamed"] = allocator_stats["renamed"] + 1
+    if register_free[index]:
+        heapq.heappush(free_heap, (register_rank[index], index))
 
 
 
 # Defining Imply logic for Gates
-
-def OR(inputs):
+#
+# Every gate is a template of imply instructions. Operands of a template are slot indices:
+# the input registers come first, followed by the work registers of the gate. NO_REG marks
+# an unused operand. See about/Templates.txt for the derivation of the algorithms.
+
+class GateTemplate():
+    def __init__(self, label: str, num_inputs: int, num_work: int, code: list, result: int, to_be_freed: list):
+        self.label = label
+        self.num_inputs = num_inputs
+        self.num_work = num_work
+        self.code = np.array(code, dtype=np.int32).reshape(-1, 3)
+        self.result = result                    # slot in which the result is saved
+        self.to_be_freed = to_be_freed          # slots that can be freed after the stage
+        self.length = len(self.code)
+
+    def instantiate(self, slots: np.ndarray) -> np.ndarray:
+        '''
+            substitutes the slots of this template by memristor indices
+
+            expects:
+                slots: array of shape (gates, num_inputs + num_work + 1), last column has to be NO_REG
+
+            returns:
+                array of shape (gates, length, 3) holding the imply instructions of every gate
+        '''
+        instructions = np.empty((len(slots), self.length, 3), dtype=np.int32)
+        instructions[:, :, 0] = self.code[:, 0]
+        instructions[:, :, 1:] = slots[:, self.code[:, 1:]]
+        return instructions
+
+F = OP_FALSE
+I = OP_IMPLY
+_ = NO_REG
+
+# a OR b (2 work regs): (b -> 0) -> a
+OR_TEMPLATE = GateTemplate("OR", 2, 2, [
+    (F, 2, 3),
+    (I, 0, 2),
+    (I, 2, 3),
+    (F, 2, _),
+    (I, 1, 2),
+    (I, 2, 3),
+], result=3, to_be_freed=[2])
+
+# a AND b (2 work regs): (b -> (a -> 0)) -> 0
+AND_TEMPLATE = GateTemplate("AND", 2, 2, [
+    (F, 2, 3),
+    (I, 0, 2),
+    (I, 1, 2),
+    (I, 2, 3),
+], result=3, to_be_freed=[2])
+
+# a XOR b (3 work regs): [(OR(a,b) -> AND(a,b))] -> 0
+XOR_TEMPLATE = GateTemplate("XOR", 2, 3, [
+    (F, 2, 3),
+    (F, 2, 3),
+    (I, 0, 2),
+    (I, 1, 2),
+    (I, 2, 3),
+    (F, 2, 4),
+    (I, 0, 2),
+    (I, 2, 4),
+    (F, 2, _),
+    (I, 1, 2),
+    (I, 2, 4),
+    (I, 4, 3),
+    (F, 2, _),
+    (I, 3, 2),
+], result=2, to_be_freed=[3, 4])
+
+# NOT a (1 work reg): a -> 0
+NOT_TEMPLATE = GateTemplate("NOT", 1, 1, [
+    (F, 1, _),
+    (I, 0, 1),
+], result=1, to_be_freed=[])
+
+# OUT only renames its input register
+OUT_TEMPLATE = GateTemplate("OUT", 1, 0, [], result=0, to_be_freed=[])
+
+del F, I, _
+
+# Gate templates ordered by the type codes of netlist_io, instances of modules are compiled from fragments
+gate_templates = [OR_TEMPLATE, AND_TEMPLATE, XOR_TEMPLATE, NOT_TEMPLATE, OUT_TEMPLATE]
+gate_mapping = netlist_io.GATE_CODES
+INST_CODE = netlist_io.INST_CODE
+assert [template.label for template in gate_templates] == netlist_io.GATE_TYPES[:INST_CODE]
+
+
+# Modules
+#
+# The body of a module is compiled once into a fragment: imply lines whose operands are memristors
+# local to the module. Its inputs are the local memristors 0 .. num_inputs-1 and are only read. An
+# instance links the fragment into the program by relocating the local memristors: inputs to the
+# memristors of the signals passed in, all others to reserved registers. Work registers of the
+# fragment are freed after the stage of the instance, its outputs are renamed to the output signals.
+
+class Fragment():
+    def __init__(self, instructions: np.ndarray, gates: np.ndarray, num_registers: int, num_inputs: int, outputs: list):
+        self.instructions = instructions        # (lines, parallelism, 3) with local memristors as operands
+        self.gates = gates                      # gate records of the body, see emit_chunk
+        self.num_registers = num_registers
+        self.num_inputs = num_inputs
+        self.outputs = outputs                  # local memristor of every output
+        self.work = [index for index in range(num_inputs, num_registers) if index not in outputs]
+        self.num_lines = len(instructions)
+        self.gate_counts = np.bincount(gates[:, 3], minlength=len(netlist_io.GATE_TYPES)).tolist()
+        self.steps = np.bincount(gates[:, 3], weights=gates[:, 2], minlength=len(netlist_io.GATE_TYPES)).astype(np.int64).tolist()
+        self.num_steps = sum(self.steps)
+        self.gate_costs = None                  # (imply steps, lines, type codes) of the body gates in compile order, see compile_profile
+
+def compile_fragment(module):
     '''
-        creates imply logic for implementing a OR gate
+        compiles the body of a module into a fragment, modules instantiated by it are compiled before
 
         expects:
-            inputs: labels of both input registers
+            module: Netlist of the body, OUT gates mark its outputs
 
         returns:
-            result: label of register in which result is saved
-            imply_logic_strings: resulting imply logic in format usable by the ATOMIC tool
+            Fragment, cached on the module for the current parallelism and allocator
     '''
-    global OR_count
-    OR_count = OR_count + 1
-    inp1, inp2 = inputs
-    imply_logic_strings = []
-    work1, work2 = reserve_registers(2)
-    imply_logic_strings.append(f"F{registers_translation[work1]},{registers_translation[work2]}    # OR{OR_count}")
-    imply_logic_strings.append(f"I{registers_translation[inp1]},{registers_translation[work1]}")
-    imply_logic_strings.append(f"I{registers_translation[work1]},{registers_translation[work2]}")
-    imply_logic_strings.append(f"F{registers_translation[work1]}")
-    imply_logic_strings.append(f"I{registers_translation[inp2]},{registers_translation[work1]}")
-    imply_logic_strings.append(f"I{registers_translation[work1]},{registers_translation[work2]}    # ENDE OR{OR_count}")
-    result = work2
-    to_be_freed = [work1]
-
-    return result, imply_logic_strings, to_be_freed
-
-
-def AND(inputs):
-    '''
-        creates imply logic for implementing a AND gate
+    global circuit, profile
+    key = (parallelism, allocator)
+    # while profiling, the costs of the body gates are needed to attribute them to their call paths
+    if key in module.fragments and (profile is None or module.fragments[key].gate_costs is not None):
+        return module.fragments[key]
+    for name in module.module_names:
+        compile_fragment(module.modules[name])
+
+    # stages of module bodies are not part of the profile of the circuit, they get a profile of their own
+    circuit, attached = module, profile
+    profile = None if attached is None else type(attached)()
+    try:
+        reset_compiler(module.num_inputs)
+        instructions, gates = concatenate_chunks(list(compile_stages(module.stages())))
+        body_profile = profile
+    finally:
+        profile = attached
+    outputs = [signal_register[signal] for signal in module.output_signals()]
+    if len(set(outputs)) != len(outputs) or min(outputs, default=module.num_inputs) < module.num_inputs:
+        raise Exception(f"ERROR: Outputs of a module have to be distinct values computed by its gates!")
+
+    fragment = Fragment(instructions, gates, num_registers, module.num_inputs, outputs)
+    if body_profile is not None:
+        # OUT gates of the body only rename inside the module, like in the linked gate records
+        kept = [index for index, code in enumerate(body_profile.gate_codes) if code != netlist_io.OUT_CODE]
+        fragment.gate_costs = ([body_profile.gate_steps[index] for index in kept], [body_profile.gate_lines[index] for index in kept],
+                               [body_profile.gate_codes[index] for index in kept])
+    module.fragments[key] = fragment
+    return fragment
+
+def compile_modules(modules: dict):
+    # fragments have to exist before a circuit instantiating them is compiled
+    for module in modules.values():
+        compile_fragment(module)
 
-        expects:
-            inputs: labels of both input registers
 
-        returns:
-            result: label of register in which result is saved
-            imply_logic_strings: resulting imply logic in format usable by the ATOMIC tool
-    '''
-    global AND_count
-    AND_count = AND_count + 1
-    inp1, inp2 = inputs
-    imply_logic_strings = []
-    work1, work2 = reserve_registers(2)
-    imply_logic_strings.append(f"F{registers_translation[work1]},{registers_translation[work2]}    # AND{AND_count}")
-    imply_logic_strings.append(f"I{registers_translation[inp1]},{registers_translation[work1]}")
-    imply_logic_strings.append(f"I{registers_translation[inp2]},{registers_translation[work1]}")
-    imply_logic_strings.append(f"I{registers_translation[work1]},{registers_translation[work2]}    # ENDE AND{AND_count}")
-    result = work2
-    to_be_freed = [work1]
-
-    return result, imply_logic_strings, to_be_freed
-
-def XOR(inputs):
-    global XOR_count
-    XOR_count = XOR_count + 1
-    inp1, inp2 = inputs
-    imply_logic_strings = []
-    work1, work2, work3 = reserve_registers(3)
-
-    imply_logic_strings.append(f"F{registers_translation[work1]},{registers_translation[work2]}    # XOR{XOR_count}")
-    imply_logic_strings.append(f"F{registers_translation[work1]},{registers_translation[work2]}")
-    imply_logic_strings.append(f"I{registers_translation[inp1]},{registers_translation[work1]}")
-    imply_logic_strings.append(f"I{registers_translation[inp2]},{registers_translation[work1]}")
-    imply_logic_strings.append(f"I{registers_translation[work1]},{registers_translation[work2]}")
-    imply_logic_strings.append(f"F{registers_translation[work1]},{registers_translation[work3]}")
-    imply_logic_strings.append(f"I{registers_translation[inp1]},{registers_translation[work1]}")
-    imply_logic_strings.append(f"I{registers_translation[work1]},{registers_translation[work3]}")
-    imply_logic_strings.append(f"F{registers_translation[work1]}")
-    imply_logic_strings.append(f"I{registers_translation[inp2]},{registers_translation[work1]}")
-    imply_logic_strings.append(f"I{registers_translation[work1]},{registers_translation[work3]}")
-    imply_logic_strings.append(f"I{registers_translation[work3]},{registers_translation[work2]}")
-    imply_logic_strings.append(f"F{registers_translation[work1]}")
-    imply_logic_strings.append(f"I{registers_translation[work2]},{registers_translation[work1]}     # ENDE XOR{XOR_count}")
-
-    result = work1
-    to_be_freed = [work2, work3]
-    return result, imply_logic_strings, to_be_freed
-
-def NOT(input):
+# Functions important for circuit flow
+
+def process_stage(gates, free_after_stage):
     '''
-        creates imply logic for implementing a NOT gate
+        assigns registers to all gates of a stage and lays them out in parallel chunks
 
         expects:
-            inputs: label of input register
+            gates: list of (type code, input signal ids, output signal id), instances as (INST_CODE, input ids, output ids, module)
+            free_after_stage: signal ids whose registers can be freed after this stage
 
         returns:
-            result: label of register in which result is saved
-            imply_logic_strings: resulting imply logic in format usable by the ATOMIC tool
+            num_lines: number of imply lines this stage takes
+            placements: list of (type code, slots, first line inside of stage, lane) for every gate,
+                        instances take all lanes and have (relocation, fragment) as slots
     '''
-    global NOT_count
-    NOT_count = NOT_count + 1
-    inp = input[0]
-    imply_logic_strings = []
-    work = reserve_registers(1)[0]
-    # print(f"work: {work}")
-    imply_logic_strings.append(f"F{registers_translation[work]}    # NOT{NOT_count}")
-    imply_logic_strings.append(f"I{registers_translation[inp]},{registers_translation[work]}    # ENDE NOT{NOT_count}")
-    result = work
+    placements = []
+    instances = []
     to_be_freed = []
-    return result, imply_logic_strings, to_be_freed
-
-def OUT(input):
-    return input[0], [], []
-    
-# Maps gate labels to Gate functions
-gate_mapping = {"OR": OR, "AND": AND, "NOT": NOT, "XOR": XOR, "OUT": OUT}
-
-
-# Functions important for circuit flow
-
-def pad_list(lst, length):
-    while len(lst) < length:
-        lst.append("nop")
-    return lst
-
-def combine_logic_chunks(chunk):
-    '''
-        combines operations that can be run in parallel
-    '''
-
-    while len(chunk) < parallelism:
-        chunk.append([])
-
-    # if only one gate is present - only unpack and return
-    if len(chunk) == 1:
-        # print("only one gate present")
-        return chunk[0]
-
-    output = []
-
-    # pad gatelogics to length of largest (first) gate
-    length = len(chunk[0])
-    for i in range(len(chunk[1:])):
-        chunk[i+1] = pad_list(chunk[i+1], length)
 
-    for parallel_logics in zip(*chunk):
-        output.append(" | ".join(parallel_logics))
+    # process gates in current stage
+    for gate in gates:
+        code, inputs, output = gate[0], gate[1], gate[2]
+        allocated = allocator_stats["allocated"]
+        if code == INST_CODE:
+            fragment = circuit.modules[gate[3]].fragments[(parallelism, allocator)]
+            relocation = [signal_register[signal] for signal in inputs]
+            relocation.extend(reserve_registers(fragment.num_registers - fragment.num_inputs))
+            for signal, index in zip(output, fragment.outputs):
+                rename_register(relocation[index], signal)
+            to_be_freed.extend(relocation[index] for index in fragment.work)
+            relocation.append(NO_REG)
+            instances.append((code, (np.array(relocation, dtype=np.int32), fragment)))
+        else:
+            template = gate_templates[code]
+
+            slots = [signal_register[signal] for signal in inputs]
+            slots.extend(reserve_registers(template.num_work))
+            slots.append(NO_REG)
+
+            placements.append((code, slots))
+            to_be_freed.extend(slots[slot] for slot in template.to_be_freed)
+            rename_register(slots[template.result], output)
+
+        if profile is not None:
+            profile.gate_memristors.append(allocator_stats["allocated"] - allocated)
 
-    return output
+    free_registers(to_be_freed)
 
+    # longest gates first, chunks of gates are processed in parallel
+    placements.sort(key=lambda placement: gate_templates[placement[0]].length, reverse=True)
 
+    num_lines = 0
+    for i, (code, slots) in enumerate(placements):
+        lane = i % parallelism
+        if lane == 0:
+            line = num_lines
+            num_lines = num_lines + gate_templates[code].length
+        placements[i] = (code, slots, line, lane)
 
-def process_stage(stage):
-    current_stage = circuit["stages"][stage]
-    generated_imply_logics = []
-    maxSteps = 0
+    # fragments of instances follow the gates of the stage
+    for code, slots in instances:
+        placements.append((code, slots, num_lines, 0))
+        num_lines = num_lines + slots[1].num_lines
 
-    to_be_freed = []
+    free_signals(free_after_stage)
 
-    # process gates in current stage
-    for gate in current_stage["gates"]:
-        func = gate_mapping[gate["type"]]
-        outputName = gate['name']
-        inputs = gate["inputs"]
-
-        out, imply_logic, free_regs = func(inputs)
-        generated_imply_logics.append(imply_logic)
-        to_be_freed.extend(free_regs)
-        if len(imply_logic) > maxSteps:
-            maxSteps = len(imply_logic)
-
-        rename_register(out, outputName)
-    
-    free_registers(to_be_freed)
+    return num_lines, placements
 
-    generated_imply_logics = sorted(generated_imply_logics, key=lambda x: len(x), reverse=True)
-    
-
-    # combine into chunks that will be processed in parallel
-    generated_imply_logics = [generated_imply_logics[i: i+parallelism] for i in range(0, len(generated_imply_logics), parallelism)]
-    # combine chunks into parallelized imply logic statements
-    imply_logic = []
-    for chunk in generated_imply_logics:
-        imply_logic.extend(combine_logic_chunks(chunk))
-
-    free_registers(current_stage['free_registers_after_stage'])
-    
-    return imply_logic
+def emit_chunk(num_lines, placements):
+    '''
+        instantiates the templates of a batch of placed gates
 
+        expects:
+            num_lines: number of imply lines covered by the batch
+            placements: list of (type code, slots, first line, lane) with lines relative to the batch
 
-# function to compile the circuit defined in configPath, outputs imply logic into outfile
-# returns amount of memristors used for this circuit
-def compile_circuit(configPath:str="config.json", outfile:str="out/atomic_config.txt"):
-    global registers_translation, reservable_registers, num_registers, num_free_registers, imply_logic_strings_parallel, logic_result
-    global AND_count, OR_count, NOT_count, XOR_count
-    circuit = json.load(open(configPath))
-    parallelism = 1 # number of gates that can maximally be executed in parallel (compiler support works iff config.json is correctly parallelized!)
+        returns:
+            instructions: array of shape (num_lines, parallelism, 3)
+            gates: array of shape (gates, 5) holding (first line, lane, length, type code, count) of every gate,
+                   sorted by first line. Instances have length 0 and are followed by the gates of their fragment
+    '''
+    instructions = np.empty((num_lines, parallelism, 3), dtype=np.int32)
+    instructions[:] = NOP_RECORD
+    gates = np.empty((len(placements), 5), dtype=np.int64)
+    first_counts = list(gate_counts)
+
+    codes = np.array([placement[0] for placement in placements], dtype=np.int64)
+    gates[:, 0] = [placement[2] for placement in placements]
+    gates[:, 1] = [placement[3] for placement in placements]
+    gates[:, 3] = codes
+
+    for code, template in enumerate(gate_templates):
+        selected = np.flatnonzero(codes == code)
+        if len(selected) == 0:
+            continue
+        gates[selected, 2] = template.length
+        gates[selected, 4] = np.arange(gate_counts[code], gate_counts[code] + len(selected))
+        gate_counts[code] = gate_counts[code] + len(selected)
+        if template.length == 0:
+            continue
+
+        slots = np.array([placements[i][1] for i in selected], dtype=np.int32)
+        lines = gates[selected, 0][:, None] + np.arange(template.length)
+        lanes = gates[selected, 1][:, None]
+        instructions[lines, lanes] = template.instantiate(slots)
+
+    selected = np.flatnonzero(codes == INST_CODE)
+    if len(selected) == 0:
+        return instructions, gates
+
+    gates[selected, 2] = 0
+    records = [gates]
+    for i in selected.tolist():
+        (relocation, fragment), line = placements[i][1], placements[i][2]
+        lines = slice(line, line + fragment.num_lines)
+        instructions[lines, :, 0] = fragment.instructions[:, :, 0]
+        instructions[lines, :, 1:] = relocation[fragment.instructions[:, :, 1:]]
+
+        # OUT gates of the body only rename inside the module, they are not gates of the circuit
+        body = fragment.gates[fragment.gates[:, 3] != netlist_io.OUT_CODE]
+        body[:, 0] = body[:, 0] + line
+        records.append(body)
+
+    # gates are numbered in order of their lines, so the numbers do not depend on the chunk size
+    gates = np.concatenate(records)
+    gates = gates[np.argsort(gates[:, 0], kind="stable")]
+    for code in range(len(gate_counts)):
+        selected = np.flatnonzero(gates[:, 3] == code)
+        gates[selected, 4] = np.arange(first_counts[code], first_counts[code] + len(selected))
+        gate_counts[code] = first_counts[code] + len(selected)
+    return instructions, gates
+
+def concatenate_chunks(chunks):
+    # combines chunks of compile_stages into one, shifting gate lines behind each other
+    offset = 0
+    for instructions, gates in chunks:
+        gates[:, 0] = gates[:, 0] + offset
+        offset = offset + len(instructions)
+    if len(chunks) == 0:
+        return np.empty((0, parallelism, 3), dtype=np.int32), np.empty((0, 5), dtype=np.int64)
+    return np.concatenate([chunk[0] for chunk in chunks]), np.concatenate([chunk[1] for chunk in chunks])
+
+def render_instruction(op, operand1, operand2):
+    if op == OP_IMPLY:
+        return f"I{operand1},{operand2}"
+    if op == OP_FALSE:
+        if operand2 == NO_REG:
+            return f"F{operand1}"
+        return f"F{operand1},{operand2}"
+    return "nop"
+
+def expand_banks(instructions, gates, num_banks, stride):
+    '''
+        replicates the instructions of one bank for num_banks independent data lanes, bank b executes every
+        instruction on its own memristors (offset by b * stride) in the lanes behind those of bank b - 1
 
-    registers_translation = {label:index for index, label in enumerate(circuit["input_registers"])}
-    reservable_registers = {label:False for label in circuit["input_registers"]} # label of register : is register free to use
+        returns:
+            instructions: array of shape (lines, num_banks * parallelism, 3)
+            gates: gate records of every bank, see emit_chunk
+    '''
+    lanes = instructions.shape[1]
+    expanded = np.tile(instructions, (1, num_banks, 1))
+    offsets = np.repeat(np.arange(num_banks, dtype=np.int32) * stride, lanes)[None, :]
+    for operand in (1, 2):
+        expanded[:, :, operand] = np.where(expanded[:, :, operand] != NO_REG, expanded[:, :, operand] + offsets, NO_REG)
+    bank_gates = np.tile(gates, (num_banks, 1))
+    bank_gates[:, 1] = bank_gates[:, 1] + np.repeat(np.arange(num_banks) * lanes, len(gates))
+    return expanded, bank_gates
+
+def bank_register(index: int, bank: int) -> int:
+    # memristor of bank that holds what memristor index holds in bank 0, valid after compilation
+    return index + bank * num_registers
+
+def render_lines(instructions, gates):
+    '''
+        renders imply instructions into the text format of the ATOMIC tool
 
-    num_registers = len(registers_translation)
-    num_free_registers = 0
+        expects:
+            instructions: array of shape (lines, parallelism, 3)
+            gates: array of shape (gates, 5) as returned by emit_chunk, used to annotate gate boundaries
 
-    imply_logic_strings_parallel = []
+        returns:
+            generator of imply logic strings, one per line
+    '''
+    comments = {}
+    for line, lane, length, code, count in gates.tolist():
+        if length == 0:
+            continue
+        name = f"{gate_templates[code].label}{count}"
+        comments[(line, lane)] = f"    # {name}"
+        comments[(line + length - 1, lane)] = f"    # ENDE {name}"
+
+    for line, records in enumerate(instructions.tolist()):
+        yield " | ".join(render_instruction(*record) + comments.get((line, lane), "") for lane, record in enumerate(records))
+
+
+# Writers for compiled imply programs
+#
+# Programs are written chunk by chunk while they are compiled, so the whole program never has to
+# be held in memory. Besides the text format of the ATOMIC tool a compact binary format is
+# supported that can be memory mapped by downstream tools (see load_program):
+#
+#   header        PROGRAM_HEADER (64 bytes)
+#   instructions  num_lines x parallelism records of two uint32 words:
+#                 (op << 28 | operand1 + 1, operand2 + 1), an all zero record is a nop
+#   gates         num_gates int32 records (first line, lane, length, type code, count)
+#
+# Programs for several banks (see banks) hold the instructions once, num_registers is the number of
+# memristors of one bank and bank b executes them on memristors offset by b * num_registers. Programs
+# written before banks were introduced have 0 banks, which means one.
+
+PROGRAM_MAGIC = b"IMPLYPRG"
+PROGRAM_VERSION = 1
+PROGRAM_HEADER = np.dtype([("magic", "S8"), ("version", "<u4"), ("parallelism", "<u4"),
+                           ("num_lines", "<u8"), ("num_gates", "<u8"), ("num_registers", "<u8"),
+                           ("banks", "<u8"), ("reserved", "<u8", 2)])
+WORD_DTYPE = np.dtype("<u4")
+GATE_RECORD_DTYPE = np.dtype("<i4")
+OP_SHIFT = 28
+OPERAND_MASK = (1 << OP_SHIFT) - 1
+
+def encode_instructions(instructions: np.ndarray) -> np.ndarray:
+    '''
+        packs instruction records (op, operand1, operand2) into pairs of uint32 words
+    '''
+    words = np.empty(instructions.shape[:-1] + (2,), dtype=WORD_DTYPE)
+    words[..., 0] = (instructions[..., 0].astype(np.uint32) << OP_SHIFT) | (instructions[..., 1] + 1).astype(np.uint32)
+    words[..., 1] = instructions[..., 2] + 1
+    return words
 
-    logic_result = []
-    AND_count = -1
-    OR_count = -1
-    NOT_count = -1
-    XOR_count = -1
+def decode_instructions(words: np.ndarray) -> np.ndarray:
+    '''
+        unpacks pairs of uint32 words into instruction records (op, operand1, operand2)
+    '''
+    instructions = np.empty(words.shape[:-1] + (3,), dtype=np.int32)
+    instructions[..., 0] = words[..., 0] >> OP_SHIFT
+    instructions[..., 1] = (words[..., 0] & OPERAND_MASK).astype(np.int32) - 1
+    instructions[..., 2] = words[..., 1].astype(np.int32) - 1
+    return instructions
+
+class TextProgramWriter():
+    def __init__(self, path: str):
+        self.file = open(path, "w")
+        self.num_lines = 0
+
+    def write(self, instructions: np.ndarray, gates: np.ndarray) -> None:
+        for line in render_lines(instructions, gates):
+            if self.num_lines > 0:
+                self.file.write("\n")
+            self.file.write(line)
+            self.num_lines = self.num_lines + 1
+
+    def close(self, num_registers: int) -> None:
+        self.file.close()
+
+class BinaryProgramWriter():
+    def __init__(self, path: str, parallelism: int, banks: int=1):
+        self.file = open(path, "wb")
+        self.gate_file = tempfile.TemporaryFile()   # gate records are appended behind the instructions on close
+        self.parallelism = parallelism
+        self.banks = banks
+        self.num_lines = 0
+        self.num_gates = 0
+        self.file.write(bytes(PROGRAM_HEADER.itemsize))
+
+    def write(self, instructions: np.ndarray, gates: np.ndarray) -> None:
+        gates = gates.copy()
+        gates[:, 0] = gates[:, 0] + self.num_lines
+        self.file.write(encode_instructions(instructions).tobytes())
+        self.gate_file.write(gates.astype(GATE_RECORD_DTYPE, copy=False).tobytes())
+        self.num_lines = self.num_lines + len(instructions)
+        self.num_gates = self.num_gates + len(gates)
+
+    def close(self, num_registers: int) -> None:
+        self.gate_file.seek(0)
+        shutil.copyfileobj(self.gate_file, self.file)
+        self.gate_file.close()
+
+        header = np.zeros(1, dtype=PROGRAM_HEADER)
+        header["magic"] = PROGRAM_MAGIC
+        header["version"] = PROGRAM_VERSION
+        header["parallelism"] = self.parallelism
+        header["num_lines"] = self.num_lines
+        header["num_gates"] = self.num_gates
+        header["num_registers"] = num_registers
+        header["banks"] = self.banks
+        self.file.seek(0)
+        self.file.write(header.tobytes())
+        self.file.close()
+
+class BankedTextProgramWriter():
+    # the memristors of a bank are offset by the number of memristors of one bank, which is only known after
+    # the last chunk, so the program is written in the binary format first and rendered on close
+    def __init__(self, path: str, parallelism: int, banks: int):
+        self.path = path
+        self.binaryPath = path + ".bin.tmp"
+        self.writer = BinaryProgramWriter(self.binaryPath, parallelism, banks)
+
+    def write(self, instructions: np.ndarray, gates: np.ndarray) -> None:
+        self.writer.write(instructions, gates)
+
+    def close(self, num_registers: int) -> None:
+        self.writer.close(num_registers)
+        render_program(self.binaryPath, self.path)
+        os.remove(self.binaryPath)
+
+def open_program_writer(outfile: str, outputFormat: str):
+    if outputFormat == "text" and banks > 1:
+        return BankedTextProgramWriter(outfile, parallelism, banks)
+    if outputFormat == "text":
+        return TextProgramWriter(outfile)
+    if outputFormat == "binary":
+        return BinaryProgramWriter(outfile, parallelism, banks)
+    raise Exception(f"ERROR: Unknown output format {outputFormat}, expected 'text' or 'binary'!")
+
+def load_program(programPath: str):
+    '''
+        loads a program written in the binary format without parsing it
 
+        expects:
+            programPath: path of binary program
 
-    for stage in range(len(circuit["stages"])):
-        logic_result.extend(process_stage(stage))
+        returns:
+            header: record with parallelism, num_lines, num_gates, num_registers (per bank) and banks of the program
+            words: memory mapped array of shape (num_lines, parallelism, 2), see decode_instructions
+            gates: memory mapped array of shape (num_gates, 5)
+    '''
+    header = np.fromfile(programPath, dtype=PROGRAM_HEADER, count=1)
+    if len(header) == 0 or header[0]["magic"] != PROGRAM_MAGIC:
+        raise Exception(f"ERROR: {programPath} is not a binary imply program!")
+    header = header[0]
+    if header["version"] != PROGRAM_VERSION:
+        raise Exception(f"ERROR: Unsupported program version {header['version']}!")
+
+    shape = (int(header["num_lines"]), int(header["parallelism"]), 2)
+    offset = PROGRAM_HEADER.itemsize
+    if shape[0] > 0:
+        words = np.memmap(programPath, dtype=WORD_DTYPE, mode="r", offset=offset, shape=shape)
+    else:
+        words = np.empty(shape, dtype=WORD_DTYPE)
+
+    offset = offset + shape[0] * shape[1] * shape[2] * WORD_DTYPE.itemsize
+    num_gates = int(header["num_gates"])
+    if num_gates > 0:
+        gates = np.memmap(programPath, dtype=GATE_RECORD_DTYPE, mode="r", offset=offset, shape=(num_gates, 5))
+    else:
+        gates = np.empty((0, 5), dtype=GATE_RECORD_DTYPE)
+
+    return header, words, gates
+
+def render_program(programPath: str, outfile: str, chunk_lines: int=65536, num_banks: int=None) -> None:
+    '''
+        renders a binary program into the text format of the ATOMIC tool, chunk by chunk, with every bank
+        in lanes of its own (num_banks overrides the banks of the program)
+    '''
+    header, words, gates = load_program(programPath)
+    num_banks = max(int(header["banks"]), 1) if num_banks is None else num_banks
+    max_length = max(template.length for template in gate_templates)
+    writer = TextProgramWriter(outfile)
+    for start in range(0, len(words), chunk_lines):
+        stop = min(start + chunk_lines, len(words))
+        # gates are stored in order of their first line, only gates overlapping the chunk are needed
+        first, last = np.searchsorted(gates[:, 0], [start - max_length, stop])
+        chunk_gates = np.array(gates[first:last])
+        chunk_gates[:, 0] = chunk_gates[:, 0] - start
+        instructions = decode_instructions(words[start:stop])
+        if num_banks > 1:
+            instructions, chunk_gates = expand_banks(instructions, chunk_gates, num_banks, int(header["num_registers"]))
+        writer.write(instructions, chunk_gates)
+    writer.close(0)
+
+
+# function to compile the circuit defined in configPath (.json, .jsonl or .npz, see netlist_io), outputs imply logic into outfile
+# outputFormat is either "text" (ATOMIC imply logic) or "binary" (see load_program), nothing is written if outfile is None
+# returns amount of memristors used for this circuit, in all banks
+def compile_circuit(configPath:str="config.json", outfile:str="out/atomic_config.txt", outputFormat:str="text"):
+    # stages are read lazily, one stage at a time
+    return compile_netlist(timed("load", netlist_io.read_config, configPath, parallelism), outfile=outfile, outputFormat=outputFormat)
+
+# function to compile a circuit that is already in memory, e.g. gates.CircuitConfig().toNetlist()
+# no config file is written or parsed, registers are tracked by the integer signal ids of the netlist
+# modules are compiled into fragments first, every instance links its fragment into the program
+def compile_netlist(netlist, outfile:str="out/atomic_config.txt", outputFormat:str="text"):
+    global circuit
+    timed("modules", compile_modules, netlist.modules)
+    circuit = netlist
+    reset_compiler(len(circuit.input_registers()))
+
+    writer = None
+    if outfile is not None:
+        writer = open_program_writer(outfile, outputFormat)
+
+    for instructions, gates in compile_stages(circuit.stages(), emit=writer is not None):
+        timed("write", writer.write, instructions, gates)
+
+    if writer is not None:
+        timed("write", writer.close, num_registers)
+    if profile is not None:
+        profile.finish()
+
+    print(f"Number of Memristors: {num_registers * banks}")
+    return num_registers * banks
+
+def reset_compiler(num_inputs):
+    global gate_counts, num_lines
+    if allocator not in ALLOCATORS:
+        raise Exception(f"ERROR: Unknown allocator {allocator}, expected one of {ALLOCATORS}!")
+    reset_registers(num_inputs)
+    gate_counts = [0] * len(netlist_io.GATE_TYPES)
+    num_lines = 0
+
+def compile_stages(stages, emit:bool=True):
+    '''
+        compiles stages starting from the current register state
 
+        expects:
+            stages: iterable of (gates, free_after_stage) as generated by netlist_io
+            emit: if False registers are assigned but no instructions are generated
 
-    try:
-        with open(outfile, 'x') as f:
-            f.write('\n'.join(logic_result))
-    except Exception:
-        with open(outfile, "w") as f:
-            f.write('\n'.join(logic_result))
-
-    print(f"Number of Memristors: {len(reservable_registers)}")
-    return len(reservable_registers)
-    
-def getOutputIndices(output_labels:list[str]):
-    # outputs ids 
-    output_ids = {f"OUT {index}" : registers_translation[label] for index, label in enumerate(output_labels)}
-    return output_ids
\ No newline at end of file
+        returns:
+            generator of chunks (instructions, gates) as returned by emit_chunk, lines are relative to the chunk
+    '''
+    global num_lines
+    # stages are compiled into chunks of gates that are handed out as soon as they are complete
+    pending = []
+    pending_lines = 0
+    if profile is not None:
+        stages = profile.stages(stages)
+    for gates, free_after_stage in stages:
+        if profile is None:
+            stage_lines, placements = process_stage(gates, free_after_stage)
+        else:
+            start = time.perf_counter()
+            stage_lines, placements = process_stage(gates, free_after_stage)
+            profile.add_stage(start, time.perf_counter(), num_lines, stage_lines, gates, placements)
+        for code, slots, line, lane in placements:
+            pending.append((code, slots, pending_lines + line, lane))
+        pending_lines = pending_lines + stage_lines
+        num_lines = num_lines + stage_lines
+
+        if len(pending) >= CHUNK_SIZE:
+            if emit:
+                yield timed("emit", emit_chunk, pending_lines, pending)
+            pending = []
+            pending_lines = 0
+    if emit and (len(pending) > 0 or pending_lines > 0):
+        yield timed("emit", emit_chunk, pending_lines, pending)
+
+def timed(phase, function, *args):
+    # calls function, its wall time is added to the profile as phase
+    if profile is None:
+        return function(*args)
+    start = time.perf_counter()
+    result = function(*args)
+    profile.add_phase(phase, start, time.perf_counter())
+    return result
+
+def getOutputIndices(output_labels:list[str], bank:int=None):
+    # outputs ids, outputs of netlists built in memory can also be given as Register objects
+    # with several banks the ids of every bank are returned as a list, or the ids of one bank if given
+    if bank is None and banks > 1:
+        return [getOutputIndices(output_labels, bank) for bank in range(banks)]
+    output_ids = {f"OUT {index}" : bank_register(signal_register[circuit.signal_id(label)], bank or 0) for index, label in enumerate(output_labels)}
+    return output_ids
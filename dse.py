@@ -0,0 +1,265 @@
+#!/usr/bin/env python3
+"""
+Design space exploration of the MAC unit
+
+    python dse.py --out dse.json
+    python dse.py --adders ripple kogge_stone sklansky --parallelism 3 --metric mred
+
+Every configuration of MAC_unit (multiplier of every 4x4 partial product, approximate accumulator,
+adder) is built and evaluated in two phases, both spread over --jobs processes:
+
+    1. estimate   imply lines and memristors are computed from the gate tables by estimate_costs,
+                  without compiling. The error metrics are measured by a batched simulation of the
+                  netlist (Netlist.evaluate on numpy bit arrays) against the exact a*b + c
+    2. compile    configurations that are not clearly dominated by another estimate (see --slack)
+                  are compiled, their exact lines and memristors replace the estimates
+
+The result is the Pareto front of latency (imply lines) versus area (memristors) versus accuracy.
+"""
+
+import argparse
+import concurrent.futures
+import contextlib
+import io
+import itertools
+import json
+import os
+
+import numpy as np
+
+import compiler
+import gates
+import netlist_io
+
+MULTIPLIERS_4x4 = {"exact": gates.traceable_multiply4x4_exact,
+                   "M1": gates.traceable_multiply4x4_M1,
+                   "M2": gates.traceable_multiply4x4_M2}
+
+ERROR_METRICS = ["error_rate", "med", "nmed", "mred", "wce"]
+OBJECTIVES = ["lines", "memristors"]    # besides the error metric chosen for the front
+
+A_BITS = 8
+B_BITS = 8
+C_BITS = 16
+RESULT_BITS = 16
+
+
+def configurations(multipliers: list[str]=None, adders: list[str]=None, approximateAdder: list[bool]=None) -> list[dict]:
+    # all combinations of the knobs of MAC_unit, multipliers are named by MULTIPLIERS_4x4
+    multipliers = list(MULTIPLIERS_4x4) if multipliers is None else multipliers
+    adders = ["ripple"] if adders is None else adders
+    approximateAdder = [False, True] if approximateAdder is None else approximateAdder
+    return [{"mult4x4_low": low, "mult4x4_mid": mid, "mult4x4_high": high, "ApproximateAdder": approximate, "adder": adder}
+            for low, mid, high, approximate, adder in itertools.product(multipliers, multipliers, multipliers, approximateAdder, adders)]
+
+def config_name(config: dict) -> str:
+    accumulator = "approx" if config["ApproximateAdder"] else "exact"
+    return f"{config['mult4x4_low']}_{config['mult4x4_mid']}_{config['mult4x4_high']}_{accumulator}_{config['adder']}"
+
+def build_netlist(config: dict, parallelism: int) -> tuple[netlist_io.Netlist, list[int]]:
+    '''
+        builds the MAC unit of a configuration
+
+        returns:
+            netlist: gate tables of the circuit
+            operands: input index of every bit of a, b and c (most significant bit first), None if unused
+    '''
+    gates.maxGatesPerStage = parallelism
+    gates.MAC_Circuit(0, 0, 0, mult4x4_low=MULTIPLIERS_4x4[config["mult4x4_low"]], mult4x4_mid=MULTIPLIERS_4x4[config["mult4x4_mid"]],
+                      mult4x4_high=MULTIPLIERS_4x4[config["mult4x4_high"]], ApproximateAdder=config["ApproximateAdder"], adder=config["adder"])
+    # a, b and c are the first inputs created by MAC_Circuit, all others are constants
+    operandLabels = [register.getLabel() for register in gates.Register.inputRegisters[:A_BITS + B_BITS + C_BITS]]
+    with contextlib.redirect_stdout(io.StringIO()):
+        netlist = gates.CircuitConfig().toNetlist()
+    inputs = {str(label): index for index, label in enumerate(netlist.labels[:netlist.num_inputs])}
+    return netlist, [inputs.get(label) for label in operandLabels]
+
+
+# Cost model
+
+def estimate_costs(netlist: netlist_io.Netlist, parallelism: int=1) -> dict:
+    '''
+        estimates the compiled costs from the gate tables, without assigning registers or emitting lines
+
+        Lines are laid out like compiler.process_stage does (longest gates first, parallelism lanes). For
+        memristors every gate reserves the work registers of its template, freed registers are reused at
+        once, so the estimate is the peak of live registers. With the "reuse" allocator both equal the
+        compiled costs. Instances of modules are not supported.
+
+        returns:
+            {"lines", "memristors", "steps"}
+    '''
+    if netlist.num_instances() > 0:
+        raise Exception("ERROR: Cost estimation does not support instances of modules!")
+
+    templates = compiler.gate_templates
+    lengths = np.array([template.length for template in templates])
+    work = np.array([template.num_work for template in templates])
+    freed = np.array([len(template.to_be_freed) for template in templates])
+
+    lines = 0
+    steps = 0
+    live = netlist.num_inputs
+    peak = live
+    gate_types = np.asarray(netlist.gate_types)
+    for stage in range(netlist.num_stages()):
+        codes = gate_types[netlist.stage_offsets[stage]:netlist.stage_offsets[stage + 1]]
+        stage_lengths = np.sort(lengths[codes])[::-1]
+        lines = lines + int(stage_lengths[::parallelism].sum())
+        steps = steps + int(stage_lengths.sum())
+        live = live + int(work[codes].sum())
+        peak = max(peak, live)
+        live = live - int(freed[codes].sum()) - int(netlist.free_offsets[stage + 1] - netlist.free_offsets[stage])
+    return {"lines": lines, "memristors": peak, "steps": steps}
+
+
+# Error metrics
+
+def operand_vectors(vectors: int=None, seed: int=0) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    # all pairs of a and b with random c, or vectors random operands
+    rng = np.random.default_rng(seed)
+    if vectors is None:
+        a, b = np.divmod(np.arange(2**(A_BITS + B_BITS), dtype=np.int64), 2**B_BITS)
+    else:
+        a = rng.integers(0, 2**A_BITS, size=vectors, dtype=np.int64)
+        b = rng.integers(0, 2**B_BITS, size=vectors, dtype=np.int64)
+    c = rng.integers(0, 2**C_BITS, size=len(a), dtype=np.int64)
+    return a, b, c
+
+def to_bits(values: np.ndarray, width: int) -> list[np.ndarray]:
+    # bit arrays of all values, most significant bit first
+    return [((values >> shift) & 1).astype(np.uint8) for shift in range(width - 1, -1, -1)]
+
+def simulate(netlist: netlist_io.Netlist, operands: list[int], a: np.ndarray, b: np.ndarray, c: np.ndarray) -> np.ndarray:
+    # results of all operand vectors at once, inputs that are not operands are constant 0
+    inputs = [np.zeros(len(a), dtype=np.uint8) for _ in range(netlist.num_inputs)]
+    for index, bits in zip(operands, to_bits(a, A_BITS) + to_bits(b, B_BITS) + to_bits(c, C_BITS)):
+        if index is not None:
+            inputs[index] = bits
+    result = np.zeros(len(a), dtype=np.int64)
+    for bits in netlist.evaluate_outputs(inputs):
+        result = (result << 1) | np.broadcast_to(bits, result.shape)
+    return result
+
+def error_metrics(result: np.ndarray, exact: np.ndarray, width: int=RESULT_BITS) -> dict:
+    '''
+        returns:
+            error_rate: share of wrong results
+            med: mean error distance
+            nmed: med normalised by the largest result 2^width - 1
+            mred: mean of the error distances relative to the exact results (exact results of 0 count as 1)
+            wce: worst case error distance
+    '''
+    distance = np.abs(result - exact)
+    return {"error_rate": float(np.mean(distance > 0)),
+            "med": float(np.mean(distance)),
+            "nmed": float(np.mean(distance) / (2**width - 1)),
+            "mred": float(np.mean(distance / np.maximum(exact, 1))),
+            "wce": int(distance.max(initial=0))}
+
+
+# Exploration
+
+def estimate_configuration(config: dict, parallelism: int, vectors: int, seed: int) -> dict:
+    # phase 1, runs in a worker process
+    netlist, operands = build_netlist(config, parallelism)
+    a, b, c = operand_vectors(vectors, seed)
+    exact = (a * b + c) % 2**RESULT_BITS
+    return {"name": config_name(config),
+            "config": config,
+            "gates": netlist.num_gates(),
+            "stages": netlist.num_stages(),
+            "estimate": estimate_costs(netlist, parallelism),
+            "errors": error_metrics(simulate(netlist, operands, a, b, c), exact)}
+
+def compile_configuration(config: dict, parallelism: int) -> dict:
+    # phase 2, runs in a worker process, nothing is written
+    netlist, _ = build_netlist(config, parallelism)
+    compiler.parallelism = parallelism
+    with contextlib.redirect_stdout(io.StringIO()):
+        compiler.compile_netlist(netlist, outfile=None)
+    return {"lines": compiler.num_lines, "memristors": compiler.num_registers}
+
+def dominates(x: dict, y: dict, keys: list[str], slack: float=0.0) -> bool:
+    # x is at least (1 + slack) times better than y in all keys and strictly better in one of them
+    better = [x[key] * (1 + slack) <= y[key] for key in keys]
+    return all(better) and any(x[key] * (1 + slack) < y[key] for key in keys)
+
+def pareto_front(points: list[dict], keys: list[str]) -> list[dict]:
+    # points that are not dominated in keys, with equal values only the first point is kept
+    front = []
+    for point in sorted(points, key=lambda point: [point[key] for key in keys]):
+        if not any(dominates(other, point, keys) or all(other[key] == point[key] for key in keys) for other in front):
+            front.append(point)
+    return front
+
+def run_parallel(function, arguments: list[tuple], jobs: int) -> list:
+    if jobs <= 1:
+        return [function(*args) for args in arguments]
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+        return list(executor.map(function, *zip(*arguments)))
+
+def explore(configs: list[dict], parallelism: int=1, vectors: int=None, seed: int=0, jobs: int=1, slack: float=0.05, metric: str="med") -> list[dict]:
+    '''
+        estimates all configurations, compiles the ones that might be on the Pareto front
+
+        expects:
+            vectors: random operand vectors per configuration, None for all pairs of a and b
+            slack: configurations are only pruned if another estimate is better by this factor in
+                   lines and memristors (and not less accurate), covering the error of the estimate
+            metric: error metric of the front, see ERROR_METRICS
+
+        returns:
+            one point per configuration with "estimate", "errors", "compiled" (None if pruned) and the
+            objectives "lines", "memristors" and metric, "pareto" marks the Pareto front
+    '''
+    if metric not in ERROR_METRICS:
+        raise Exception(f"ERROR: Unknown error metric {metric}, expected one of {ERROR_METRICS}!")
+    keys = OBJECTIVES + [metric]
+
+    points = run_parallel(estimate_configuration, [(config, parallelism, vectors, seed) for config in configs], jobs)
+    for point in points:
+        point.update(point["estimate"])
+        point[metric] = point["errors"][metric]
+
+    candidates = [point for point in points if not any(dominates(other, point, keys, slack) for other in points)]
+    compiled = run_parallel(compile_configuration, [(point["config"], parallelism) for point in candidates], jobs)
+    for point in points:
+        point["compiled"] = None
+    for point, costs in zip(candidates, compiled):
+        point["compiled"] = costs
+        point.update(costs)
+
+    front = pareto_front(candidates, keys)
+    for point in points:
+        point["pareto"] = any(point is other for other in front)
+    return points
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(description="Design space exploration of the MAC unit")
+    parser.add_argument("--out", default="dse.json", help="JSON file all points are written to")
+    parser.add_argument("--multipliers", nargs="+", choices=list(MULTIPLIERS_4x4), default=list(MULTIPLIERS_4x4))
+    parser.add_argument("--adders", nargs="+", choices=gates.MAC_ADDERS, default=["ripple"])
+    parser.add_argument("--parallelism", type=int, default=1)
+    parser.add_argument("--vectors", type=int, default=None, help="random operand vectors (default: all pairs of a and b)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--jobs", type=int, default=os.cpu_count())
+    parser.add_argument("--slack", type=float, default=0.05, help="margin of the estimates when pruning")
+    parser.add_argument("--metric", choices=ERROR_METRICS, default="med", help="error metric of the Pareto front")
+    args = parser.parse_args(argv)
+
+    configs = configurations(args.multipliers, args.adders)
+    points = explore(configs, args.parallelism, args.vectors, args.seed, args.jobs, args.slack, args.metric)
+
+    with open(args.out, "w") as f:
+        json.dump({"parallelism": args.parallelism, "metric": args.metric, "points": points}, f, indent=4)
+
+    compiled = sum(point["compiled"] is not None for point in points)
+    print(f"{len(points)} configurations, {compiled} compiled, {len(points) - compiled} pruned by the estimate")
+    print(f"{'configuration':40s} {'lines':>8s} {'memristors':>10s} {args.metric:>12s}")
+    for point in sorted((point for point in points if point["pareto"]), key=lambda point: point["lines"]):
+        print(f"{point['name']:40s} {point['lines']:8d} {point['memristors']:10d} {point[args.metric]:12.6g}")
+
+if __name__ == "__main__":
+    main()
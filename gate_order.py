@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+"""
+Reordering of the gates of a circuit to lower the number of memristors it is compiled to
+
+    python gate_order.py config.npz --out reordered.npz
+    python cli.py compile config.npz --reorder --out out/atomic_config.txt
+
+How long a signal occupies a memristor depends on the order of the gates, which is the order in which
+the traceable_* functions call them (traceable_multiply4x4_exact computes all partial products of a
+column before any of them is consumed). Two topological orders are derived from the gate graph:
+
+    sethi_ullman   depth first from the outputs, the inputs of every gate are computed in decreasing order
+                   of their Sethi-Ullman number (memristors needed to compute the cone as if it was a tree,
+                   including the work memristors of the gate templates), so the cone needing the most
+                   memristors is done while the fewest results are held
+    greedy         list scheduling on top of it for signals read by several gates: among the gates whose
+                   inputs are computed, the one freeing the most memristors (inputs it is the last reader
+                   of, minus its own result) is placed next, ties in sethi_ullman order
+
+The stages and the signals freed after every stage are then assigned again by netlist_io.schedule_gates.
+Every order is measured for the allocator it will be compiled with, by dse.estimate_costs for "reuse"
+(equal to the compiled costs) and by assigning registers like the compiler does for the others. The one
+with the fewest memristors (then lines) is kept, the original order included. Netlists with instances of
+modules are left as they are, their gates are only known per module.
+"""
+
+import argparse
+import contextlib
+import heapq
+import io
+
+import compiler
+import dse
+import netlist_io
+
+ORDERS = ("original", "sethi_ullman", "greedy")
+SKIPPED = "original (instances of modules are not reordered)"
+
+
+def readers_of(num_inputs: int, gate_inputs: list[list[int]]) -> list[list[int]]:
+    # gates reading every signal, once per gate
+    readers = [[] for _ in range(num_inputs + len(gate_inputs))]
+    for gate, inputs in enumerate(gate_inputs):
+        for signal in set(inputs):
+            readers[signal].append(gate)
+    return readers
+
+def sethi_ullman_numbers(num_inputs: int, gate_types: list[int], gate_inputs: list[list[int]]) -> list[int]:
+    '''
+        memristors needed to compute every signal as if its cone was a tree, inputs are already stored
+
+        The inputs of a gate are computed in decreasing order of their numbers, while the k-th input is computed
+        the results of the k-1 before are held. The gate itself needs its inputs and its work memristors.
+    '''
+    need = [0] * num_inputs
+    for code, inputs in zip(gate_types, gate_inputs):
+        computed = sorted((need[signal] for signal in inputs if signal >= num_inputs), reverse=True)
+        held = len(computed)
+        need.append(max([number + position for position, number in enumerate(computed)] + [held + compiler.gate_templates[code].num_work]))
+    return need
+
+def sethi_ullman_order(num_inputs: int, gate_types: list[int], gate_inputs: list[list[int]], outputs: list[int]) -> list[int]:
+    # depth first from the outputs (largest number first), inputs of a gate in decreasing order of their numbers
+    need = sethi_ullman_numbers(num_inputs, gate_types, gate_inputs)
+    order = []
+    placed = [True] * num_inputs + [False] * len(gate_types)
+    roots = sorted(dict.fromkeys(outputs), key=lambda signal: need[signal], reverse=True)
+    for root in roots + list(range(num_inputs, num_inputs + len(gate_types))):
+        if placed[root]:
+            continue
+        stack = [(root, False)]
+        while len(stack) > 0:
+            signal, expanded = stack.pop()
+            if placed[signal]:
+                continue
+            if expanded:
+                placed[signal] = True
+                order.append(signal - num_inputs)
+                continue
+            stack.append((signal, True))
+            # pushed in increasing order, so the input with the largest number is computed first
+            inputs = sorted(set(gate_inputs[signal - num_inputs]), key=lambda input: need[input])
+            stack.extend((input, False) for input in inputs if not placed[input])
+    return order
+
+def greedy_order(num_inputs: int, gate_types: list[int], gate_inputs: list[list[int]], outputs: list[int], priority: list[int]) -> list[int]:
+    '''
+        list scheduling placing the ready gate that frees the most memristors next
+
+        expects:
+            priority: position of every gate in the order breaking ties
+    '''
+    readers = readers_of(num_inputs, gate_inputs)
+    remaining = [len(gates) for gates in readers]
+    kept = set(outputs)
+    missing = [len(set(signal for signal in inputs if signal >= num_inputs)) for inputs in gate_inputs]
+
+    def gain(gate):
+        freed = sum(1 for signal in set(gate_inputs[gate]) if remaining[signal] == 1 and signal not in kept)
+        return freed - 1
+
+    heap = [(-gain(gate), priority[gate], gate) for gate in range(len(gate_inputs)) if missing[gate] == 0]
+    heapq.heapify(heap)
+    placed = [False] * len(gate_inputs)
+    order = []
+    while len(heap) > 0:
+        score, _, gate = heapq.heappop(heap)
+        if placed[gate]:
+            continue
+        if -score != gain(gate):
+            heapq.heappush(heap, (-gain(gate), priority[gate], gate))
+            continue
+        placed[gate] = True
+        order.append(gate)
+        for signal in set(gate_inputs[gate]):
+            remaining[signal] = remaining[signal] - 1
+            # the last reader of the signal now frees it
+            if remaining[signal] == 1 and signal not in kept:
+                for reader in readers[signal]:
+                    if not placed[reader] and missing[reader] == 0:
+                        heapq.heappush(heap, (-gain(reader), priority[reader], reader))
+        for reader in readers[num_inputs + gate]:
+            missing[reader] = missing[reader] - 1
+            if missing[reader] == 0:
+                heapq.heappush(heap, (-gain(reader), priority[reader], reader))
+    return order
+
+def reordered(flat: tuple, num_inputs: int, order: list[int], maxGatesPerStage: int=1) -> netlist_io.Netlist:
+    # netlist with the gates of flat_gates in the given order
+    labels, gate_types, gate_inputs, outputs, output_labels = flat
+    renumber = list(range(num_inputs)) + [0] * len(gate_types)
+    for position, gate in enumerate(order):
+        renumber[num_inputs + gate] = num_inputs + position
+    return netlist_io.schedule_gates(list(labels[:num_inputs]) + [labels[num_inputs + gate] for gate in order], num_inputs,
+                                     [gate_types[gate] for gate in order],
+                                     [[renumber[signal] for signal in gate_inputs[gate]] for gate in order],
+                                     [renumber[signal] for signal in outputs], output_labels, maxGatesPerStage)
+
+def measured_costs(netlist: netlist_io.Netlist, parallelism: int=1, allocator: str="reuse") -> dict:
+    # costs of netlist compiled with allocator, nothing is written and the compiler settings are restored
+    costs = dse.estimate_costs(netlist, parallelism)
+    if allocator == "reuse":
+        return costs
+    settings = (compiler.parallelism, compiler.allocator, compiler.profile)
+    compiler.parallelism, compiler.allocator, compiler.profile = parallelism, allocator, None
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            compiler.compile_netlist(netlist, outfile=None)
+    finally:
+        compiler.parallelism, compiler.allocator, compiler.profile = settings
+    costs.update(lines=compiler.num_lines, memristors=compiler.num_registers)
+    return costs
+
+def gate_orders(netlist: netlist_io.Netlist, parallelism: int=1, allocator: str="reuse") -> dict:
+    '''
+        compiles netlist in every order of ORDERS
+
+        expects:
+            allocator: allocator of compiler.ALLOCATORS the orders are measured for
+
+        returns:
+            order : (Netlist, {"lines", "memristors", "steps"})
+    '''
+    flat = netlist.flat_gates()
+    _, gate_types, gate_inputs, outputs, _ = flat
+    num_inputs = netlist.num_inputs
+    orders = {"original": list(range(len(gate_types)))}
+    orders["sethi_ullman"] = sethi_ullman_order(num_inputs, gate_types, gate_inputs, outputs)
+    priority = [0] * len(gate_types)
+    for position, gate in enumerate(orders["sethi_ullman"]):
+        priority[gate] = position
+    orders["greedy"] = greedy_order(num_inputs, gate_types, gate_inputs, outputs, priority)
+
+    results = {}
+    for name, order in orders.items():
+        scheduled = reordered(flat, num_inputs, order, parallelism)
+        results[name] = (scheduled, measured_costs(scheduled, parallelism, allocator))
+    return results
+
+def best_order(results: dict) -> str:
+    # order of gate_orders with the fewest memristors (then lines)
+    return min(results, key=lambda name: (results[name][1]["memristors"], results[name][1]["lines"]))
+
+def reorder_netlist(netlist: netlist_io.Netlist, parallelism: int=1, allocator: str="reuse") -> tuple[netlist_io.Netlist, str]:
+    '''
+        returns:
+            netlist in the order of ORDERS with the fewest memristors (then lines) for allocator, name of that order
+            netlists with instances of modules unchanged, SKIPPED
+    '''
+    if netlist.num_instances() > 0:
+        return netlist, SKIPPED
+    results = gate_orders(netlist, parallelism, allocator)
+    best = best_order(results)
+    return results[best][0], best
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(description="Reorder the gates of a circuit to need fewer memristors")
+    parser.add_argument("config", help="config file (.json, .jsonl or .npz) or circuit to import (.blif, .aag or .aig)")
+    parser.add_argument("--parallelism", type=int, default=1)
+    parser.add_argument("--allocator", choices=list(compiler.ALLOCATORS), default="reuse", help="allocator the orders are measured for")
+    parser.add_argument("--out", default=None, help="write the best order as config (.json, .jsonl or .npz)")
+    args = parser.parse_args(argv)
+
+    netlist = netlist_io.load_netlist(args.config, args.parallelism)
+    if netlist.num_instances() > 0:
+        parser.error("instances of modules cannot be reordered, build the circuit without --hierarchical")
+    results = gate_orders(netlist, args.parallelism, args.allocator)
+    for name, (_, costs) in results.items():
+        print(f"{name}: {costs}")
+    best = best_order(results)
+    print(f"best: {best}")
+    if args.out is not None:
+        scheduled = results[best][0]
+        if args.out.endswith(".npz"):
+            scheduled.save(args.out)
+        else:
+            netlist_io.write_config(args.out, scheduled.input_registers(), scheduled.labelled_stages())
+        print(f"Configuration file '{args.out}' has been created.")
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,11 @@
 import numpy as np
 from itertools import product
+from array import array
+import functools
 import json
 
+import netlist_io
+
 labelLists = {
     # label format like OR0, OR1, ...
     "OR": [],
@@ -10,10 +14,18 @@ labelLists = {
     "NOT": [],
     "IN": [], # used to label input registers
     "OUT": [], # used to label output registers
+    "INST": [], # used to label outputs of module instances
 }
 
 maxGatesPerStage = 1
 
+# Optional attribution of gates to the subcircuits creating them
+# If traceCalls is set, every gate is tagged with the call path of @traceable functions it was created in,
+# e.g. "MAC_unit/mult8x8_from4x4/traceable_exact_compressor_4to2/traceable_full_adder". The path is
+# exported with the circuit, so the compiler can roll its costs up per subcircuit (see compile_profile).
+traceCalls = False
+callStack = []
+
 # Define custom datastructures for dependency and flow tracing
 
 class Register():
@@ -111,9 +123,12 @@ class Gate():
         self.output = None
 
     def to_json_dict(self):
-        return {"type": self.gateLabel,
+        gate = {"type": self.gateLabel,
                 "name": self.name,
                 "inputs": [inp.getLabel() for inp in self.inputs]}
+        if self.path:
+            gate["path"] = self.path
+        return gate
 
     def __str__(self):
         return f"[stage: {self.stage} | type: {self.gateLabel} | inputs: ({', '.join([r.getLabel() for r in self.inputs])}) | name: {self.name} | output: {self.output}]"
@@ -134,6 +149,7 @@ class Gate():
         return maxInputStage
     
     def registerGate(self) -> None:
+        self.path = "/".join(callStack) if traceCalls else ""
         try:
             Gate.usedGates[self.stage].append(self)
         except Exception:
@@ -301,6 +317,150 @@ class NOT_GATE(Gate):
         return outRegister
     
 
+class INST_GATE(Gate):
+    def __init__(self, module: str, inputs: list):
+        self.gateLabel = "INST"
+        self.module = module
+        self.inputs = list(inputs)
+
+        if(len(self.inputs) == 0):
+            raise Exception(f"ERROR: INST-Gate of module {module} Expects at least 1 input!")
+        self.stage = self.determineStage()
+        self.registerGate()
+        if traceCalls:
+            self.path = "/".join(callStack + [module])
+
+        self.name = None
+        self.output = None
+        self.outputs = []
+
+    def to_json_dict(self):
+        gate = {"type": self.gateLabel,
+                "module": self.module,
+                "inputs": [inp.getLabel() for inp in self.inputs],
+                "outputs": [out.getLabel() for out in self.outputs]}
+        if self.path:
+            gate["path"] = self.path
+        return gate
+
+    def execute(self) -> list[Register]:
+        for register in self.inputs:
+            register.usedAt(self.getStage())
+
+        values = Module.library[self.module].evaluate_outputs([register.getValue() for register in self.inputs])
+        self.outputs = [Register(value=val, gateLabel=self.gateLabel, stage=self.stage) for val in values]
+        self.setOutput(outputRegister=self.outputs[0])
+
+        return self.outputs
+
+
+# Modules: subcircuits that are built once and instantiated by reference
+
+def flatten_registers(value, registers: list):
+    # collects the Registers of nested lists/tuples, returns a signature of everything else
+    if isinstance(value, Register):
+        registers.append(value)
+        return "Register"
+    if isinstance(value, (list, tuple)):
+        return (type(value).__name__, tuple(flatten_registers(item, registers) for item in value))
+    return repr(value)
+
+def replace_registers(value, registers):
+    # copy of nested lists/tuples with every Register replaced by the next one of registers
+    if isinstance(value, Register):
+        return next(registers)
+    if isinstance(value, (list, tuple)):
+        return type(value)(replace_registers(item, registers) for item in value)
+    return value
+
+class Module():
+    '''
+        wraps a traceable_* function, so its gates are only created and compiled once
+
+        Calling a module places a single INST gate instead of the gates of the function. The body is
+        built the first time the module is called with a new signature (shape of the Register
+        arguments, values of all other arguments, maxGatesPerStage and traceCalls) and stored in
+        Module.library. Registers created as constants inside of the body become additional inputs
+        of every instance, like they would become inputs of a flattened circuit.
+    '''
+    library = {}    # module name : Netlist of the body, a body is added after the modules it instantiates
+    wrappers = {}   # function : Module
+
+    def __init__(self, function, name: str=None):
+        self.function = function
+        self.name = function.__name__ if name is None else name
+        self.bodies = {}    # signature : (module name, values of constant inputs, result of the body)
+
+    def __repr__(self):
+        return f"Module({self.name})"
+
+    def wrap(function):
+        # one Module per function, so every caller shares its bodies
+        if isinstance(function, Module):
+            return function
+        if function not in Module.wrappers:
+            Module.wrappers[function] = Module(function)
+        return Module.wrappers[function]
+
+    def __call__(self, *args, **kwargs):
+        inputs = []
+        # bodies depend on the builder settings as well
+        signature = (flatten_registers(args, inputs), flatten_registers(sorted(kwargs.items()), []), maxGatesPerStage, traceCalls)
+        if signature not in self.bodies:
+            self.bodies[signature] = self.build(args, kwargs, len(inputs))
+        name, constants, result = self.bodies[signature]
+
+        constants = [Register(val, "IN") for val in constants]
+        outputs = INST_GATE(name, inputs + constants).execute()
+        return replace_registers(result, iter(outputs))
+
+    def build(self, args, kwargs, num_inputs: int):
+        name = self.name
+        while name in Module.library:
+            name = f"{self.name}_{len(self.bodies)}" if name == self.name else name + "_"
+
+        # the body is built on placeholder inputs, separated from the circuit that is currently built
+        usedGates, freeRegistersAfter, inputRegisters = Gate.usedGates, Register.freeRegistersAfter, Register.inputRegisters
+        stack = callStack[:]
+        callStack.clear()
+        Gate.reset()
+        Register.reset()
+        try:
+            placeholders = [Register(0, "IN") for _ in range(num_inputs)]
+            result = self.function(*replace_registers(args, iter(placeholders)), **kwargs)
+            outputs = []
+            flatten_registers(result, outputs)
+            if len(outputs) == 0 or len(set(outputs)) != len(outputs) or any(output.getStage() == 0 for output in outputs):
+                raise Exception(f"ERROR: Outputs of module {name} have to be distinct Registers computed by its gates!")
+            add_OUT_layer(list(outputs))
+
+            config = CircuitConfig(isModule=True)
+            constants = [register.getValue() for register in config.inputRegisters[num_inputs:]]
+            body = config.toNetlist()
+            body.registers = None
+        finally:
+            Gate.usedGates, Register.freeRegistersAfter, Register.inputRegisters = usedGates, freeRegistersAfter, inputRegisters
+            callStack[:] = stack
+
+        Module.library[name] = body
+        return name, constants, result
+
+
+def traceable(function):
+    '''
+        decorator for subcircuits, pushes the name of the function on callStack while it builds its gates
+    '''
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        if not traceCalls:
+            return function(*args, **kwargs)
+        callStack.append(function.__name__)
+        try:
+            return function(*args, **kwargs)
+        finally:
+            callStack.pop()
+    return wrapper
+
 
 # Define more abstract logic blocks
 
@@ -319,6 +479,7 @@ def BinRegistersToNum(bin):
         integer = integer + int(bit)* (2**i)
     return integer
 
+@traceable
 def traceable_half_adder(a: Register, b: Register) -> tuple[Register, Register]:
     """
     Gibt (sum, carry) zurück.
@@ -329,6 +490,7 @@ def traceable_half_adder(a: Register, b: Register) -> tuple[Register, Register]:
     carry = AND_GATE([a, b]).execute()
     return sum_, carry
 
+@traceable
 def traceable_full_adder(a: Register, b: Register, cin: Register) -> tuple[Register, Register]:
     """
     Gibt (sum, carry) zurück.
@@ -343,6 +505,7 @@ def traceable_full_adder(a: Register, b: Register, cin: Register) -> tuple[Regis
     carry_out = OR_GATE([c1, c2]).execute()
     return s2, carry_out
 
+@traceable
 def traceable_approx_compressor_4to2(x1, x2, x3, x4): # passt
     """
     Gibt das approximierte Sum- und Carry-Bit zurück,
@@ -365,6 +528,7 @@ def traceable_approx_compressor_4to2(x1, x2, x3, x4): # passt
     return sum_approx, carry_approx
 
 
+@traceable
 def traceable_approx_compressor_4to2_stage2(x1: Register, x2: Register, x3: Register, x4: Register) -> tuple[Register, Register]: # passt
     """
     Gibt das approximierte Sum- und Carry-Bit zurück,
@@ -382,6 +546,7 @@ def traceable_approx_compressor_4to2_stage2(x1: Register, x2: Register, x3: Regi
     # Als 0/1 zurückgeben
     return sum_approx, carry_approx
 
+@traceable
 def traceable_approx_compressor_4to2_stage3(x1: Register, x2: Register, x3: Register, x4: Register) -> tuple[Register, Register]: # passt
     """
     Gibt das approximierte Sum- und Carry-Bit zurück,
@@ -402,6 +567,7 @@ def traceable_approx_compressor_4to2_stage3(x1: Register, x2: Register, x3: Regi
     # Als 0/1 zurückgeben
     return sum_approx, carry_approx
 
+@traceable
 def traceable_approx_compressor_4to2_stage4(x1: Register, x2: Register, x3: Register, x4: Register, get_carry: bool) -> tuple[Register, Register]: # passt
     """
     Gibt das approximierte Sum- und Carry-Bit zurück,
@@ -423,6 +589,7 @@ def traceable_approx_compressor_4to2_stage4(x1: Register, x2: Register, x3: Regi
     # Als 0/1 zurückgeben
     return sum_approx, carry_approx
 
+@traceable
 def traceable_exact_compressor_4to2(x1: Register,x2: Register,x3: Register,x4: Register,cin: Register, combine_carries: bool=False) -> tuple[Register, Register, Register]:
     '''
         Gibt das exakte sum, cout und carry bit zurück.
@@ -438,12 +605,14 @@ def traceable_exact_compressor_4to2(x1: Register,x2: Register,x3: Register,x4: R
     
     return sum, carry, cout
 
+@traceable
 def traceable_exact_compressor_5to2(x1: Register,x2: Register,x3: Register,x4: Register,x5: Register,cin1: Register, cin2: Register) -> tuple[Register, Register, Register, Register]:
     tmp_sum, cout1 = traceable_full_adder(x1, x2, x3)
     tmp_sum, cout2 = traceable_full_adder(tmp_sum, x4, cin1)
     sum, carry = traceable_full_adder(tmp_sum, x5, cin2)
     return sum, carry, cout1, cout2
 
+@traceable
 def traceable_multiply4x4_M1(a: list[Register],b: list[Register]):
     result = []
 
@@ -490,6 +659,7 @@ def traceable_multiply4x4_M1(a: list[Register],b: list[Register]):
 
     return result
 
+@traceable
 def traceable_multiply4x4_M2(a: list[Register],b: list[Register]):
     result = []
 
@@ -536,6 +706,7 @@ def traceable_multiply4x4_M2(a: list[Register],b: list[Register]):
 
     return result
 
+@traceable
 def traceable_multiply4x4_exact(a: list[Register],b: list[Register]) -> list[Register]:
     result = []
 
@@ -586,6 +757,7 @@ def traceable_multiply4x4_exact(a: list[Register],b: list[Register]) -> list[Reg
 
     return result
 
+@traceable
 def mult8x8_from4x4(a: list[Register],b: list[Register], mult4x4_low=traceable_multiply4x4_exact, mult4x4_mid=traceable_multiply4x4_exact, mult4x4_high=traceable_multiply4x4_exact):
 
     # create two "bit-nibbles", high/low for each number
@@ -648,6 +820,184 @@ def mult8x8_from4x4(a: list[Register],b: list[Register], mult4x4_low=traceable_m
 
     return result
 
+@traceable
+def traceable_array_multiplier(a: list[Register], b: list[Register]) -> list[Register]:
+    '''
+        unsigned NxM array multiplier, the rows of partial products are added one by one with ripple carry adders
+
+        a, b and the result are ordered most significant bit first, like NumToBinRegisters. The result has
+        len(a)+len(b) bits, or fewer if one of the factors has a single bit
+    '''
+    # low -> high significant bits
+    a = a[::-1]
+    b = b[::-1]
+
+    result = []
+    partial = [AND_GATE(x, b[0]).execute() for x in a]
+    for j in range(1, len(b)):
+        result.append(partial[0])
+        upper = partial[1:]
+        row = [AND_GATE(x, b[j]).execute() for x in a]
+
+        partial = []
+        carry = None
+        for i in range(len(a)):
+            if i < len(upper) and carry is None:
+                sum, carry = traceable_half_adder(upper[i], row[i])
+            elif i < len(upper):
+                sum, carry = traceable_full_adder(upper[i], row[i], carry)
+            elif carry is not None:
+                sum, carry = traceable_half_adder(row[i], carry)
+            else:
+                sum = row[i]
+            partial.append(sum)
+        if carry is not None:
+            partial.append(carry)
+    result.extend(partial)
+
+    result.reverse()
+    return result
+
+# Tree multipliers
+# The partial products are collected in columns of equal weight, reduced with counters to at most two bits per
+# column and added by a final carry propagate adder. Reduction takes O(log n) adder levels instead of the O(n)
+# rows of the array multiplier.
+
+def partial_product_columns(a: list[Register], b: list[Register]) -> list[list[Register]]:
+    # column k holds the bits of weight 2^k, a and b are ordered most significant bit first
+    a = a[::-1]
+    b = b[::-1]
+    columns = [[] for _ in range(len(a) + len(b))]
+    for j, y in enumerate(b):
+        for i, x in enumerate(a):
+            columns[i + j].append(AND_GATE(x, y).execute())
+    return columns
+
+def approximate_low_columns(columns: list[list[Register]], approximateColumns: int) -> None:
+    '''
+        reduces the lowest approximateColumns columns to a single bit each, like the M1/M2 multipliers
+
+        Groups of four bits are compressed by traceable_approx_compressor_4to2 (sum in the column, carry in the
+        next one), fewer remaining bits are ORed. No carry is propagated out of the ORed bits.
+    '''
+    for k in range(min(approximateColumns, len(columns) - 1)):
+        bits = columns[k]
+        while len(bits) >= 4:
+            sum, carry = traceable_approx_compressor_4to2(bits.pop(0), bits.pop(0), bits.pop(0), bits.pop(0))
+            bits.append(sum)
+            columns[k + 1].append(carry)
+        while len(bits) >= 2:
+            bits.append(OR_GATE(bits.pop(0), bits.pop(0)).execute())
+
+def compress_column(bits: list[Register], reduction: int, compressors: bool, column: list[Register], higher: list[Register]) -> None:
+    # removes bits from the front of bits until the column shrank by reduction, sums go to column, carries to higher
+    while reduction > 0:
+        if compressors and reduction >= 4 and len(bits) >= 5:
+            sum, carry, cout = traceable_exact_compressor_4to2(bits.pop(0), bits.pop(0), bits.pop(0), bits.pop(0), bits.pop(0))
+            higher.extend([carry, cout])
+            reduction = reduction - 4
+        elif reduction >= 2 and len(bits) >= 3:
+            sum, carry = traceable_full_adder(bits.pop(0), bits.pop(0), bits.pop(0))
+            higher.append(carry)
+            reduction = reduction - 2
+        elif len(bits) >= 2:
+            sum, carry = traceable_half_adder(bits.pop(0), bits.pop(0))
+            higher.append(carry)
+            reduction = reduction - 1
+        else:
+            break
+        column.append(sum)
+
+def wallace_reduction(columns: list[list[Register]], compressors: bool) -> list[list[Register]]:
+    # every level compresses as many bits as possible, leftover pairs of a column are added by a half adder
+    while max(len(bits) for bits in columns) > 2:
+        reduced = [[] for _ in range(len(columns) + 1)]
+        for k, bits in enumerate(columns):
+            bits = list(bits)
+            compress_column(bits, len(bits) - 1, compressors, reduced[k], reduced[k + 1])
+            reduced[k].extend(bits)
+        columns = reduced
+    return columns
+
+def dadda_reduction(columns: list[list[Register]], compressors: bool) -> list[list[Register]]:
+    # every level only compresses what is needed to reach the next height of the sequence 2, 3, 4, 6, 9, 13, ...
+    heights = [2]
+    while heights[-1] < max(len(bits) for bits in columns):
+        heights.append(heights[-1] * 3 // 2)
+
+    for height in reversed(heights[:-1]):
+        reduced = [[] for _ in range(len(columns) + 1)]
+        for k, bits in enumerate(columns):
+            bits = list(bits)
+            # carries of the column below are already part of reduced[k]
+            compress_column(bits, len(bits) + len(reduced[k]) - height, compressors, reduced[k], reduced[k + 1])
+            reduced[k].extend(bits)
+        columns = reduced
+    return columns
+
+def carry_propagate_columns(columns: list[list[Register]], width: int, finalAdder: str="ripple") -> list[Register]:
+    # adds columns of at most two bits with a ripple carry adder or a prefix network (see PREFIX_NETWORKS),
+    # returns width bits ordered most significant first
+    columns = [bits for bits in columns[:width] if len(bits) > 0]
+    if finalAdder != "ripple" and len(columns) > 0:
+        generate = [AND_GATE(*bits).execute() if len(bits) == 2 else None for bits in columns]
+        propagate = [XOR_GATE(*bits).execute() if len(bits) == 2 else bits[0] for bits in columns]
+        sums, carry = prefix_sums(generate, propagate, finalAdder, carryOut=len(columns) < width)
+        if carry is not None:
+            sums.append(carry)
+        return sums[::-1]
+
+    result = []
+    carry = None
+    for bits in columns:
+        bits = bits if carry is None else bits + [carry]
+        carry = None
+        if len(bits) == 3:
+            sum, carry = traceable_full_adder(*bits)
+        elif len(bits) == 2:
+            sum, carry = traceable_half_adder(*bits)
+        elif len(bits) == 1:
+            sum = bits[0]
+        result.append(sum)
+    if carry is not None and len(result) < width:
+        result.append(carry)
+    result.reverse()
+    return result
+
+@traceable
+def traceable_tree_multiplier(a: list[Register], b: list[Register], reduction: str="dadda", compressors: bool=False, approximateColumns: int=0, finalAdder: str="ripple") -> list[Register]:
+    '''
+        unsigned NxM multiplier with a Wallace or Dadda reduction tree
+
+        expects:
+            a, b: factors ordered most significant bit first, like NumToBinRegisters
+            reduction: "wallace" or "dadda"
+            compressors: additionally reduce with traceable_exact_compressor_4to2 where a column shrinks by four bits
+            approximateColumns: amount of low order columns reduced approximately, see approximate_low_columns
+            finalAdder: "ripple" or a prefix network ("kogge_stone", "brent_kung", "sklansky") adding the reduced columns
+
+        returns:
+            product with len(a)+len(b) bits (fewer if one of the factors has a single bit), most significant bit first
+    '''
+    if reduction not in TREE_REDUCTIONS:
+        raise Exception(f"ERROR: Unknown reduction {reduction}, expected one of {list(TREE_REDUCTIONS)}!")
+
+    columns = partial_product_columns(a, b)
+    approximate_low_columns(columns, approximateColumns)
+    columns = TREE_REDUCTIONS[reduction](columns, compressors)
+    return carry_propagate_columns(columns, len(a) + len(b), finalAdder)
+
+TREE_REDUCTIONS = {"wallace": wallace_reduction, "dadda": dadda_reduction}
+
+@traceable
+def traceable_wallace_multiplier(a: list[Register], b: list[Register], compressors: bool=False, approximateColumns: int=0, finalAdder: str="ripple") -> list[Register]:
+    return traceable_tree_multiplier(a, b, reduction="wallace", compressors=compressors, approximateColumns=approximateColumns, finalAdder=finalAdder)
+
+@traceable
+def traceable_dadda_multiplier(a: list[Register], b: list[Register], compressors: bool=False, approximateColumns: int=0, finalAdder: str="ripple") -> list[Register]:
+    return traceable_tree_multiplier(a, b, reduction="dadda", compressors=compressors, approximateColumns=approximateColumns, finalAdder=finalAdder)
+
+@traceable
 def traceable_full_adder_nimar(x1: Register, x2: Register, carry: Register) -> tuple[Register, Register]:
     or1 = OR_GATE(x1,x2).execute()
     nor1 = OR_GATE(NOT_GATE(x1).execute(), NOT_GATE(x2).execute()).execute()
@@ -661,6 +1011,7 @@ def traceable_full_adder_nimar(x1: Register, x2: Register, carry: Register) -> t
 
     return sum, cout
 
+@traceable
 def traceable16x16_adder(a: list[Register],b: list[Register], approximate=True):
     
     # reverse a and b to make control flow easier, i.e low -> high significant bits
@@ -690,10 +1041,183 @@ def traceable16x16_adder(a: list[Register],b: list[Register], approximate=True):
     result.reverse()
     return result
 
-def MAC_unit(a:list[Register],b:list[Register],c:list[Register], mult4x4_low=traceable_multiply4x4_exact, mult4x4_mid=traceable_multiply4x4_exact, mult4x4_high=traceable_multiply4x4_exact, ApproximateAdder=True):
+# Parallel prefix adders
+# The carries of an adder are the prefixes of the (generate, propagate) pairs of its bits under
+#   (g, p) o (g', p') = (g OR (p AND g'), p AND p')
+# The networks only differ in how the prefixes are combined. Sklansky and Kogge-Stone need log2(n) levels,
+# Kogge-Stone with a fanout of 2 but many combinations, Brent-Kung needs 2 log2(n) - 1 levels and the fewest
+# combinations. Each network is given as levels of (i, j) pairs, prefix i is combined with prefix j.
+
+def kogge_stone_levels(n: int) -> list[list[tuple[int, int]]]:
+    levels = []
+    distance = 1
+    while distance < n:
+        levels.append([(i, i - distance) for i in range(distance, n)])
+        distance = distance * 2
+    return levels
+
+def sklansky_levels(n: int) -> list[list[tuple[int, int]]]:
+    levels = []
+    distance = 1
+    while distance < n:
+        levels.append([(i, (i // distance) * distance - 1) for i in range(n) if (i // distance) % 2 == 1])
+        distance = distance * 2
+    return levels
+
+def brent_kung_levels(n: int) -> list[list[tuple[int, int]]]:
+    levels = []
+    distance = 1
+    while distance < n:
+        levels.append([(i, i - distance) for i in range(2 * distance - 1, n, 2 * distance)])
+        distance = distance * 2
+    while distance > 1:
+        distance = distance // 2
+        levels.append([(i, i - distance) for i in range(3 * distance - 1, n, 2 * distance)])
+    return [level for level in levels if len(level) > 0]
+
+PREFIX_NETWORKS = {"kogge_stone": kogge_stone_levels, "brent_kung": brent_kung_levels, "sklansky": sklansky_levels}
+
+def combine_prefix(high: tuple, low: tuple) -> tuple:
+    # a generate of None is constant 0, prefixes reaching down to bit 0 drop their propagate (None)
+    generate, propagate = high
+    lowGenerate, lowPropagate = low
+    if lowGenerate is not None:
+        carried = AND_GATE(propagate, lowGenerate).execute()
+        generate = carried if generate is None else OR_GATE(generate, carried).execute()
+    propagate = None if lowPropagate is None else AND_GATE(propagate, lowPropagate).execute()
+    return generate, propagate
+
+def prefix_sums(generate: list, propagate: list[Register], network: str, carryOut: bool=False) -> tuple[list[Register], Register]:
+    '''
+        adds with a parallel prefix network, bits are ordered least significant first and the carry in is 0
+
+        expects:
+            generate: generate bit of every position, None if it is constant 0
+            propagate: propagate (sum) bit of every position
+
+        returns:
+            sums: sum bits
+            carry: carry out (None if it is constant 0 or not carryOut)
+    '''
+    if network not in PREFIX_NETWORKS:
+        raise Exception(f"ERROR: Unknown prefix network {network}, expected one of {list(PREFIX_NETWORKS)}!")
+
+    # the carry out of the highest bit is only needed for carryOut
+    width = len(propagate) if carryOut else len(propagate) - 1
+    prefixes = [(generate[0], None)] + list(zip(generate[1:width], propagate[1:width]))
+    for level in PREFIX_NETWORKS[network](width):
+        combined = [(i, combine_prefix(prefixes[i], prefixes[j])) for i, j in level]
+        for i, prefix in combined:
+            prefixes[i] = prefix
+
+    sums = [propagate[0]]
+    for bit, (carry, _) in zip(propagate[1:], prefixes):
+        sums.append(bit if carry is None else XOR_GATE(bit, carry).execute())
+    carry = prefixes[-1][0] if carryOut and width > 0 else None
+    return sums, carry
+
+@traceable
+def traceable_prefix_adder(a: list[Register], b: list[Register], network: str="kogge_stone", approximateBits: int=0, carryOut: bool=False) -> list[Register]:
+    '''
+        NxN parallel prefix adder
+
+        expects:
+            a, b: summands of equal width, ordered most significant bit first
+            network: "kogge_stone", "brent_kung" or "sklansky"
+            approximateBits: amount of low order bits only added by XOR, like traceable16x16_adder
+            carryOut: prepend the carry out to the result
+
+        returns:
+            sum ordered most significant bit first
+    '''
+    # low -> high significant bits
+    a = a[::-1]
+    b = b[::-1]
+
+    result = [XOR_GATE(x, y).execute() for x, y in zip(a[:approximateBits], b[:approximateBits])]
+    carry = None
+    if approximateBits < len(a):
+        propagate = [XOR_GATE(x, y).execute() for x, y in zip(a[approximateBits:], b[approximateBits:])]
+        generate = [AND_GATE(x, y).execute() for x, y in zip(a[approximateBits:], b[approximateBits:])]
+        sums, carry = prefix_sums(generate, propagate, network, carryOut)
+        result.extend(sums)
+    if carryOut and carry is not None:
+        result.append(carry)
+
+    result.reverse()
+    return result
+
+def ripple_add(a: list[Register], b: list[Register], carry: Register=None) -> tuple[list[Register], Register]:
+    # ripple carry addition of bits ordered least significant first, a carry of None is 0
+    sums = []
+    for x, y in zip(a, b):
+        if carry is None:
+            sum, carry = traceable_half_adder(x, y)
+        else:
+            sum, carry = traceable_full_adder(x, y, carry)
+        sums.append(sum)
+    return sums, carry
+
+@traceable
+def traceable_carry_select_adder(a: list[Register], b: list[Register], blockSize: int=None, approximateBits: int=0, carryOut: bool=False) -> list[Register]:
+    '''
+        NxN carry select adder
+
+        Every block of blockSize bits (default about sqrt(N)) is added twice by ripple carry adders, for a carry
+        in of 0 and 1, and the carry of the block below selects one of the results. Arguments and result are
+        like traceable_prefix_adder.
+    '''
+    # low -> high significant bits
+    a = a[::-1]
+    b = b[::-1]
+
+    result = [XOR_GATE(x, y).execute() for x, y in zip(a[:approximateBits], b[:approximateBits])]
+    a = a[approximateBits:]
+    b = b[approximateBits:]
+    if blockSize is None:
+        blockSize = max(1, round(len(a) ** 0.5))
+
+    sums, carry = ripple_add(a[:blockSize], b[:blockSize])
+    result.extend(sums)
+    for start in range(blockSize, len(a), blockSize):
+        x, y = a[start:start + blockSize], b[start:start + blockSize]
+
+        # first bit for a carry in of 0 and of 1
+        propagate = XOR_GATE(x[0], y[0]).execute()
+        sums0, carry0 = ripple_add(x[1:], y[1:], AND_GATE(x[0], y[0]).execute())
+        sums1, carry1 = ripple_add(x[1:], y[1:], OR_GATE(x[0], y[0]).execute())
+        sums0 = [propagate] + sums0
+        sums1 = [NOT_GATE(propagate).execute()] + sums1
+
+        notCarry = NOT_GATE(carry).execute()
+        for sum0, sum1 in zip(sums0, sums1):
+            result.append(OR_GATE(AND_GATE(carry, sum1).execute(), AND_GATE(notCarry, sum0).execute()).execute())
+        if start + blockSize < len(a) or carryOut:
+            carry = OR_GATE(carry0, AND_GATE(carry, carry1).execute()).execute()
+    if carryOut and carry is not None:
+        result.append(carry)
+
+    result.reverse()
+    return result
+
+# adders selectable in MAC_unit, called with (a, b, approximateBits=...)
+ADDERS = {"kogge_stone": functools.partial(traceable_prefix_adder, network="kogge_stone"),
+          "brent_kung": functools.partial(traceable_prefix_adder, network="brent_kung"),
+          "sklansky": functools.partial(traceable_prefix_adder, network="sklansky"),
+          "carry_select": traceable_carry_select_adder}
+MAC_ADDERS = ["ripple"] + list(ADDERS)
+
+@traceable
+def MAC_unit(a:list[Register],b:list[Register],c:list[Register], mult4x4_low=traceable_multiply4x4_exact, mult4x4_mid=traceable_multiply4x4_exact, mult4x4_high=traceable_multiply4x4_exact, ApproximateAdder=True, adder="ripple"):
     product = mult8x8_from4x4(a,b,mult4x4_low=mult4x4_low, mult4x4_mid=mult4x4_mid, mult4x4_high=mult4x4_high)
 
-    mac_result = traceable16x16_adder(product, c, approximate=ApproximateAdder)
+    # the accumulator is the ripple carry traceable16x16_adder or one of ADDERS
+    if adder == "ripple":
+        mac_result = traceable16x16_adder(product, c, approximate=ApproximateAdder)
+    elif adder in ADDERS:
+        mac_result = ADDERS[adder](product, c, approximateBits=8 if ApproximateAdder else 0)
+    else:
+        raise Exception(f"ERROR: Unknown adder {adder}, expected one of {MAC_ADDERS}!")
 
     return mac_result
 
@@ -703,7 +1227,7 @@ def add_OUT_layer(results):
     return results
 
 # Wrapper class for the four different approximate levels of our circuit
-def MAC_Wrap(a:int, b:int, c:int, mult4x4_low=traceable_multiply4x4_exact, mult4x4_mid=traceable_multiply4x4_exact, mult4x4_high=traceable_multiply4x4_exact, ApproximateAdder=True):
+def MAC_Wrap(a:int, b:int, c:int, mult4x4_low=traceable_multiply4x4_exact, mult4x4_mid=traceable_multiply4x4_exact, mult4x4_high=traceable_multiply4x4_exact, ApproximateAdder=True, adder="ripple"):
     Gate.reset()
     Register.reset()
     labelLists = {
@@ -717,50 +1241,140 @@ def MAC_Wrap(a:int, b:int, c:int, mult4x4_low=traceable_multiply4x4_exact, mult4
     a = NumToBinRegisters(a, 8)
     b = NumToBinRegisters(b, 8)
     c = NumToBinRegisters(c, 16)
-    result = MAC_unit(a,b,c,mult4x4_low=mult4x4_low,mult4x4_mid=mult4x4_mid,mult4x4_high=mult4x4_high,ApproximateAdder=ApproximateAdder)
+    result = MAC_unit(a,b,c,mult4x4_low=mult4x4_low,mult4x4_mid=mult4x4_mid,mult4x4_high=mult4x4_high,ApproximateAdder=ApproximateAdder, adder=adder)
     Gate.reset()
     Register.reset()
     return BinRegistersToNum(result)
 
+# Builds the MAC circuit including its OUT layer and leaves it registered, so it can be exported by CircuitConfig
+# hierarchical instantiates the 4x4 multipliers as modules instead of flattening their gates
+def MAC_Circuit(a:int, b:int, c:int, mult4x4_low=traceable_multiply4x4_exact, mult4x4_mid=traceable_multiply4x4_exact, mult4x4_high=traceable_multiply4x4_exact, ApproximateAdder=True, adder="ripple", hierarchical=False) -> list[Register]:
+    Gate.reset()
+    Register.reset()
+    if hierarchical:
+        mult4x4_low, mult4x4_mid, mult4x4_high = Module.wrap(mult4x4_low), Module.wrap(mult4x4_mid), Module.wrap(mult4x4_high)
+    a = NumToBinRegisters(a, 8)
+    b = NumToBinRegisters(b, 8)
+    c = NumToBinRegisters(c, 16)
+    result = MAC_unit(a,b,c,mult4x4_low=mult4x4_low,mult4x4_mid=mult4x4_mid,mult4x4_high=mult4x4_high,ApproximateAdder=ApproximateAdder, adder=adder)
+    return add_OUT_layer(result)
+
 # Helper class for exporting circuit as a config readable by the compiler
 
 
 class CircuitConfig():
 
-    def __init__(self):
-        self.input_registers = [reg.getLabel() for reg in Register.inputRegisters]
+    def __init__(self, isModule: bool=False):
+        # bodies of modules keep all inputs, so the inputs of their instances stay in order
+        self.isModule = isModule
         try:
-            useless_inputs = [reg.getLabel() for reg in Register.freeRegistersAfter[0]]
+            useless_inputs = [] if isModule else Register.freeRegistersAfter[0]
         except Exception:
             useless_inputs = []
-        print(f"Removing useless Input: {useless_inputs}")
-        if len(useless_inputs) > 0:
-            for useless_input in useless_inputs:
-                self.input_registers.remove(useless_input)
-        self.stages = []
-        for stage in Gate.usedGates.keys():
-            try:
-                freeRegisters = [register for register in Register.freeRegistersAfter[stage] if not (register.getLabel() in output_labels)]
-            except Exception:
-                freeRegisters = []
-
-            self.stages.append({"gates": [gate.to_json_dict() for gate in Gate.usedGates[stage]],
-                                "free_registers_after_stage": [reg.getLabel() for reg in freeRegisters]})
-            
+        if not isModule:
+            print(f"Removing useless Input: {[reg.getLabel() for reg in useless_inputs]}")
+        self.inputRegisters = [reg for reg in Register.inputRegisters if not reg in useless_inputs]
+        self.input_registers = [reg.getLabel() for reg in self.inputRegisters]
+        self.modules = netlist_io.used_modules(Module.library, {gate.module for gates in Gate.usedGates.values() for gate in gates if gate.getGateLabel() == "INST"})
+
+    def iterStageRegisters(self):
+        # generates (gates, registers freed after stage) one stage at a time
+        # registers read by OUT gates hold the results and are never freed, inputs of modules belong to the caller
+        outputRegisters = set(self.inputRegisters) if self.isModule else set()
+        for gate in Gate.usedGates.get(Gate.outGatesID, []):
+            outputRegisters.update(gate.getInputs())
+            outputRegisters.add(gate.getOutput())
+
+        for stage, gates in Gate.usedGates.items():
+            freeRegisters = [register for register in Register.freeRegistersAfter.get(stage, []) if not register in outputRegisters]
+            yield gates, freeRegisters
+
+    def iterStages(self):
+        # generates the stages one by one, so they can be written without holding the whole config in memory
+        for gates, freeRegisters in self.iterStageRegisters():
+            yield {"gates": [gate.to_json_dict() for gate in gates],
+                   "free_registers_after_stage": [reg.getLabel() for reg in freeRegisters]}
+
+    def toNetlist(self) -> netlist_io.Netlist:
+        '''
+            converts the live circuit into integer indexed gate tables that can be compiled directly (see compiler.compile_netlist)
+
+            signal ids are assigned to the Register objects themselves, labels are only kept to look up outputs by name
+        '''
+        signal_ids = {reg: index for index, reg in enumerate(self.inputRegisters)}
+        labels = list(self.input_registers)
+        gate_types = array("B")
+        gate_inputs = array("i")
+        stage_offsets = array("q", [0])
+        free_registers = array("i")
+        free_offsets = array("q", [0])
+        instance_modules = array("i")
+        instance_offsets = array("q", [0])
+        instance_inputs = array("i")
+        module_names = list(self.modules)
+        gate_paths = array("i")
+        path_ids = {"": 0}
+
+        for gates, freeRegisters in self.iterStageRegisters():
+            for gate in gates:
+                inputs = [signal_ids[reg] for reg in gate.getInputs()]
+                gate_types.append(netlist_io.GATE_CODES[gate.getGateLabel()])
+                gate_paths.append(path_ids.setdefault(gate.path, len(path_ids)))
+                if gate.getGateLabel() == "INST":
+                    gate_inputs.extend([len(instance_modules), netlist_io.NO_SIGNAL])
+                    instance_modules.append(module_names.index(gate.module))
+                    instance_inputs.extend(inputs)
+                    instance_offsets.append(len(instance_inputs))
+                    for reg in gate.outputs:
+                        signal_ids[reg] = len(labels)
+                        labels.append(reg.getLabel())
+                    continue
+                inputs.extend([netlist_io.NO_SIGNAL] * (2 - len(inputs)))
+                gate_inputs.extend(inputs)
+                signal_ids[gate.getOutput()] = len(labels)
+                labels.append(gate.name)
+            free_registers.extend(signal_ids[reg] for reg in freeRegisters)
+            stage_offsets.append(len(gate_types))
+            free_offsets.append(len(free_registers))
+
+        netlist = netlist_io.Netlist(labels, len(self.inputRegisters),
+                                     np.frombuffer(gate_types, dtype=np.uint8),
+                                     np.frombuffer(gate_inputs, dtype=np.int32).reshape(-1, 2),
+                                     np.frombuffer(stage_offsets, dtype=np.int64),
+                                     np.frombuffer(free_registers, dtype=np.int32),
+                                     np.frombuffer(free_offsets, dtype=np.int64),
+                                     np.frombuffer(instance_modules, dtype=np.int32),
+                                     np.frombuffer(instance_offsets, dtype=np.int64),
+                                     np.frombuffer(instance_inputs, dtype=np.int32),
+                                     module_names, self.modules)
+        if len(path_ids) > 1:
+            netlist.gate_paths = np.frombuffer(gate_paths, dtype=np.int32)
+            netlist.path_names = list(path_ids)
+        netlist.registers = signal_ids
+        return netlist
+
     def createJSONConfig(self):
-        return json.dumps(self, default=lambda o: o.__dict__, indent=4)
-    
+        config = {"input_registers": self.input_registers, "stages": list(self.iterStages())}
+        if self.modules:
+            config["modules"] = netlist_io.labelled_modules(self.modules)
+        return json.dumps(config, indent=4)
+
     def writeToFile(path="config.json"):
-        json_string = CircuitConfig().createJSONConfig()
-        try:
-            with open('path', 'x') as f:
-                f.write(json_string)
-        except Exception:
-            with open('path', 'w') as f:
-                f.write(json_string)
+        # format is chosen by file extension (.json, .jsonl or .npz), see netlist_io
+        config = CircuitConfig()
+        if path.endswith(".npz"):
+            config.toNetlist().save(path)
+            return
+        netlist_io.write_config(path, config.input_registers, config.iterStages(), config.modules)
 
 # Circuits
-exactAdder_exactMultiplier = lambda a,b,c: MAC_Wrap(a,b,c, mult4x4_low=traceable_multiply4x4_exact, mult4x4_mid=traceable_multiply4x4_exact, mult4x4_high=traceable_multiply4x4_exact, ApproximateAdder=False)
-exactAdder_approxMultiplier = lambda a,b,c: MAC_Wrap(a,b,c, mult4x4_low=traceable_multiply4x4_M2, mult4x4_mid=traceable_multiply4x4_M1, mult4x4_high=traceable_multiply4x4_exact, ApproximateAdder=False)
-approxAdder_exactMultiplier = lambda a,b,c: MAC_Wrap(a,b,c, mult4x4_low=traceable_multiply4x4_exact, mult4x4_mid=traceable_multiply4x4_exact, mult4x4_high=traceable_multiply4x4_exact, ApproximateAdder=True)
-approxAdder_approxMultiplier = lambda a,b,c: MAC_Wrap(a,b,c, mult4x4_low=traceable_multiply4x4_M2, mult4x4_mid=traceable_multiply4x4_M1, mult4x4_high=traceable_multiply4x4_exact, ApproximateAdder=True)
\ No newline at end of file
+MAC_variants = {
+    "exactAdder_exactMultiplier": {"mult4x4_low": traceable_multiply4x4_exact, "mult4x4_mid": traceable_multiply4x4_exact, "mult4x4_high": traceable_multiply4x4_exact, "ApproximateAdder": False},
+    "exactAdder_approxMultiplier": {"mult4x4_low": traceable_multiply4x4_M2, "mult4x4_mid": traceable_multiply4x4_M1, "mult4x4_high": traceable_multiply4x4_exact, "ApproximateAdder": False},
+    "approxAdder_exactMultiplier": {"mult4x4_low": traceable_multiply4x4_exact, "mult4x4_mid": traceable_multiply4x4_exact, "mult4x4_high": traceable_multiply4x4_exact, "ApproximateAdder": True},
+    "approxAdder_approxMultiplier": {"mult4x4_low": traceable_multiply4x4_M2, "mult4x4_mid": traceable_multiply4x4_M1, "mult4x4_high": traceable_multiply4x4_exact, "ApproximateAdder": True},
+}
+exactAdder_exactMultiplier = lambda a,b,c: MAC_Wrap(a,b,c, **MAC_variants["exactAdder_exactMultiplier"])
+exactAdder_approxMultiplier = lambda a,b,c: MAC_Wrap(a,b,c, **MAC_variants["exactAdder_approxMultiplier"])
+approxAdder_exactMultiplier = lambda a,b,c: MAC_Wrap(a,b,c, **MAC_variants["approxAdder_exactMultiplier"])
+approxAdder_approxMultiplier = lambda a,b,c: MAC_Wrap(a,b,c, **MAC_variants["approxAdder_approxMultiplier"])
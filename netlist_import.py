@@ -0,0 +1,405 @@
+#!/usr/bin/env python3
+"""
+Import of gate-level benchmark circuits in the BLIF and AIGER (ASCII .aag, binary .aig) formats
+
+    python netlist_import.py adder.blif --out adder.npz
+    python netlist_import.py multiplier.aig --out multiplier.jsonl --parallelism 2
+    python cli.py compile multiplier.aig --out out/multiplier.txt --parallelism 2
+
+The files are read line by line (the AND section of binary AIGER is decoded with numpy) and the gates
+are built as integer tables, no Gate/Register objects are created and nothing recurses, so circuits with
+millions of nodes can be imported. Only combinational circuits are supported (no latches or subcircuits).
+
+Every node is mapped to the gate types of the compiler:
+
+    AIGER AND     AND of two signals, a complemented input becomes a NOT gate (shared by all readers)
+                  and an AND of two complemented inputs becomes an inverted OR (De Morgan)
+    BLIF .names   sum of products cover: AND of the literals of every cube, OR of the cubes, inverted for
+                  covers of the off-set. Covers of a parity function (all 2^(n-1) minterms with an odd or
+                  even number of ones) become XOR gates
+
+Inversions are kept as the polarity of a signal and only turned into NOT gates where a signal is read
+inverted, structurally equal gates are created once and gates no output depends on are removed.
+Constant outputs are read from inputs CONST0/CONST1 (one per output). The gates are placed into stages
+by netlist_io.schedule_gates with at most --parallelism gates per stage.
+"""
+
+import argparse
+import itertools
+
+import numpy as np
+
+import netlist_io
+
+OR = netlist_io.GATE_CODES["OR"]
+AND = netlist_io.GATE_CODES["AND"]
+XOR = netlist_io.GATE_CODES["XOR"]
+NOT = netlist_io.GATE_CODES["NOT"]
+
+FORMATS = (".blif", ".aag", ".aig")
+
+# literals like in AIGER: 2 * node + inverted, node 0 is the constant 0 and node n > 0 is signal n - 1
+FALSE = 0
+TRUE = 1
+
+
+class GateBuilder():
+    '''
+        flat circuit built from literals, every gate is created once per type and inputs
+
+        labels: label of every input and gate signal
+        gate_types, gate_inputs: gates in topological order, gate g creates signal num_inputs + g
+    '''
+    def __init__(self, input_labels: list[str]):
+        self.labels = [str(label) for label in input_labels]
+        self.num_inputs = len(self.labels)
+        self.gate_types = []
+        self.gate_inputs = []
+        self.structure = {}     # (type, inputs) : signal
+
+    def input(self, index: int) -> int:
+        return 2 * (index + 1)
+
+    def gate(self, code: int, inputs: list[int], label: str) -> int:
+        # literal of a gate reading signals
+        key = (code, *inputs)
+        signal = self.structure.get(key)
+        if signal is None:
+            signal = len(self.labels)
+            self.structure[key] = signal
+            self.labels.append(label)
+            self.gate_types.append(code)
+            self.gate_inputs.append(inputs)
+        return 2 * (signal + 1)
+
+    def signal(self, literal: int) -> int:
+        # signal holding the value of a literal that is not constant, an inverted literal is read through a NOT gate
+        signal = (literal >> 1) - 1
+        if literal & 1:
+            signal = (self.gate(NOT, [signal], f"{self.labels[signal]}$n") >> 1) - 1
+        return signal
+
+    def and2(self, a: int, b: int, label: str) -> int:
+        a, b = min(a, b), max(a, b)
+        if a == FALSE or a == b ^ 1:
+            return FALSE
+        if a == TRUE or a == b:
+            return b
+        if a & 1 and b & 1:
+            return self.gate(OR, [(a >> 1) - 1, (b >> 1) - 1], label) ^ 1
+        return self.gate(AND, [self.signal(a), self.signal(b)], label)
+
+    def or2(self, a: int, b: int, label: str) -> int:
+        return self.and2(a ^ 1, b ^ 1, label) ^ 1
+
+    def xor2(self, a: int, b: int, label: str) -> int:
+        a, b = min(a, b), max(a, b)
+        if a <= TRUE:
+            return b ^ a
+        if a == b or a == b ^ 1:
+            return (a ^ b) & 1
+        return self.gate(XOR, [(a >> 1) - 1, (b >> 1) - 1], label) ^ ((a ^ b) & 1)
+
+    def reduce(self, operation, literals: list[int], label: str, empty: int) -> int:
+        # balanced tree of a two input operation, the last gate is labelled label
+        if len(literals) == 0:
+            return empty
+        level = 0
+        while len(literals) > 1:
+            pairs = [(literals[i], literals[i + 1]) for i in range(0, len(literals) - 1, 2)]
+            last = len(literals) == 2
+            reduced = [operation(a, b, label if last else f"{label}${level}_{i}") for i, (a, b) in enumerate(pairs)]
+            literals = reduced + literals[len(pairs) * 2:]
+            level = level + 1
+        return literals[0]
+
+    def netlist(self, outputs: list[int], output_labels: list[str], maxGatesPerStage: int=1) -> netlist_io.Netlist:
+        '''
+            removes gates no output depends on and schedules the circuit
+
+            expects:
+                outputs: literal of every output
+                output_labels: label of every OUT gate
+        '''
+        # every output is read from its own memristor, so signals read by several outputs are copied by two NOT gates
+        signals = []
+        read = set()
+        constants = []      # output index, value
+        for index, literal in enumerate(outputs):
+            if literal <= TRUE:
+                constants.append((index, literal))
+                signals.append(None)
+                continue
+            signal = self.signal(literal)
+            if signal in read:
+                self.labels.append(f"{output_labels[index]}_inverted")
+                self.gate_types.append(NOT)
+                self.gate_inputs.append([signal])
+                self.labels.append(f"{output_labels[index]}_copy")
+                self.gate_types.append(NOT)
+                self.gate_inputs.append([len(self.labels) - 2])
+                signal = len(self.labels) - 1
+            read.add(signal)
+            signals.append(signal)
+        num_gates = len(self.gate_types)
+
+        live = bytearray(self.num_inputs + num_gates)
+        for signal in signals:
+            if signal is not None:
+                live[signal] = 1
+        for gate in range(num_gates - 1, -1, -1):
+            if live[self.num_inputs + gate]:
+                for signal in self.gate_inputs[gate]:
+                    live[signal] = 1
+
+        # constant inputs follow the inputs, the kept gates follow the constants
+        num_inputs = self.num_inputs + len(constants)
+        renumber = list(range(self.num_inputs)) + [0] * num_gates
+        kept = [gate for gate in range(num_gates) if live[self.num_inputs + gate]]
+        for position, gate in enumerate(kept):
+            renumber[self.num_inputs + gate] = num_inputs + position
+        labels = self.labels[:self.num_inputs] + [f"CONST{value}" for _, value in constants] + [self.labels[self.num_inputs + gate] for gate in kept]
+        for position, (index, _) in enumerate(constants):
+            signals[index] = self.num_inputs + position
+        return netlist_io.schedule_gates(labels, num_inputs, [self.gate_types[gate] for gate in kept],
+                                         [[renumber[signal] for signal in self.gate_inputs[gate]] for gate in kept],
+                                         [signals[index] if outputs[index] <= TRUE else renumber[signals[index]] for index in range(len(outputs))],
+                                         output_labels, maxGatesPerStage)
+
+
+def topological_order(dependencies: list[list[int]], num_nodes: int) -> list[int]:
+    # nodes ordered so every node follows the nodes it depends on, without recursion
+    order = []
+    state = bytearray(num_nodes)    # 0 unvisited, 1 on the stack, 2 ordered
+    for root in range(num_nodes):
+        if state[root]:
+            continue
+        stack = [(root, 0)]
+        state[root] = 1
+        while len(stack) > 0:
+            node, position = stack[-1]
+            if position < len(dependencies[node]):
+                stack[-1] = (node, position + 1)
+                dependency = dependencies[node][position]
+                if state[dependency] == 0:
+                    state[dependency] = 1
+                    stack.append((dependency, 0))
+                elif state[dependency] == 1:
+                    raise Exception("ERROR: The circuit contains a combinational loop!")
+                continue
+            stack.pop()
+            state[node] = 2
+            order.append(node)
+    return order
+
+
+# BLIF
+
+def blif_lines(path: str):
+    # logical lines of a BLIF file without comments, continued lines (ending in \) are joined
+    with open(path) as f:
+        pending = ""
+        for line in f:
+            line = line.split("#", 1)[0].rstrip()
+            if line.endswith("\\"):
+                pending = pending + line[:-1] + " "
+                continue
+            line = (pending + line).strip()
+            pending = ""
+            if line:
+                yield line
+        if pending.strip():
+            yield pending.strip()
+
+def read_blif(path: str, maxGatesPerStage: int=1) -> netlist_io.Netlist:
+    '''
+        imports the first model of a BLIF file
+
+        returns:
+            Netlist with the inputs and outputs of the model, outputs are labelled by their names
+    '''
+    inputs = []
+    outputs = []
+    nodes = {}      # name : index of the .names defining it
+    covers = []     # (input names, output name, cube rows) of every .names
+    lines = blif_lines(path)
+    for line in lines:
+        tokens = line.split()
+        command = tokens[0]
+        if command.startswith("."):
+            if command == ".inputs":
+                inputs.extend(tokens[1:])
+            elif command == ".outputs":
+                outputs.extend(tokens[1:])
+            elif command == ".names":
+                nodes[tokens[-1]] = len(covers)
+                covers.append((tokens[1:-1], tokens[-1], []))
+            elif command in (".latch", ".subckt", ".gate", ".mlatch"):
+                raise Exception(f"ERROR: {command} is not supported, only combinational models without subcircuits can be imported!")
+            elif command in (".end", ".exdc"):
+                break
+            continue
+        if len(covers) == 0:
+            raise Exception(f"ERROR: Cube '{line}' outside of a .names!")
+        covers[-1][2].append(tokens)
+
+    input_ids = {name: index for index, name in enumerate(inputs)}
+    for index, (cover_inputs, name, _) in enumerate(covers):
+        for input_name in cover_inputs:
+            if input_name not in input_ids and input_name not in nodes:
+                raise Exception(f"ERROR: Signal {input_name} read by {name} is never defined!")
+    dependencies = [[nodes[input_name] for input_name in cover_inputs if input_name not in input_ids] for cover_inputs, _, _ in covers]
+
+    builder = GateBuilder(inputs)
+    literals = {name: builder.input(index) for index, name in enumerate(inputs)}
+    for index in topological_order(dependencies, len(covers)):
+        cover_inputs, name, rows = covers[index]
+        literals[name] = cover_literal(builder, [literals[input_name] for input_name in cover_inputs], rows, name)
+
+    for name in outputs:
+        if name not in literals:
+            raise Exception(f"ERROR: Output {name} is never defined!")
+    return builder.netlist([literals[name] for name in outputs], outputs, maxGatesPerStage)
+
+def cover_literal(builder: GateBuilder, inputs: list[int], rows: list[list[str]], name: str) -> int:
+    # literal of a sum of products cover, rows are (cube, output value) or (output value) without inputs
+    if len(rows) == 0:
+        return FALSE
+    value = rows[0][-1]
+    if any(row[-1] != value for row in rows):
+        raise Exception(f"ERROR: Cover of {name} mixes on-set and off-set cubes!")
+    inverted = TRUE if value == "0" else FALSE
+    if len(inputs) == 0:
+        return TRUE ^ inverted
+    cubes = [row[0] for row in rows]
+
+    # parity functions: all minterms with an odd (XOR) or an even (XNOR) number of ones
+    if len(inputs) >= 2 and len(cubes) == 2**(len(inputs) - 1) and all("-" not in cube for cube in cubes):
+        parities = {cube.count("1") % 2 for cube in cubes}
+        if len(parities) == 1 and len(set(cubes)) == len(cubes):
+            literal = builder.reduce(builder.xor2, inputs, name, FALSE)
+            return literal ^ (1 - parities.pop()) ^ inverted
+
+    products = []
+    for position, cube in enumerate(cubes):
+        factors = [literal if bit == "1" else literal ^ 1 for literal, bit in zip(inputs, cube) if bit != "-"]
+        products.append(builder.reduce(builder.and2, factors, f"{name}$c{position}" if len(cubes) > 1 else name, TRUE))
+    return builder.reduce(builder.or2, products, name, FALSE) ^ inverted
+
+
+# AIGER
+
+def decode_numbers(data: np.ndarray, count: int) -> tuple[np.ndarray, int]:
+    '''
+        decodes count unsigned numbers of 7 bits per byte (least significant first, the last byte of a
+        number has the highest bit cleared), as the AND gates of binary AIGER are stored
+
+        returns:
+            numbers, number of bytes they take
+    '''
+    if count == 0:
+        return np.empty(0, dtype=np.int64), 0
+    ends = np.flatnonzero(data < 128)[:count]
+    if len(ends) < count:
+        raise Exception("ERROR: Binary AIGER file ends inside of its AND gates!")
+    size = int(ends[-1]) + 1
+    starts = np.concatenate([[0], ends[:-1] + 1])
+    groups = np.repeat(np.arange(count), ends - starts + 1)
+    shifts = 7 * (np.arange(size) - starts[groups])
+    return np.add.reduceat((data[:size] & 127).astype(np.int64) << shifts, starts), size
+
+def read_aiger(path: str, maxGatesPerStage: int=1) -> netlist_io.Netlist:
+    '''
+        imports an AIGER file, ASCII (aag) or binary (aig)
+
+        returns:
+            Netlist with the inputs and outputs named by the symbol table, by default i<k> and o<k>
+    '''
+    with open(path, "rb") as f:
+        header = f.readline().split()
+        if len(header) < 6 or header[0] not in (b"aag", b"aig"):
+            raise Exception(f"ERROR: {path} is not an AIGER file!")
+        binary = header[0] == b"aig"
+        max_var, num_inputs, num_latches, num_outputs, num_ands = [int(token) for token in header[1:6]]
+        if num_latches > 0 or any(int(token) > 0 for token in header[6:]):
+            raise Exception("ERROR: Only combinational AIGER files (without latches and properties) can be imported!")
+
+        if binary:
+            input_literals = 2 * np.arange(1, num_inputs + 1, dtype=np.int64)
+        else:
+            input_literals = np.array([int(line) for line in itertools.islice(f, num_inputs)], dtype=np.int64)
+        output_literals = [int(line) for line in itertools.islice(f, num_outputs)]
+        if binary:
+            data = np.frombuffer(f.read(), dtype=np.uint8)
+            deltas, size = decode_numbers(data, 2 * num_ands)
+            lhs = 2 * (num_inputs + 1 + np.arange(num_ands, dtype=np.int64))
+            rhs0 = lhs - deltas[0::2]
+            rhs1 = rhs0 - deltas[1::2]
+            symbols = data[size:].tobytes().splitlines()
+        else:
+            ands = np.array(b" ".join(itertools.islice(f, num_ands)).split(), dtype=np.int64).reshape(-1, 3)
+            lhs, rhs0, rhs1 = ands[:, 0], ands[:, 1], ands[:, 2]
+            symbols = f.read().splitlines()
+
+    input_labels = [f"i{index}" for index in range(num_inputs)]
+    output_labels = [f"o{index}" for index in range(num_outputs)]
+    for line in symbols:
+        if line.startswith(b"c"):
+            break
+        if not line.strip():
+            continue
+        kind, name = line.split(b" ", 1)
+        if kind[:1] == b"i":
+            input_labels[int(kind[1:])] = name.decode()
+        elif kind[:1] == b"o":
+            output_labels[int(kind[1:])] = name.decode()
+
+    # the AND gates of ASCII files can be in any order
+    nodes = np.full(max_var + 1, -1, dtype=np.int64)
+    nodes[lhs >> 1] = np.arange(num_ands)
+    if len(lhs) > 0 and not (np.all(nodes[rhs0 >> 1] < nodes[lhs >> 1]) and np.all(nodes[rhs1 >> 1] < nodes[lhs >> 1])):
+        dependencies = [[int(node) for node in (nodes[r0 >> 1], nodes[r1 >> 1]) if node >= 0] for r0, r1 in zip(rhs0.tolist(), rhs1.tolist())]
+        order = np.array(topological_order(dependencies, num_ands), dtype=np.int64)
+        lhs, rhs0, rhs1 = lhs[order], rhs0[order], rhs1[order]
+
+    builder = GateBuilder(input_labels)
+    literals = [FALSE] * (max_var + 1)     # AIGER variable : literal of the builder
+    for index, literal in enumerate(input_literals.tolist()):
+        literals[literal >> 1] = builder.input(index)
+    for l, r0, r1 in zip(lhs.tolist(), rhs0.tolist(), rhs1.tolist()):
+        literals[l >> 1] = builder.and2(literals[r0 >> 1] ^ (r0 & 1), literals[r1 >> 1] ^ (r1 & 1), f"n{l >> 1}")
+    return builder.netlist([literals[literal >> 1] ^ (literal & 1) for literal in output_literals], output_labels, maxGatesPerStage)
+
+
+def import_netlist(path: str, maxGatesPerStage: int=1) -> netlist_io.Netlist:
+    '''
+        imports a BLIF or AIGER file, the format is chosen by the file extension (.blif, .aag or .aig)
+    '''
+    if path.endswith(".blif"):
+        return read_blif(path, maxGatesPerStage)
+    if path.endswith((".aag", ".aig")):
+        return read_aiger(path, maxGatesPerStage)
+    raise Exception(f"ERROR: Unknown netlist format of {path}, expected one of {FORMATS}!")
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(description="Import a BLIF or AIGER circuit as circuit config")
+    parser.add_argument("netlist", help="circuit file (.blif, .aag or .aig)")
+    parser.add_argument("--out", default=None, help="config file (.json, .jsonl or .npz)")
+    parser.add_argument("--parallelism", type=int, default=1, help="maximal number of gates per stage")
+    args = parser.parse_args(argv)
+
+    netlist = import_netlist(args.netlist, args.parallelism)
+    if args.out is not None:
+        if args.out.endswith(".npz"):
+            netlist.save(args.out)
+        else:
+            netlist_io.write_config(args.out, netlist.input_registers(), netlist.labelled_stages())
+        print(f"Configuration file '{args.out}' has been created.")
+    counts = np.bincount(np.asarray(netlist.gate_types), minlength=len(netlist_io.GATE_TYPES))
+    print(f"inputs: {netlist.num_inputs}")
+    print(f"outputs: {netlist.num_outputs()}")
+    print(f"stages: {netlist.num_stages()}")
+    print(f"gates: {({label: int(count) for label, count in zip(netlist_io.GATE_TYPES, counts)})}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,564 @@
+import json
+from array import array
+
+import numpy as np
+
+# Formats of circuit configs
+#
+#   .json   {"input_registers": [...], "stages": [...]} written without indentation, read as a whole
+#   .jsonl  first line {"input_registers": [...]}, then one stage per line, read stage by stage
+#   .npz    integer indexed gate tables, see Netlist
+#   .blif, .aag, .aig   gate-level benchmark circuits, imported and scheduled when read (see netlist_import)
+#
+# A stage always is {"gates": [{"type", "name", "inputs"}, ...], "free_registers_after_stage": [...]}
+# in the JSON formats. Inside of the compiler every value is identified by an integer signal id:
+# inputs are numbered first, every gate creates the next signal id in stage order.
+#
+# Hierarchical circuits instantiate modules: {"type": "INST", "module", "inputs", "outputs"} creates
+# one signal per output of the module. The bodies of the modules are circuits of their own, listed in
+# "modules": {name: {"input_registers", "stages"}} of the JSON header, before any module instantiating
+# them. OUT gates of a body mark its outputs, inputs of a body are never freed.
+
+GATE_TYPES = ["OR", "AND", "XOR", "NOT", "OUT", "INST"] # position is the type code of a gate
+GATE_CODES = {label: code for code, label in enumerate(GATE_TYPES)}
+OUT_CODE = GATE_CODES["OUT"]
+INST_CODE = GATE_CODES["INST"]
+
+NO_SIGNAL = -1
+
+
+class Netlist():
+    '''
+        circuit config as integer indexed gate tables
+
+        labels: label of every signal, inputs first, followed by the outputs of all gates
+        num_inputs: number of input signals
+        gate_types: type code of every gate, gates are ordered by stage
+        gate_inputs: (gates, 2) signal ids of the gate inputs, NO_SIGNAL for unused inputs
+        stage_offsets: gates of stage s are gate_types[stage_offsets[s]:stage_offsets[s+1]]
+        free_registers: signal ids that can be freed after each stage
+        free_offsets: signals freed after stage s are free_registers[free_offsets[s]:free_offsets[s+1]]
+        instance_modules: module of every instance as index into module_names
+        instance_offsets: inputs of instance i are instance_inputs[instance_offsets[i]:instance_offsets[i+1]]
+        instance_inputs: input signal ids of all instances
+        module_names: names of the modules instantiated by this netlist
+        modules: module name : Netlist of its body, one library shared by a netlist and all of its modules
+        gate_paths: optional call path of every gate as index into path_names (see gates.traceCalls)
+        path_names: call paths like "MAC_unit/mult8x8_from4x4", "" for gates outside of traced subcircuits
+
+        An INST gate stores the index of its instance in gate_inputs[g, 0] and creates one signal per
+        output of its module. Without instances the output of gate g is signal num_inputs + g.
+    '''
+    def __init__(self, labels, num_inputs, gate_types, gate_inputs, stage_offsets, free_registers, free_offsets,
+                 instance_modules=None, instance_offsets=None, instance_inputs=None, module_names=None, modules=None,
+                 gate_paths=None, path_names=None):
+        self.labels = labels
+        self.num_inputs = int(num_inputs)
+        self.gate_types = gate_types
+        self.gate_inputs = gate_inputs
+        self.stage_offsets = stage_offsets
+        self.free_registers = free_registers
+        self.free_offsets = free_offsets
+        self.instance_modules = np.empty(0, dtype=np.int32) if instance_modules is None else instance_modules
+        self.instance_offsets = np.zeros(1, dtype=np.int64) if instance_offsets is None else instance_offsets
+        self.instance_inputs = np.empty(0, dtype=np.int32) if instance_inputs is None else instance_inputs
+        self.module_names = [] if module_names is None else [str(name) for name in module_names]
+        self.modules = {} if modules is None else modules
+        self.gate_paths = gate_paths
+        self.path_names = None if path_names is None else [str(name) for name in path_names]
+        self.signal_ids = None
+        self.registers = None       # Register object : signal id, only set for netlists built in memory (see gates.CircuitConfig.toNetlist)
+        self.fragments = {}         # compiled bodies of modules, see compiler.compile_fragment
+        self._gate_signals = None
+
+    def num_stages(self) -> int:
+        return len(self.stage_offsets) - 1
+
+    def num_gates(self) -> int:
+        return len(self.gate_types)
+
+    def num_instances(self) -> int:
+        return len(self.instance_modules)
+
+    def num_outputs(self) -> int:
+        return int(np.count_nonzero(np.asarray(self.gate_types) == OUT_CODE))
+
+    def input_registers(self) -> list[str]:
+        return [str(label) for label in self.labels[:self.num_inputs]]
+
+    def gate_signals(self) -> np.ndarray:
+        # first signal id created by every gate
+        if self._gate_signals is None:
+            widths = np.ones(self.num_gates(), dtype=np.int64)
+            instances = np.flatnonzero(np.asarray(self.gate_types) == INST_CODE)
+            if len(instances) > 0:
+                num_outputs = np.array([self.modules[name].num_outputs() for name in self.module_names], dtype=np.int64)
+                widths[instances] = num_outputs[np.asarray(self.instance_modules)[np.asarray(self.gate_inputs)[instances, 0]]]
+            self._gate_signals = self.num_inputs + np.cumsum(widths) - widths
+        return self._gate_signals
+
+    def paths(self) -> list[str]:
+        # call path of every gate
+        if self.gate_paths is None:
+            return [""] * self.num_gates()
+        return [self.path_names[path] for path in np.asarray(self.gate_paths).tolist()]
+
+    def output_signals(self) -> list[int]:
+        # signals created by OUT gates, for module bodies these are the outputs of the module
+        return self.gate_signals()[np.asarray(self.gate_types) == OUT_CODE].tolist()
+
+    def signal_id(self, label) -> int:
+        # outputs can be looked up by label or, for netlists built in memory, by their Register object
+        if self.registers is not None and not isinstance(label, str):
+            return self.registers[label]
+        if self.signal_ids is None:
+            self.signal_ids = {str(label): index for index, label in enumerate(self.labels)}
+        return self.signal_ids[label]
+
+    def stages(self, block_size: int=4096):
+        '''
+            generator of stages as (gates, free_registers_after_stage) with gates as (type code, input ids, output id)
+            and instances as (INST_CODE, input ids, output ids, module name)
+
+            the tables are converted block_size stages at a time
+        '''
+        instance_modules = [self.module_names[module] for module in np.asarray(self.instance_modules).tolist()]
+        instance_offsets = np.asarray(self.instance_offsets).tolist()
+        instance_inputs = np.asarray(self.instance_inputs).tolist()
+        gate_signals = self.gate_signals()
+
+        for block in range(0, self.num_stages(), block_size):
+            stage_offsets = self.stage_offsets[block:block+block_size+1].tolist()
+            free_offsets = self.free_offsets[block:block+block_size+1].tolist()
+            first_gate, first_free = stage_offsets[0], free_offsets[0]
+            gate_types = self.gate_types[first_gate:stage_offsets[-1]].tolist()
+            gate_inputs = self.gate_inputs[first_gate:stage_offsets[-1]].tolist()
+            signals = gate_signals[first_gate:stage_offsets[-1] + 1].tolist()
+            free_registers = self.free_registers[first_free:free_offsets[-1]].tolist()
+
+            for stage in range(len(stage_offsets) - 1):
+                gates = []
+                for gate in range(stage_offsets[stage] - first_gate, stage_offsets[stage+1] - first_gate):
+                    inputs = gate_inputs[gate]
+                    if gate_types[gate] == INST_CODE:
+                        instance = inputs[0]
+                        module = instance_modules[instance]
+                        outputs = list(range(signals[gate], signals[gate] + self.modules[module].num_outputs()))
+                        gates.append((INST_CODE, instance_inputs[instance_offsets[instance]:instance_offsets[instance+1]], outputs, module))
+                        continue
+                    if inputs[-1] == NO_SIGNAL:
+                        inputs = inputs[:1]
+                    gates.append((gate_types[gate], inputs, signals[gate]))
+
+                yield gates, free_registers[free_offsets[stage] - first_free:free_offsets[stage+1] - first_free]
+
+    def flat_gates(self) -> tuple[list[str], list[int], list[list[int]], list[int], list[str]]:
+        '''
+            gates of a netlist without instances, without OUT gates and numbered so gate g creates signal
+            num_inputs + g, the inverse of schedule_gates
+
+            returns:
+                labels: label of every input and gate signal
+                gate_types: type code of every gate
+                gate_inputs: input signal ids of every gate
+                outputs: signals read by the OUT gates
+                output_labels: labels of the OUT gates
+        '''
+        if self.num_instances() > 0:
+            raise Exception("ERROR: Instances of modules have to be flattened first!")
+        labels = self.input_registers()
+        renumbered = list(range(self.num_inputs))
+        gate_types = []
+        gate_inputs = []
+        outputs = []
+        output_labels = []
+        for gates, _ in self.stages():
+            for code, inputs, output in gates:
+                inputs = [renumbered[signal] for signal in inputs]
+                if code == OUT_CODE:
+                    renumbered.append(inputs[0])
+                    outputs.append(inputs[0])
+                    output_labels.append(str(self.labels[output]))
+                    continue
+                renumbered.append(len(labels))
+                labels.append(str(self.labels[output]))
+                gate_types.append(code)
+                gate_inputs.append(inputs)
+        return labels, gate_types, gate_inputs, outputs, output_labels
+
+    def labelled_stages(self):
+        '''
+            generator of stages in the format of the JSON configs
+        '''
+        paths = iter(self.paths())
+        for gates, free in self.stages():
+            yield {"gates": [labelled_gate(gate, self.labels, next(paths)) for gate in gates],
+                   "free_registers_after_stage": [str(self.labels[i]) for i in free]}
+
+    def evaluate(self, input_values: list) -> list:
+        '''
+            evaluates the circuit, values are 0/1 or numpy arrays of bits to evaluate many input vectors at once
+
+            returns:
+                values of all signals, indexed by signal id
+        '''
+        values = list(input_values)
+        for gates, _ in self.stages():
+            for gate in gates:
+                code, inputs = gate[0], gate[1]
+                if code == INST_CODE:
+                    values.extend(self.modules[gate[3]].evaluate_outputs([values[i] for i in inputs]))
+                elif code == GATE_CODES["OR"]:
+                    values.append(values[inputs[0]] | values[inputs[1]])
+                elif code == GATE_CODES["AND"]:
+                    values.append(values[inputs[0]] & values[inputs[1]])
+                elif code == GATE_CODES["XOR"]:
+                    values.append(values[inputs[0]] ^ values[inputs[1]])
+                elif code == GATE_CODES["NOT"]:
+                    values.append(1 - values[inputs[0]])
+                else:
+                    values.append(values[inputs[0]])
+        return values
+
+    def evaluate_outputs(self, input_values: list) -> list:
+        values = self.evaluate(input_values)
+        return [values[signal] for signal in self.output_signals()]
+
+    def tables(self) -> dict:
+        # gate tables of this netlist without its modules
+        tables = {"labels": np.array(self.labels, dtype=str),
+                  "num_inputs": np.array(self.num_inputs),
+                  "gate_types": np.asarray(self.gate_types, dtype=np.uint8),
+                  "gate_inputs": np.asarray(self.gate_inputs, dtype=np.int32).reshape(-1, 2),
+                  "stage_offsets": np.asarray(self.stage_offsets, dtype=np.int64),
+                  "free_registers": np.asarray(self.free_registers, dtype=np.int32),
+                  "free_offsets": np.asarray(self.free_offsets, dtype=np.int64),
+                  "instance_modules": np.asarray(self.instance_modules, dtype=np.int32),
+                  "instance_offsets": np.asarray(self.instance_offsets, dtype=np.int64),
+                  "instance_inputs": np.asarray(self.instance_inputs, dtype=np.int32),
+                  "module_names": np.array(self.module_names, dtype=str)}
+        if self.gate_paths is not None:
+            tables["gate_paths"] = np.asarray(self.gate_paths, dtype=np.int32)
+            tables["path_names"] = np.array(self.path_names, dtype=str)
+        return tables
+
+    def save(self, path: str) -> None:
+        # bodies of the modules are stored next to the circuit, prefixed by "module<index>_"
+        tables = self.tables()
+        tables["library"] = np.array(list(self.modules), dtype=str)
+        for index, module in enumerate(self.modules.values()):
+            for key, value in module.tables().items():
+                tables[f"module{index}_{key}"] = value
+        np.savez_compressed(path, **tables)
+
+    def from_tables(tables, prefix: str="", modules: dict=None):
+        if prefix + "instance_modules" not in tables:
+            # configs written before modules existed
+            return Netlist(tables[prefix + "labels"], tables[prefix + "num_inputs"], tables[prefix + "gate_types"], tables[prefix + "gate_inputs"],
+                           tables[prefix + "stage_offsets"], tables[prefix + "free_registers"], tables[prefix + "free_offsets"])
+        traced = prefix + "gate_paths" in tables
+        return Netlist(tables[prefix + "labels"], tables[prefix + "num_inputs"], tables[prefix + "gate_types"], tables[prefix + "gate_inputs"],
+                       tables[prefix + "stage_offsets"], tables[prefix + "free_registers"], tables[prefix + "free_offsets"],
+                       tables[prefix + "instance_modules"], tables[prefix + "instance_offsets"], tables[prefix + "instance_inputs"],
+                       tables[prefix + "module_names"].tolist(), modules,
+                       tables[prefix + "gate_paths"] if traced else None, tables[prefix + "path_names"].tolist() if traced else None)
+
+    def load(path: str):
+        # arrays of a npz file are only read when they are accessed
+        data = np.load(path)
+        modules = {}
+        if "library" in data:
+            for index, name in enumerate(data["library"].tolist()):
+                modules[name] = Netlist.from_tables(data, f"module{index}_", modules)
+        return Netlist.from_tables(data, "", modules)
+
+    def from_stages(input_registers: list[str], stages, modules: dict=None):
+        '''
+            builds the gate tables from stages in the format of the JSON configs, consuming them one by one
+
+            modules: module name : Netlist of every module that is instantiated
+        '''
+        labels = list(input_registers)
+        signal_ids = {label: index for index, label in enumerate(labels)}
+        gate_types = array("B")
+        gate_inputs = array("i")
+        stage_offsets = array("q", [0])
+        free_registers = array("i")
+        free_offsets = array("q", [0])
+        instance_modules = array("i")
+        instance_offsets = array("q", [0])
+        instance_inputs = array("i")
+        module_names = []
+        gate_paths = array("i")
+        path_ids = {"": 0}
+
+        for stage in stages:
+            for gate in stage["gates"]:
+                inputs = [signal_ids[label] for label in gate["inputs"]]
+                gate_types.append(GATE_CODES[gate["type"]])
+                gate_paths.append(path_ids.setdefault(gate.get("path", ""), len(path_ids)))
+                if gate["type"] == "INST":
+                    if gate["module"] not in module_names:
+                        module_names.append(gate["module"])
+                    gate_inputs.extend([len(instance_modules), NO_SIGNAL])
+                    instance_modules.append(module_names.index(gate["module"]))
+                    instance_inputs.extend(inputs)
+                    instance_offsets.append(len(instance_inputs))
+                    for label in gate["outputs"]:
+                        signal_ids[label] = len(labels)
+                        labels.append(label)
+                    continue
+                inputs.extend([NO_SIGNAL] * (2 - len(inputs)))
+                gate_inputs.extend(inputs)
+                signal_ids[gate["name"]] = len(labels)
+                labels.append(gate["name"])
+            free_registers.extend(signal_ids[label] for label in stage["free_registers_after_stage"])
+            stage_offsets.append(len(gate_types))
+            free_offsets.append(len(free_registers))
+
+        netlist = Netlist(labels, len(input_registers),
+                          np.frombuffer(gate_types, dtype=np.uint8),
+                          np.frombuffer(gate_inputs, dtype=np.int32).reshape(-1, 2),
+                          np.frombuffer(stage_offsets, dtype=np.int64),
+                          np.frombuffer(free_registers, dtype=np.int32),
+                          np.frombuffer(free_offsets, dtype=np.int64),
+                          np.frombuffer(instance_modules, dtype=np.int32),
+                          np.frombuffer(instance_offsets, dtype=np.int64),
+                          np.frombuffer(instance_inputs, dtype=np.int32),
+                          module_names, modules)
+        if len(path_ids) > 1:
+            netlist.gate_paths = np.frombuffer(gate_paths, dtype=np.int32)
+            netlist.path_names = list(path_ids)
+        netlist.signal_ids = signal_ids
+        return netlist
+
+
+def labelled_gate(gate, labels, path: str="") -> dict:
+    # gate of Netlist.stages in the format of the JSON configs
+    if gate[0] == INST_CODE:
+        labelled = {"type": "INST", "module": gate[3], "inputs": [str(labels[i]) for i in gate[1]], "outputs": [str(labels[i]) for i in gate[2]]}
+    else:
+        labelled = {"type": GATE_TYPES[gate[0]], "name": str(labels[gate[2]]), "inputs": [str(labels[i]) for i in gate[1]]}
+    if path:
+        labelled["path"] = path
+    return labelled
+
+def num_signals(gates) -> int:
+    # number of signals created by the gates of a stage
+    return sum(len(gate[2]) if gate[0] == INST_CODE else 1 for gate in gates)
+
+def used_modules(library: dict, names) -> dict:
+    '''
+        selects the modules instantiated by names and by the modules they instantiate, in the order of library
+    '''
+    used = set()
+    pending = list(names)
+    while len(pending) > 0:
+        name = pending.pop()
+        if name not in used:
+            used.add(name)
+            pending.extend(library[name].module_names)
+    return {name: module for name, module in library.items() if name in used}
+
+def read_modules(modules: dict) -> dict:
+    # module bodies of a JSON header, every body is listed before the modules instantiating it
+    library = {}
+    for name, module in modules.items():
+        library[name] = Netlist.from_stages(module["input_registers"], module["stages"], library)
+    return library
+
+def labelled_modules(modules: dict) -> dict:
+    return {name: {"input_registers": module.input_registers(), "stages": list(module.labelled_stages())}
+            for name, module in modules.items()}
+
+
+def schedule_gates(labels: list[str], num_inputs: int, gate_types: list[int], gate_inputs: list[list[int]], outputs: list[int],
+                   output_labels: list[str]=None, maxGatesPerStage: int=1) -> Netlist:
+    '''
+        places the gates of a flat circuit into stages and determines when their signals can be freed,
+        like gates.Gate and gates.Register do while a circuit is built
+
+        expects:
+            labels: label of every input and gate signal
+            gate_types, gate_inputs: gates without OUT gates in topological order, gate g creates signal num_inputs + g
+            outputs: signals read by the OUT gates, in order
+            output_labels: labels of the OUT gates, by default OUT0, OUT1, ...
+
+        Every gate is placed in the first stage after its inputs that holds less than maxGatesPerStage gates.
+        Signals are freed after the stage of their last use, unused signals after the stage creating them
+        and unused inputs after the first stage. Outputs are never freed, OUT gates form the last stage.
+    '''
+    num_gates = len(gate_types)
+    if output_labels is None:
+        output_labels = [f"OUT{index}" for index in range(len(outputs))]
+
+    # next_stage[s] leads to the first stage >= s that is not full yet
+    stage_of = [0] * (num_inputs + num_gates)
+    next_stage = {}
+    stage_sizes = {}
+    for gate, inputs in enumerate(gate_inputs):
+        stage = max(stage_of[signal] for signal in inputs) + 1
+        path = []
+        while next_stage.get(stage, stage) != stage:
+            path.append(stage)
+            stage = next_stage[stage]
+        for visited in path:
+            next_stage[visited] = stage
+        stage_sizes[stage] = stage_sizes.get(stage, 0) + 1
+        if stage_sizes[stage] >= maxGatesPerStage:
+            next_stage[stage] = stage + 1
+        stage_of[num_inputs + gate] = stage
+
+    # gates ordered by stage, signal ids follow the new order
+    stages, stage_index, stage_sizes = np.unique(np.array(stage_of[num_inputs:], dtype=np.int64), return_inverse=True, return_counts=True)
+    order = np.argsort(stage_index, kind="stable")
+    renumber = np.arange(num_inputs + num_gates, dtype=np.int64)
+    renumber[num_inputs + order] = np.arange(num_inputs, num_inputs + num_gates)
+    padded = np.array([inputs + [NO_SIGNAL] * (2 - len(inputs)) for inputs in gate_inputs], dtype=np.int64).reshape(-1, 2)[order]
+    new_inputs = np.where(padded == NO_SIGNAL, NO_SIGNAL, renumber[padded])
+    new_labels = list(labels[:num_inputs]) + [labels[num_inputs + gate] for gate in order.tolist()]
+    new_stage = np.concatenate([np.zeros(num_inputs, dtype=np.int64), stage_index[order]])
+    outputs = renumber[np.array(outputs, dtype=np.int64)]
+
+    # a signal is freed after the stage of its last use
+    last_use = new_stage.copy()
+    readers = np.broadcast_to(new_stage[num_inputs:, None], new_inputs.shape)
+    used = new_inputs != NO_SIGNAL
+    np.maximum.at(last_use, new_inputs[used], readers[used])
+    freed = np.ones(num_inputs + num_gates, dtype=bool)
+    freed[outputs] = False
+    freed = np.flatnonzero(freed & (last_use < len(stages)))
+    freed = freed[np.argsort(last_use[freed], kind="stable")]
+
+    stage_offsets = np.concatenate([[0], np.cumsum(stage_sizes), [num_gates + len(outputs)]])
+    free_offsets = np.concatenate([[0], np.cumsum(np.bincount(last_use[freed], minlength=len(stages))), [len(freed)]])
+
+    gate_inputs = np.concatenate([new_inputs, np.stack([outputs, np.full(len(outputs), NO_SIGNAL)], axis=1)])
+    return Netlist(new_labels + list(output_labels), num_inputs,
+                   np.concatenate([np.asarray(gate_types, dtype=np.uint8)[order], np.full(len(outputs), OUT_CODE, dtype=np.uint8)]),
+                   gate_inputs.astype(np.int32).reshape(-1, 2),
+                   stage_offsets.astype(np.int64),
+                   freed.astype(np.int32),
+                   free_offsets.astype(np.int64))
+
+
+class StageReader():
+    '''
+        reads stages in the format of the JSON configs lazily and numbers their signals on the fly
+
+        Only labels of signals that are still alive are remembered, labels of freed signals are dropped.
+    '''
+    def __init__(self, input_registers: list[str], stages, modules: dict=None):
+        self.num_inputs = len(input_registers)
+        self.signal_ids = {label: index for index, label in enumerate(input_registers)}
+        self.next_signal = self.num_inputs
+        self.modules = {} if modules is None else modules
+        self.gate_paths = array("i")    # call path of every gate read so far, as index into path_ids
+        self.path_ids = {"": 0}
+        self._input_registers = list(input_registers)
+        self._stages = stages
+
+    def input_registers(self) -> list[str]:
+        return self._input_registers
+
+    def signal_id(self, label: str) -> int:
+        return self.signal_ids[label]
+
+    def labelled_stages(self):
+        return self._stages
+
+    def paths(self) -> list[str]:
+        path_names = list(self.path_ids)
+        return [path_names[path] for path in self.gate_paths]
+
+    def stages(self):
+        signal_ids = self.signal_ids
+        for stage in self._stages:
+            gates = []
+            for gate in stage["gates"]:
+                inputs = [signal_ids[label] for label in gate["inputs"]]
+                self.gate_paths.append(self.path_ids.setdefault(gate.get("path", ""), len(self.path_ids)))
+                if gate["type"] == "INST":
+                    outputs = list(range(self.next_signal, self.next_signal + len(gate["outputs"])))
+                    signal_ids.update(zip(gate["outputs"], outputs))
+                    gates.append((INST_CODE, inputs, outputs, gate["module"]))
+                    self.next_signal = self.next_signal + len(outputs)
+                    continue
+                signal_ids[gate["name"]] = self.next_signal
+                gates.append((GATE_CODES[gate["type"]], inputs, self.next_signal))
+                self.next_signal = self.next_signal + 1
+
+            free = [signal_ids.pop(label) for label in stage["free_registers_after_stage"] if label in signal_ids]
+            yield gates, free
+
+
+def read_lines(path: str):
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+def read_config(path: str, maxGatesPerStage: int=1):
+    '''
+        opens a circuit config, the format is chosen by the file extension
+
+        expects:
+            maxGatesPerStage: gates per stage of imported circuits, configs are already scheduled
+
+        returns:
+            object with input_registers(), signal_id(label) and a stages() generator, see Netlist
+    '''
+    if path.endswith((".blif", ".aag", ".aig")):
+        import netlist_import   # imported here, netlist_import builds on this module
+        return netlist_import.import_netlist(path, maxGatesPerStage)
+    if path.endswith(".npz"):
+        return Netlist.load(path)
+    if path.endswith(".jsonl"):
+        lines = read_lines(path)
+        header = next(lines)
+        return StageReader(header["input_registers"], lines, read_modules(header.get("modules", {})))
+
+    circuit = json.load(open(path))
+    return StageReader(circuit["input_registers"], iter(circuit["stages"]), read_modules(circuit.get("modules", {})))
+
+def load_netlist(path: str, maxGatesPerStage: int=1) -> Netlist:
+    '''
+        reads a circuit config of any format completely into integer indexed gate tables
+    '''
+    circuit = read_config(path, maxGatesPerStage)
+    if isinstance(circuit, Netlist):
+        return circuit
+    return Netlist.from_stages(circuit.input_registers(), circuit.labelled_stages(), circuit.modules)
+
+def write_config(path: str, input_registers: list[str], stages, modules: dict=None) -> None:
+    '''
+        writes a circuit config, the format is chosen by the file extension
+
+        expects:
+            path: path of config file (.json, .jsonl or .npz)
+            input_registers: labels of input registers
+            stages: iterable of stages in the format of the JSON configs, written as they are produced
+            modules: module name : Netlist of every module that is instantiated
+    '''
+    if path.endswith(".npz"):
+        Netlist.from_stages(input_registers, stages, modules).save(path)
+        return
+
+    header = {"input_registers": input_registers}
+    if modules:
+        header["modules"] = labelled_modules(modules)
+
+    with open(path, "w") as f:
+        if path.endswith(".jsonl"):
+            f.write(json.dumps(header, separators=(",", ":")))
+            for stage in stages:
+                f.write("\n")
+                f.write(json.dumps(stage, separators=(",", ":")))
+            return
+
+        f.write(json.dumps(header, separators=(",", ":"))[:-1] + ',"stages":[')
+        for i, stage in enumerate(stages):
+            if i > 0:
+                f.write(",")
+            f.write(json.dumps(stage, separators=(",", ":")))
+        f.write("]}")
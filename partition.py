@@ -0,0 +1,429 @@
+#!/usr/bin/env python3
+"""
+Partitioning of a circuit across several fixed-size memristor arrays
+
+    python partition.py config.npz --arrays 2 --array-size 128 --out out/partitioned
+    python partition.py --circuit mac16x16 --arrays 4 --array-size 256 --parallelism 2 --json partition.json
+
+The gates are split over --arrays arrays of --array-size memristors each, so circuits that need more
+memristors than one array (like a 16x16 MAC) can be compiled, and the arrays compute concurrently:
+
+    1. partition   recursive bisection of the gate graph, every bisection is improved by passes of
+                   Fiduccia-Mattheyses moves (the Kernighan-Lin heuristic for hypergraphs) that
+                   minimise the number of signals read on another array than the one computing them
+    2. schedule    gates are placed in the first stage after their inputs with less than parallelism
+                   gates of their array, a signal read on another array is copied at the barrier
+                   after the stage computing it
+    3. compile     every array is compiled on its own, a copied signal arrives in a memristor
+                   reserved at the barrier and is freed after its last reader on the receiving array
+
+Every array gets its own imply program (<out>_array<k>.txt). All programs run in lockstep: stage s
+starts at the same line in every program (shorter stages are padded with nop), and after the last line
+of a stage the copies of <out>_copies.json are carried out (read the memristor of the source array,
+write the memristor of the destination array). Inputs are loaded into every array reading them.
+"""
+
+import argparse
+import contextlib
+import functools
+import heapq
+import io
+import json
+import os
+
+import numpy as np
+
+import approx_synth
+import compiler
+import gates
+import netlist_io
+
+
+def wide_mac(a: list, b: list, c: list, adder: str="kogge_stone") -> list:
+    # NxN multiply accumulate into a 2N bit accumulator: Dadda multiplier followed by a prefix adder
+    return gates.ADDERS[adder](gates.traceable_dadda_multiplier(a, b), c)
+
+# circuits that can be partitioned from the command line: function building the outputs and widths of its operands
+CIRCUITS = {"mac": (functools.partial(gates.MAC_unit, ApproximateAdder=False), [8, 8, 16]),
+            "mac16x16": (wide_mac, [16, 16, 32]),
+            "dadda16x16": (gates.traceable_dadda_multiplier, [16, 16])}
+
+
+# Partition
+
+def signal_nets(num_inputs: int, gate_inputs: list[list[int]]) -> list[list[int]]:
+    # gates connected by every signal: the gate computing it (if any) followed by its readers
+    nets = [[] for _ in range(num_inputs)] + [[gate] for gate in range(len(gate_inputs))]
+    for gate, inputs in enumerate(gate_inputs):
+        for signal in set(inputs):
+            nets[signal].append(gate)
+    return [net for net in nets if len(net) > 1]
+
+def bisect(nodes: list[int], nets: list[list[int]], fraction: float, tolerance: float=0.05, passes: int=8) -> list[int]:
+    '''
+        splits nodes in two sides by Fiduccia-Mattheyses passes minimising the number of cut nets
+
+        expects:
+            nodes: gate indices in topological order, the initial sides are the first and the rest
+            nets: nets restricted to nodes
+            fraction: share of the nodes on side 0
+
+        returns:
+            side of every node (same order as nodes)
+    '''
+    position = {node: index for index, node in enumerate(nodes)}
+    target = round(len(nodes) * fraction)
+    slack = max(1, round(len(nodes) * tolerance))
+    side = [0 if index < target else 1 for index in range(len(nodes))]
+    local_nets = [[position[node] for node in net] for net in nets]
+    node_nets = [[] for _ in nodes]
+    for index, net in enumerate(local_nets):
+        for node in net:
+            node_nets[node].append(index)
+
+    for _ in range(passes):
+        counts = [[0, 0] for _ in local_nets]
+        for index, net in enumerate(local_nets):
+            for node in net:
+                counts[index][side[node]] += 1
+
+        def gain(node):
+            own = side[node]
+            return sum((counts[net][own] == 1) - (counts[net][1 - own] == 0) for net in node_nets[node])
+
+        gains = [gain(node) for node in range(len(nodes))]
+        heaps = [[], []]    # (-gain, node) of the unlocked nodes of every side, stale entries are skipped
+        for node in range(len(nodes)):
+            heaps[side[node]].append((-gains[node], node))
+        for heap in heaps:
+            heapq.heapify(heap)
+        locked = [False] * len(nodes)
+        size = side.count(0)
+        moves = []
+        total, best, best_moves = 0, 0, 0
+        while True:
+            candidates = []
+            for source, heap in enumerate(heaps):
+                while len(heap) > 0 and (locked[heap[0][1]] or -heap[0][0] != gains[heap[0][1]] or side[heap[0][1]] != source):
+                    heapq.heappop(heap)
+                allowed = size - 1 >= target - slack if source == 0 else size + 1 <= target + slack
+                if len(heap) > 0 and allowed:
+                    candidates.append((heap[0][0], source))
+            if len(candidates) == 0:
+                break
+            _, source = min(candidates)
+            _, node = heapq.heappop(heaps[source])
+
+            total = total + gains[node]
+            locked[node] = True
+            side[node] = 1 - source
+            size = size - 1 if source == 0 else size + 1
+            moves.append(node)
+            for net in node_nets[node]:
+                counts[net][source] -= 1
+                counts[net][1 - source] += 1
+            for net in node_nets[node]:
+                for neighbour in local_nets[net]:
+                    if not locked[neighbour]:
+                        updated = gain(neighbour)
+                        if updated != gains[neighbour]:
+                            gains[neighbour] = updated
+                            heapq.heappush(heaps[side[neighbour]], (-updated, neighbour))
+            if total > best:
+                best, best_moves = total, len(moves)
+
+        # only the moves up to the best cut of the pass are kept
+        for node in moves[best_moves:]:
+            side[node] = 1 - side[node]
+        if best == 0:
+            break
+    return side
+
+def partition_gates(num_inputs: int, gate_inputs: list[list[int]], arrays: int, tolerance: float=0.05, passes: int=8) -> list[int]:
+    '''
+        splits the gates over arrays by recursive bisection with balanced gate counts
+
+        returns:
+            array of every gate
+    '''
+    nets = signal_nets(num_inputs, gate_inputs)
+    parts = [0] * len(gate_inputs)
+
+    def split(nodes, first, count):
+        if count == 1 or len(nodes) == 0:
+            for node in nodes:
+                parts[node] = first
+            return
+        half = count // 2
+        members = set(nodes)
+        restricted = [[node for node in net if node in members] for net in nets]
+        restricted = [net for net in restricted if len(net) > 1]
+        side = bisect(nodes, restricted, half / count, tolerance, passes)
+        split([node for node, s in zip(nodes, side) if s == 0], first, half)
+        split([node for node, s in zip(nodes, side) if s == 1], first + half, count - half)
+
+    split(list(range(len(gate_inputs))), 0, arrays)
+    return parts
+
+def schedule_arrays(num_inputs: int, gate_inputs: list[list[int]], parts: list[int], parallelism: int=1) -> list[int]:
+    # stage of every gate: the first stage after its inputs with less than parallelism gates of its array
+    stage_of = [0] * num_inputs
+    next_stage = {}     # (array, stage) : first stage >= stage of the array that is not full yet
+    stage_sizes = {}
+    for gate, inputs in enumerate(gate_inputs):
+        array = parts[gate]
+        stage = max([stage_of[signal] for signal in inputs], default=0) + 1
+        path = []
+        while next_stage.get((array, stage), stage) != stage:
+            path.append(stage)
+            stage = next_stage[(array, stage)]
+        for visited in path:
+            next_stage[(array, visited)] = stage
+        stage_sizes[(array, stage)] = stage_sizes.get((array, stage), 0) + 1
+        if stage_sizes[(array, stage)] >= parallelism:
+            next_stage[(array, stage)] = stage + 1
+        stage_of.append(stage)
+    return stage_of[num_inputs:]
+
+
+# Compilation of every array
+
+class ArrayProgram():
+    '''
+        compiled program of one array
+
+        instructions, gates: program without padding, see compiler.emit_chunk
+        stage_lines: imply lines of every stage
+        inputs: input signal : memristor it is loaded into
+        sent: signal : memristor holding it at the barrier after the stage computing it
+        received: signal : memristor it is copied into
+        outputs: output index : memristor
+    '''
+    def __init__(self, instructions, gates, num_registers, stage_lines, inputs, sent, received, outputs):
+        self.instructions = instructions
+        self.gates = gates
+        self.num_registers = num_registers
+        self.stage_lines = stage_lines
+        self.inputs = inputs
+        self.sent = sent
+        self.received = received
+        self.outputs = outputs
+
+def compile_array(array: int, flat: tuple, num_inputs: int, parts: list[int], stage_of: list[int], parallelism: int) -> ArrayProgram:
+    '''
+        compiles the gates of one array, signals of other arrays are received at the barrier before the
+        first stage reading them
+    '''
+    labels, gate_types, gate_inputs, outputs, _ = flat
+    num_stages = max(stage_of, default=0) + 1
+    producer = [None] * num_inputs + list(range(len(gate_types)))
+    home = [None] * num_inputs + parts
+    local_outputs = {index: signal for index, signal in enumerate(outputs) if home[signal] == array or (home[signal] is None and array == 0)}
+
+    # signals read on this array: loaded inputs, received signals and when they can be freed
+    last_use = {}
+    for gate, inputs in enumerate(gate_inputs):
+        if parts[gate] == array:
+            for signal in inputs:
+                last_use[signal] = max(last_use.get(signal, 0), stage_of[gate])
+    for signal in local_outputs.values():
+        last_use[signal] = num_stages
+    loaded = sorted(signal for signal in last_use if signal < num_inputs)
+    received = {}       # stage : signals copied into this array before it
+    for signal in last_use:
+        if signal >= num_inputs and home[signal] != array:
+            received.setdefault(stage_of[producer[signal]] + 1, []).append(signal)
+    sent = {}           # stage : signals computed here and read by another array
+    for gate, inputs in enumerate(gate_inputs):
+        if parts[gate] != array:
+            for signal in inputs:
+                if home[signal] == array:
+                    sent.setdefault(stage_of[producer[signal]], set()).add(signal)
+
+    stages = [[] for _ in range(num_stages)]
+    for gate, (code, inputs) in enumerate(zip(gate_types, gate_inputs)):
+        if parts[gate] == array:
+            stages[stage_of[gate]].append((code, inputs, num_inputs + gate))
+    sent_signals = set().union(*sent.values())
+    freed = [[] for _ in range(num_stages + 1)]
+    released = {}       # stage : signals only sent, freed at the barrier before it once they are copied
+    for gate in range(len(gate_types)):
+        signal = num_inputs + gate
+        if parts[gate] == array and signal not in last_use:
+            if signal in sent_signals:
+                released.setdefault(stage_of[gate] + 1, []).append(signal)
+            else:
+                freed[stage_of[gate]].append(signal)
+    for signal, stage in last_use.items():
+        if stage < num_stages:
+            freed[stage].append(signal)
+
+    # the compiler numbers the loaded inputs 0.. and every other signal behind them
+    local = {signal: index for index, signal in enumerate(loaded)}
+    def local_id(signal):
+        if signal not in local:
+            local[signal] = len(local)
+        return local[signal]
+
+    compiler.parallelism = parallelism
+    compiler.circuit = None
+    compiler.reset_compiler(len(loaded))
+    stage_lines = []
+    sent_registers = {}
+    received_registers = {}
+
+    def local_stages():
+        for stage in range(num_stages):
+            for signal in received.get(stage, []):
+                index = compiler.reserve_registers(1)[0]
+                compiler.rename_register(index, local_id(signal))
+                received_registers[signal] = index
+            # received memristors are reserved first, so no copy of this barrier reads a memristor it writes
+            compiler.free_signals([local_id(signal) for signal in released.get(stage, [])])
+            lines = compiler.num_lines
+            yield ([(code, [local_id(signal) for signal in inputs], local_id(output)) for code, inputs, output in stages[stage]],
+                   [local_id(signal) for signal in freed[stage]])
+            stage_lines.append(compiler.num_lines - lines)
+            for signal in sent.get(stage, []):
+                sent_registers[signal] = compiler.signal_register[local_id(signal)]
+        # OUT gates only rename, the outputs stay where they are
+        lines = compiler.num_lines
+        yield ([(netlist_io.OUT_CODE, [local_id(signal)], local_id(("out", index))) for index, signal in local_outputs.items()], [])
+        stage_lines.append(compiler.num_lines - lines)
+
+    instructions, records = compiler.concatenate_chunks(list(compiler.compile_stages(local_stages())))
+    output_registers = {index: compiler.signal_register[local_id(("out", index))] for index in local_outputs}
+    return ArrayProgram(instructions, records, compiler.num_registers, stage_lines, {signal: local[signal] for signal in loaded},
+                        sent_registers, received_registers, output_registers)
+
+class PartitionedProgram():
+    '''
+        programs of all arrays of a partitioned circuit, padded to common stage barriers
+
+        programs: ArrayProgram of every array
+        barriers: first line of every stage, the last entry is the number of lines
+        copies: list of {"after_line", "signal", "from": [array, memristor], "to": [array, memristor]}
+    '''
+    def __init__(self, netlist: netlist_io.Netlist, arrays: int, arraySize: int=None, parallelism: int=1, tolerance: float=0.05, passes: int=8):
+        self.flat = netlist.flat_gates()
+        labels, gate_types, gate_inputs, outputs, self.output_labels = self.flat
+        self.num_inputs = netlist.num_inputs
+        self.arrays = arrays
+        self.parallelism = parallelism
+        self.parts = partition_gates(self.num_inputs, gate_inputs, arrays, tolerance, passes)
+        self.stage_of = schedule_arrays(self.num_inputs, gate_inputs, self.parts, parallelism)
+        self.programs = [compile_array(array, self.flat, self.num_inputs, self.parts, self.stage_of, parallelism) for array in range(arrays)]
+
+        if arraySize is not None:
+            for array, program in enumerate(self.programs):
+                if program.num_registers > arraySize:
+                    raise Exception(f"ERROR: Array {array} needs {program.num_registers} memristors, more than the {arraySize} of an array!")
+
+        lengths = np.max([program.stage_lines for program in self.programs], axis=0)
+        self.barriers = np.concatenate([[0], np.cumsum(lengths)]).tolist()
+        self.copies = []
+        home = [None] * self.num_inputs + self.parts
+        producer_stage = [0] * self.num_inputs + self.stage_of
+        for array, program in enumerate(self.programs):
+            for signal, index in program.received.items():
+                source = home[signal]
+                self.copies.append({"after_line": self.barriers[producer_stage[signal] + 1] - 1,
+                                    "signal": str(labels[signal]),
+                                    "from": [source, self.programs[source].sent[signal]],
+                                    "to": [array, index]})
+        self.copies.sort(key=lambda copy: (copy["after_line"], copy["to"]))
+
+    def num_lines(self) -> int:
+        return self.barriers[-1]
+
+    def padded(self, array: int) -> tuple[np.ndarray, np.ndarray]:
+        # program of array with every stage starting at its barrier
+        program = self.programs[array]
+        instructions = np.empty((self.num_lines(), self.parallelism, 3), dtype=np.int32)
+        instructions[:] = compiler.NOP_RECORD
+        starts = np.concatenate([[0], np.cumsum(program.stage_lines)]).astype(np.int64)
+        shift = np.array(self.barriers[:-1], dtype=np.int64) - starts[:-1]
+        for stage, lines in enumerate(program.stage_lines):
+            instructions[self.barriers[stage]:self.barriers[stage] + lines] = program.instructions[starts[stage]:starts[stage] + lines]
+        records = program.gates.copy()
+        stages = np.searchsorted(starts, records[:, 0], side="right") - 1
+        records[:, 0] = records[:, 0] + shift[np.minimum(stages, len(shift) - 1)]
+        return instructions, records
+
+    def write(self, prefix: str, outputFormat: str="text") -> list[str]:
+        # one program per array and the copies between them, returns the paths of the programs
+        compiler.parallelism = self.parallelism
+        paths = []
+        for array in range(self.arrays):
+            path = f"{prefix}_array{array}." + ("txt" if outputFormat == "text" else "bin")
+            writer = compiler.open_program_writer(path, outputFormat)
+            writer.write(*self.padded(array))
+            writer.close(self.programs[array].num_registers)
+            paths.append(path)
+        with open(f"{prefix}_copies.json", "w") as f:
+            json.dump(self.manifest(), f, indent=4)
+        return paths
+
+    def manifest(self) -> dict:
+        labels = self.flat[0]
+        return {"arrays": self.arrays,
+                "lines": self.num_lines(),
+                "barriers": self.barriers,
+                "inputs": [{str(labels[signal]): index for signal, index in program.inputs.items()} for program in self.programs],
+                "outputs": {label: [array, program.outputs[index]] for array, program in enumerate(self.programs)
+                            for index, label in enumerate(self.output_labels) if index in program.outputs},
+                "copies": self.copies}
+
+    def report(self) -> dict:
+        return {"arrays": self.arrays,
+                "lines": self.num_lines(),
+                "copies": len(self.copies),
+                "per_array": [{"gates": self.parts.count(array), "memristors": program.num_registers,
+                               "busy_lines": int(sum(program.stage_lines)), "inputs": len(program.inputs)}
+                              for array, program in enumerate(self.programs)]}
+
+
+def single_array(netlist: netlist_io.Netlist, parallelism: int) -> dict:
+    # the circuit compiled on one unbounded array with the same parallelism, for comparison
+    labels, gate_types, gate_inputs, outputs, output_labels = netlist.flat_gates()
+    scheduled = netlist_io.schedule_gates(labels, netlist.num_inputs, gate_types, gate_inputs, outputs, output_labels, parallelism)
+    compiler.parallelism = parallelism
+    with contextlib.redirect_stdout(io.StringIO()):
+        compiler.compile_netlist(scheduled, outfile=None)
+    return {"lines": compiler.num_lines, "memristors": compiler.num_registers}
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(description="Partition a circuit across several fixed-size memristor arrays")
+    parser.add_argument("config", nargs="?", default=None, help="config file (.json, .jsonl or .npz), else --circuit is built")
+    parser.add_argument("--circuit", choices=list(CIRCUITS), default="mac16x16")
+    parser.add_argument("--arrays", type=int, default=2)
+    parser.add_argument("--array-size", type=int, default=None, help="memristors of one array (default: unbounded)")
+    parser.add_argument("--parallelism", type=int, default=1, help="gates per stage of one array")
+    parser.add_argument("--tolerance", type=float, default=0.05, help="allowed imbalance of the gates per array")
+    parser.add_argument("--passes", type=int, default=8, help="Fiduccia-Mattheyses passes per bisection")
+    parser.add_argument("--out", default=None, help="prefix of the programs <out>_array<k> and of <out>_copies.json")
+    parser.add_argument("--format", choices=["text", "binary"], default="text")
+    parser.add_argument("--json", default=None, help="also write the report to this file")
+    args = parser.parse_args(argv)
+
+    if args.config is not None:
+        netlist = netlist_io.load_netlist(args.config)
+    else:
+        function, widths = CIRCUITS[args.circuit]
+        netlist, _ = approx_synth.build_circuit(function, widths)
+    partitioned = PartitionedProgram(netlist, args.arrays, args.array_size, args.parallelism, args.tolerance, args.passes)
+    if args.out is not None:
+        outDir = os.path.dirname(args.out)
+        if outDir != "" and not os.path.exists(outDir):
+            os.makedirs(outDir)
+        partitioned.write(args.out, args.format)
+
+    report = {"single_array": single_array(netlist, args.parallelism), **partitioned.report()}
+    if args.json is not None:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=4)
+    for key, value in report.items():
+        print(f"{key}: {value}")
+
+if __name__ == "__main__":
+    main()
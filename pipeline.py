@@ -0,0 +1,420 @@
+#!/usr/bin/env python3
+"""
+Modulo scheduled (pipelined) compilation for streams of operand sets
+
+    python pipeline.py --variant exactAdder_exactMultiplier --parallelism 3 --iterations 16 --out out/pipelined.txt
+    python pipeline.py --variant exactAdder_exactMultiplier --adder kogge_stone --accumulate --parallelism 3
+    python pipeline.py config.npz --parallelism 4 --max-memristors 300
+
+A program compiled by compiler.compile_netlist handles one operand set from start to finish. Here the
+gates of one operand set (one iteration) are modulo scheduled: a new iteration starts every ii lines
+(initiation interval), so the late gates of one operand set overlap with the early gates of the next:
+
+    1. schedule     the gates are placed in topological order at the earliest line their inputs are
+                    ready, in a lane that is free at all of their lines modulo ii (modulo reservation
+                    table), so the gates of all overlapping iterations fit into the parallelism lanes
+    2. recurrences  with --accumulate the result of the MAC is fed back into c of the next iteration
+                    without leaving the array, as when streaming a dot product. An input fed back is
+                    only ready ii lines before the end of the gate computing it, the schedule is
+                    repeated with these release times until they hold
+    3. allocation   every value lives from the first line of its gate to the last line of its last
+                    reader, work registers for the lines of their gate. The live ranges of all
+                    iterations are assigned to memristors by interval colouring, so memristors are
+                    reused as soon as a value is dead
+
+The inputs of iteration i are loaded before line i * ii, its outputs can be read after line
+i * ii + lines - 1. The gates are instantiated from the templates of compiler.py, so a program
+compiled this way runs on the same array as the single-shot program.
+"""
+
+import argparse
+import contextlib
+import heapq
+import io
+import json
+import math
+import os
+
+import numpy as np
+
+import compiler
+import dse
+import gates
+import netlist_io
+
+MAX_RELEASE_ROUNDS = 16     # schedules tried per ii until the release times of recurrences hold
+
+
+class LoopBody():
+    '''
+        gates of one iteration, see netlist_io.Netlist.flat_gates
+
+        lengths: imply lines of every gate
+        producers: gate computing every signal, None for inputs
+        readers: gates reading every signal
+    '''
+    def __init__(self, netlist: netlist_io.Netlist):
+        self.labels, self.gate_types, self.gate_inputs, self.outputs, self.output_labels = netlist.flat_gates()
+        self.num_inputs = netlist.num_inputs
+        self.lengths = [compiler.gate_templates[code].length for code in self.gate_types]
+        self.producers = [None] * self.num_inputs + list(range(self.num_gates()))
+        self.readers = [[] for _ in self.labels]
+        for gate, inputs in enumerate(self.gate_inputs):
+            for signal in set(inputs):
+                self.readers[signal].append(gate)
+
+    def num_gates(self) -> int:
+        return len(self.gate_types)
+
+    def recurrence_bound(self, feedback: dict=None) -> int:
+        # longest path from a reader of an input fed back to the end of the output it is fed back from
+        bound = 1
+        for output, input in (feedback or {}).items():
+            distance = [None] * len(self.labels)
+            for gate in self.readers[input]:
+                distance[self.num_inputs + gate] = self.lengths[gate]
+            for gate, inputs in enumerate(self.gate_inputs):
+                before = [distance[signal] for signal in inputs if distance[signal] is not None]
+                if len(before) > 0:
+                    distance[self.num_inputs + gate] = max(distance[self.num_inputs + gate] or 0, max(before) + self.lengths[gate])
+            bound = max(bound, distance[self.outputs[output]] or 1)
+        return bound
+
+def modulo_schedule(body: LoopBody, ii: int, parallelism: int, release: dict=None) -> tuple[list[int], list[int]]:
+    '''
+        places every gate at its earliest line with a lane free at all of its lines modulo ii
+
+        expects:
+            release: input signal : first line it can be read (default 0)
+
+        returns:
+            starts, lanes of every gate, None if a gate does not fit
+    '''
+    release = release or {}
+    occupied = np.zeros((parallelism, 2 * ii), dtype=np.int64)   # reservation table, repeated once for windows wrapping around
+    ready = [release.get(signal, 0) for signal in range(body.num_inputs)]
+    starts = []
+    lanes = []
+    for gate, inputs in enumerate(body.gate_inputs):
+        length = body.lengths[gate]
+        if length > ii:
+            return None
+        earliest = max([ready[signal] for signal in inputs], default=0)
+        # lines of the table already taken inside of a window of length lines starting at every line
+        busy = np.cumsum(np.concatenate([np.zeros((parallelism, 1), dtype=np.int64), occupied], axis=1), axis=1)
+        busy = busy[:, length:length + ii] - busy[:, :ii]
+        delays = np.roll(busy, -(earliest % ii), axis=1) == 0
+        if not delays.any():
+            return None
+        delay = np.where(delays.any(axis=1), delays.argmax(axis=1), ii)
+        lane = int(delay.argmin())
+        start = earliest + int(delay[lane])
+        slots = (start + np.arange(length)) % ii
+        occupied[lane, slots] = 1
+        occupied[lane, slots + ii] = 1
+        starts.append(start)
+        lanes.append(lane)
+        ready.append(start + length)
+    return starts, lanes
+
+def schedule_iteration(body: LoopBody, ii: int, parallelism: int, feedback: dict=None) -> tuple[list[int], list[int], dict]:
+    '''
+        modulo schedule meeting the recurrences of feedback (output index : input signal)
+
+        returns:
+            starts, lanes of every gate and the release time of every input fed back, None if ii is infeasible
+    '''
+    release = {input: 0 for input in (feedback or {}).values()}
+    for _ in range(MAX_RELEASE_ROUNDS):
+        schedule = modulo_schedule(body, ii, parallelism, release)
+        if schedule is None:
+            return None
+        starts, _ = schedule
+        needed = {input: signal_end(body, starts, body.outputs[output]) + 1 - ii for output, input in feedback.items()} if feedback else {}
+        if all(needed[input] <= release[input] for input in needed):
+            return schedule[0], schedule[1], release
+        release = {input: max(release[input], needed[input]) for input in release}
+    return None
+
+def signal_end(body: LoopBody, starts: list[int], signal: int) -> int:
+    # last line of the gate computing signal, -1 for inputs
+    gate = body.producers[signal]
+    return -1 if gate is None else starts[gate] + body.lengths[gate] - 1
+
+
+# Live ranges
+
+def live_ranges(body: LoopBody, starts: list[int], ii: int, feedback: dict=None, last: bool=False) -> tuple[np.ndarray, np.ndarray, list]:
+    '''
+        live ranges of one iteration, relative to its first line
+
+        expects:
+            last: the iteration is the last one, outputs fed back are kept until its end instead of the next iteration
+
+        returns:
+            starts, ends: first and last line of every range
+            owners: ("signal", id) or ("work", gate, slot) of every range, inputs fed back are part of the range of
+                    their output in the previous iteration and have no range of their own
+    '''
+    feedback = feedback or {}
+    length = max([start + body.lengths[gate] for gate, start in enumerate(starts)], default=1)
+    fed_back = set(feedback.values())
+    first = [0] * body.num_inputs + list(starts)
+    final = [0] * body.num_inputs + [start + length - 1 for start, length in zip(starts, body.lengths)]
+    for gate, inputs in enumerate(body.gate_inputs):
+        for signal in inputs:
+            final[signal] = max(final[signal], starts[gate] + body.lengths[gate] - 1)
+    for signal in body.outputs:
+        final[signal] = max(final[signal], length - 1)
+    if not last:
+        for output, input in feedback.items():
+            final[body.outputs[output]] = max(final[body.outputs[output]], ii + final[input])
+
+    range_starts = []
+    range_ends = []
+    owners = []
+    for signal in range(len(body.labels)):
+        if signal not in fed_back:
+            range_starts.append(first[signal])
+            range_ends.append(final[signal])
+            owners.append(("signal", signal))
+    for gate, code in enumerate(body.gate_types):
+        template = compiler.gate_templates[code]
+        for slot in range(template.num_inputs, template.num_inputs + template.num_work):
+            if slot != template.result:
+                range_starts.append(starts[gate])
+                range_ends.append(starts[gate] + body.lengths[gate] - 1)
+                owners.append(("work", gate, slot))
+    return np.array(range_starts, dtype=np.int64), np.array(range_ends, dtype=np.int64), owners
+
+def register_pressure(body: LoopBody, starts: list[int], ii: int, feedback: dict=None) -> int:
+    # live ranges of all overlapping iterations at the busiest line of the steady state
+    range_starts, range_ends, _ = live_ranges(body, starts, ii, feedback)
+    live = np.zeros(int(range_ends.max(initial=0)) + 2, dtype=np.int64)
+    np.add.at(live, range_starts, 1)
+    np.add.at(live, range_ends + 1, -1)
+    live = np.cumsum(live)[:-1]
+    return int(np.bincount(np.arange(len(live)) % ii, weights=live, minlength=ii).max(initial=0))
+
+def assign_intervals(starts: np.ndarray, ends: np.ndarray) -> tuple[np.ndarray, int]:
+    '''
+        interval colouring: every interval [start, end] gets the lowest memristor that is free at its start
+
+        returns:
+            memristor of every interval, number of memristors used
+    '''
+    assigned = np.empty(len(starts), dtype=np.int64)
+    busy = []       # (end, memristor)
+    free = []
+    used = 0
+    for index in np.lexsort((ends, starts)).tolist():
+        while len(busy) > 0 and busy[0][0] < starts[index]:
+            heapq.heappush(free, heapq.heappop(busy)[1])
+        if len(free) > 0:
+            assigned[index] = heapq.heappop(free)
+        else:
+            assigned[index] = used
+            used = used + 1
+        heapq.heappush(busy, (int(ends[index]), int(assigned[index])))
+    return assigned, used
+
+
+# Initiation interval
+
+def minimum_ii(body: LoopBody, parallelism: int, feedback: dict=None) -> int:
+    # lower bound from the lanes, the longest gate and the recurrences
+    resources = math.ceil(sum(body.lengths) / parallelism)
+    return max(resources, max(body.lengths, default=1), body.recurrence_bound(feedback), 1)
+
+def initiation_intervals(body: LoopBody, parallelism: int, feedback: dict=None, growth: float=1.05) -> list[dict]:
+    '''
+        feasible initiation intervals from the smallest one up to the length of an iteration, every next one
+        growth times the last, that need fewer memristors than every smaller ii
+
+        returns:
+            list of {"ii", "lines", "memristors"} sorted by ii, lines of one iteration, memristors of the steady
+            state of an endless stream
+    '''
+    points = []
+    ii = minimum_ii(body, parallelism, feedback)
+    while True:
+        schedule = schedule_iteration(body, ii, parallelism, feedback)
+        if schedule is None:
+            ii = ii + 1
+            continue
+        starts = schedule[0]
+        lines = max([start + length for start, length in zip(starts, body.lengths)], default=0)
+        memristors = register_pressure(body, starts, ii, feedback)
+        if len(points) == 0 or memristors < points[-1]["memristors"]:
+            points.append({"ii": ii, "lines": lines, "memristors": memristors})
+        if ii >= lines:
+            return points
+        ii = max(ii + 1, min(lines, math.ceil(ii * growth)))
+
+class ModuloSchedule():
+    '''
+        program of iterations, one operand set each, started every ii lines
+
+        instructions, gates: program as returned by compiler.emit_chunk
+        inputs, outputs: (iterations, inputs / outputs) memristor of every input and output per iteration
+        load_lines: line before which the inputs of every iteration are loaded
+        ready_lines: line after which the outputs of every iteration can be read
+    '''
+    def __init__(self, body: LoopBody, ii: int, parallelism: int, iterations: int, feedback: dict=None):
+        feedback = feedback or {}
+        if len(set(feedback.values())) != len(feedback):
+            raise Exception(f"ERROR: Every input can only be fed back from one output!")
+        schedule = schedule_iteration(body, ii, parallelism, feedback)
+        if schedule is None:
+            raise Exception(f"ERROR: The gates do not fit into ii {ii} with {parallelism} lanes!")
+        starts, lanes, self.release = schedule
+        self.ii = ii
+        self.parallelism = parallelism
+        self.iterations = iterations
+        self.length = max([start + length for start, length in zip(starts, body.lengths)], default=0)
+        self.num_lines = (iterations - 1) * ii + self.length if iterations > 0 else 0
+
+        # live ranges of all iterations, an input fed back is stored where its output of the previous iteration is
+        range_starts, range_ends, owners = [], [], []
+        for iteration in range(iterations):
+            iteration_starts, iteration_ends, iteration_owners = live_ranges(body, starts, ii, feedback, iteration == iterations - 1)
+            range_starts.append(iteration_starts + iteration * ii)
+            range_ends.append(iteration_ends + iteration * ii)
+            owners.extend((iteration,) + owner for owner in iteration_owners)
+        # the inputs fed back are loaded for the first iteration only
+        if iterations > 0:
+            for input in feedback.values():
+                range_starts.append(np.zeros(1, dtype=np.int64))
+                range_ends.append(np.array([max([starts[gate] + body.lengths[gate] - 1 for gate in body.readers[input]], default=0)]))
+                owners.append((0, "signal", input))
+        memristors, self.num_registers = assign_intervals(np.concatenate(range_starts), np.concatenate(range_ends))
+        stored = dict(zip(owners, memristors.tolist()))
+        for iteration in range(1, iterations):
+            for output, input in feedback.items():
+                stored[(iteration, "signal", input)] = stored[(iteration - 1, "signal", body.outputs[output])]
+
+        # gates are instantiated from the templates of the compiler in the lane of the reservation table
+        self.instructions = np.empty((self.num_lines, parallelism, 3), dtype=np.int32)
+        self.instructions[:] = compiler.NOP_RECORD
+        records = []
+        for iteration in range(iterations):
+            for gate, (code, inputs) in enumerate(zip(body.gate_types, body.gate_inputs)):
+                template = compiler.gate_templates[code]
+                slots = [stored[(iteration, "signal", signal)] for signal in inputs]
+                for slot in range(template.num_inputs, template.num_inputs + template.num_work):
+                    if slot == template.result:
+                        slots.append(stored[(iteration, "signal", body.num_inputs + gate)])
+                    else:
+                        slots.append(stored[(iteration, "work", gate, slot)])
+                slots.append(compiler.NO_REG)
+                line = iteration * ii + starts[gate]
+                self.instructions[line:line + template.length, lanes[gate]] = template.instantiate(np.array([slots], dtype=np.int32))[0]
+                records.append((line, lanes[gate], template.length, code, 0))
+
+        # gates are numbered in order of their lines like in compiler.emit_chunk
+        self.gates = np.array(records, dtype=np.int64).reshape(-1, 5)
+        self.gates = self.gates[np.argsort(self.gates[:, 0], kind="stable")]
+        for code in range(len(netlist_io.GATE_TYPES)):
+            selected = np.flatnonzero(self.gates[:, 3] == code)
+            self.gates[selected, 4] = np.arange(len(selected))
+
+        self.inputs = np.array([[stored[(iteration, "signal", signal)] for signal in range(body.num_inputs)] for iteration in range(iterations)], dtype=np.int64)
+        self.outputs = np.array([[stored[(iteration, "signal", signal)] for signal in body.outputs] for iteration in range(iterations)], dtype=np.int64)
+        self.load_lines = np.arange(iterations, dtype=np.int64) * ii
+        self.ready_lines = self.load_lines + self.length - 1
+
+    def write(self, outfile: str, outputFormat: str="text") -> None:
+        compiler.parallelism = self.parallelism
+        writer = compiler.open_program_writer(outfile, outputFormat)
+        writer.write(self.instructions, self.gates)
+        writer.close(self.num_registers)
+
+    def report(self) -> dict:
+        return {"ii": self.ii,
+                "iterations": self.iterations,
+                "lines": self.num_lines,
+                "lines_per_iteration": self.length,
+                "memristors": self.num_registers,
+                "schedule": [{"load": int(load), "inputs": inputs, "ready": int(ready), "outputs": outputs}
+                             for load, inputs, ready, outputs in zip(self.load_lines, self.inputs.tolist(), self.ready_lines, self.outputs.tolist())]}
+
+
+# MAC
+
+def mac_netlist(variant: str, adder: str="ripple", parallelism: int=1) -> tuple[netlist_io.Netlist, list[int]]:
+    # MAC variant of gates.MAC_variants and the input index of every bit of a, b and c, see dse.build_netlist
+    gates.maxGatesPerStage = parallelism
+    gates.MAC_Circuit(0, 0, 0, **gates.MAC_variants[variant], adder=adder)
+    operandLabels = [register.getLabel() for register in gates.Register.inputRegisters[:dse.A_BITS + dse.B_BITS + dse.C_BITS]]
+    with contextlib.redirect_stdout(io.StringIO()):
+        netlist = gates.CircuitConfig().toNetlist()
+    inputs = {str(label): index for index, label in enumerate(netlist.labels[:netlist.num_inputs])}
+    return netlist, [inputs.get(label) for label in operandLabels]
+
+def mac_feedback(body: LoopBody, operands: list[int]) -> dict:
+    # the result bits of the MAC are fed back into c, both most significant bit first
+    c = operands[dse.A_BITS + dse.B_BITS:]
+    if len(body.outputs) != dse.RESULT_BITS or None in c:
+        raise Exception(f"ERROR: Accumulation needs {dse.RESULT_BITS} outputs and every bit of c as input!")
+    return {output: input for output, input in enumerate(c)}
+
+def single_shot(netlist: netlist_io.Netlist, parallelism: int) -> dict:
+    compiler.parallelism = parallelism
+    with contextlib.redirect_stdout(io.StringIO()):
+        compiler.compile_netlist(netlist, outfile=None)
+    return {"lines": compiler.num_lines, "memristors": compiler.num_registers}
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(description="Modulo scheduled compilation for streams of operand sets")
+    parser.add_argument("config", nargs="?", default=None, help="config file (.json, .jsonl or .npz), else the MAC of --variant is built")
+    parser.add_argument("--variant", choices=list(gates.MAC_variants), default="exactAdder_exactMultiplier")
+    parser.add_argument("--adder", choices=gates.MAC_ADDERS, default="ripple", help="adder of the accumulator")
+    parser.add_argument("--accumulate", action="store_true", help="feed the result of the MAC back into c of the next iteration")
+    parser.add_argument("--parallelism", type=int, default=1)
+    parser.add_argument("--ii", type=int, default=None, help="initiation interval (default: smallest feasible one)")
+    parser.add_argument("--max-memristors", type=int, default=None, help="smallest ii whose steady state fits into this many memristors")
+    parser.add_argument("--iterations", type=int, default=8, help="operand sets of the compiled program")
+    parser.add_argument("--out", default=None, help="write the pipelined program to this file")
+    parser.add_argument("--format", choices=["text", "binary"], default="text")
+    parser.add_argument("--json", default=None, help="also write the report to this file")
+    args = parser.parse_args(argv)
+
+    if args.config is not None:
+        if args.accumulate:
+            raise Exception(f"ERROR: --accumulate needs the MAC of --variant!")
+        netlist = netlist_io.load_netlist(args.config)
+        body, feedback = LoopBody(netlist), None
+    else:
+        netlist, operands = mac_netlist(args.variant, args.adder, args.parallelism)
+        body = LoopBody(netlist)
+        feedback = mac_feedback(body, operands) if args.accumulate else None
+    points = initiation_intervals(body, args.parallelism, feedback)
+
+    ii = args.ii
+    if ii is None:
+        fitting = [point for point in points if args.max_memristors is None or point["memristors"] <= args.max_memristors]
+        if len(fitting) == 0:
+            raise Exception(f"ERROR: No initiation interval fits into {args.max_memristors} memristors!")
+        ii = fitting[0]["ii"]
+    schedule = ModuloSchedule(body, ii, args.parallelism, args.iterations, feedback)
+    if args.out is not None:
+        outDir = os.path.dirname(args.out)
+        if outDir != "" and not os.path.exists(outDir):
+            os.makedirs(outDir)
+        schedule.write(args.out, args.format)
+
+    reference = single_shot(netlist, args.parallelism)
+    report = {"single_shot": reference,
+              "initiation_intervals": points,
+              "program": schedule.report()}
+    if args.json is not None:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=4)
+    print(f"single shot: {reference['lines']} lines, {reference['memristors']} memristors")
+    for point in points:
+        print(f"ii {point['ii']:6d}  memristors {point['memristors']:5d} ({point['memristors'] - reference['memristors']:+d})  "
+              f"throughput {reference['lines'] / point['ii']:.2f}x")
+    print(f"program: ii {schedule.ii}, {schedule.iterations} iterations, {schedule.num_lines} lines, {schedule.num_registers} memristors")
+
+if __name__ == "__main__":
+    main()
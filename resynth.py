@@ -0,0 +1,476 @@
+#!/usr/bin/env python3
+"""
+Cut-based resynthesis: small cones of a circuit are replaced by their cheapest implementation in imply steps
+
+    python resynth.py --circuit full_adder_nimar
+    python resynth.py --circuit mac --cut-size 4 --objective lines --out resynthesized.npz
+    python resynth.py config.npz --parallelism 2 --json resynth.json
+
+Every round of the pass
+
+    1. enumerates the k-feasible cuts of every gate (sets of at most --cut-size signals separating it from
+       the inputs, at most --cuts per gate) and the truth table of the gate over every cut, combined from
+       the tables over the cuts of its inputs with bit operations on integers. Cuts and tables of gates
+       whose cone is unchanged are taken from the previous round
+    2. looks up the cheapest implementation of every truth table in CostLibrary: functions of up to 3
+       inputs are synthesised exactly (cheapest tree of OR/AND/XOR/NOT weighted by the imply steps of the
+       templates in compiler.py), larger ones by Shannon decomposition into them. Implementations are
+       cached per truth table
+    3. replaces the gate by the implementation if that takes fewer steps than the gates that are only
+       used by its cone (maximum fanout-free cone), cones of the replacements do not overlap
+    4. rebuilds the circuit with structural hashing and inverted signals kept as polarities (see
+       netlist_import.GateBuilder) and schedules it again
+
+The round is only kept if the compiled costs (dse.estimate_costs, lines or memristors by --objective)
+go down, the pass stops at the first round that does not improve them. Cones computing a constant are
+not replaced and a round changing the inputs of the circuit is rejected (GateBuilder reads an output
+folded to a constant from an added CONST input), so operands bound by input position stay valid.
+"""
+
+import argparse
+import json
+import operator
+
+import numpy as np
+
+import approx_synth
+import compiler
+import dse
+import gates
+import netlist_io
+from netlist_import import GateBuilder
+
+OR = netlist_io.GATE_CODES["OR"]
+AND = netlist_io.GATE_CODES["AND"]
+XOR = netlist_io.GATE_CODES["XOR"]
+NOT = netlist_io.GATE_CODES["NOT"]
+VAR = -1        # implementation by an input of the cut
+
+STEPS = {code: compiler.gate_templates[code].length for code in (OR, AND, XOR, NOT)}
+OPERATIONS = {OR: operator.or_, AND: operator.and_, XOR: operator.xor}
+EXACT_INPUTS = 3        # functions of up to this many inputs are synthesised exactly
+UNREACHABLE = np.iinfo(np.int64).max // 4
+TRIVIAL = 2             # truth table of a signal over its trivial cut, see projections
+EXPANSIONS = {}         # (size of a merged cut, positions of a cut in it) : minterm of the cut for every minterm of the merged cut
+
+# circuits that can be resynthesised from the command line: function building the outputs and widths of its operands
+CIRCUITS = {"full_adder_nimar": (lambda a, b, c: list(gates.traceable_full_adder_nimar(a[0], b[0], c[0])), [1, 1, 1]),
+            **approx_synth.CIRCUITS}
+
+
+def projections(n: int) -> list[int]:
+    # truth tables of the inputs of a function of n inputs, bit m holds the value for minterm m
+    return [sum(1 << m for m in range(1 << n) if m >> j & 1) for j in range(n)]
+
+class CostLibrary():
+    '''
+        cheapest implementation in imply steps of every function given as truth table, see projections
+
+        Functions of up to EXACT_INPUTS inputs are enumerated exhaustively: starting from the inputs, NOT and the
+        two input gates are applied to all functions found so far until no cost goes down (costs of trees, signals
+        read twice are counted twice). Larger functions are split by the input giving the cheapest Shannon
+        decomposition f = x ? f1 : f0, which becomes an AND, OR or XOR with x if a cofactor is constant or the
+        inverse of the other one.
+    '''
+    def __init__(self):
+        self.exact = {n: self.enumerate(n) for n in range(1, EXACT_INPUTS + 1)}
+        self.decompositions = {}        # (n, truth table) : (cost, input, form, f0, f1)
+
+    def enumerate(self, n: int) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        # cost, operation, first and second operand of every function of n inputs
+        size = 1 << (1 << n)
+        mask = size - 1
+        cost = np.full(size, UNREACHABLE, dtype=np.int64)
+        operation = np.full(size, VAR, dtype=np.int64)
+        first = np.zeros(size, dtype=np.int64)
+        second = np.zeros(size, dtype=np.int64)
+        for index, table in enumerate(projections(n)):
+            cost[table] = 0
+            first[table] = index
+
+        changed = True
+        while changed:
+            changed = False
+            tables = np.arange(size)
+            inverted = cost[tables ^ mask] + STEPS[NOT]
+            better = np.flatnonzero(inverted < cost)
+            if len(better) > 0:
+                cost[better] = inverted[better]
+                operation[better] = NOT
+                first[better] = better ^ mask
+                changed = True
+
+            known = np.flatnonzero(cost < UNREACHABLE)
+            a, b = np.meshgrid(known, known, indexing="ij")
+            a, b = a.ravel(), b.ravel()
+            for code, function in OPERATIONS.items():
+                results = function(a, b)
+                costs = cost[a] + cost[b] + STEPS[code]
+                order = np.lexsort((costs, results))
+                results, unique = np.unique(results[order], return_index=True)
+                best = order[unique]
+                better = costs[best] < cost[results]
+                if np.any(better):
+                    results, best = results[better], best[better]
+                    cost[results] = costs[best]
+                    operation[results] = code
+                    first[results] = a[best]
+                    second[results] = b[best]
+                    changed = True
+        return cost, operation, first, second
+
+    def cost(self, n: int, table: int) -> int:
+        if n <= EXACT_INPUTS:
+            return int(self.exact[n][0][table])
+        return self.decompose(n, table)[0]
+
+    def decompose(self, n: int, table: int) -> tuple:
+        key = (n, table)
+        if key in self.decompositions:
+            return self.decompositions[key]
+        best = None
+        mask = (1 << (1 << n)) - 1
+        for index in range(n):
+            f0, f1 = cofactors(n, table, index)
+            sub_mask = (1 << (1 << (n - 1))) - 1
+            if f0 == f1:
+                options = [(self.cost(n - 1, f0), "same")]
+            elif f0 == 0:
+                options = [(self.cost(n - 1, f1) + STEPS[AND], "and")]
+            elif f1 == sub_mask:
+                options = [(self.cost(n - 1, f0) + STEPS[OR], "or")]
+            elif f1 == 0:
+                options = [(self.cost(n - 1, f0) + STEPS[NOT] + STEPS[AND], "and_not")]
+            elif f0 == sub_mask:
+                options = [(self.cost(n - 1, f1) + STEPS[NOT] + STEPS[OR], "or_not")]
+            elif f1 == f0 ^ sub_mask:
+                options = [(self.cost(n - 1, f0) + STEPS[XOR], "xor")]
+            else:
+                options = [(self.cost(n - 1, f0) + self.cost(n - 1, f1) + 2 * STEPS[AND] + STEPS[NOT] + STEPS[OR], "mux")]
+            for cost, form in options:
+                if best is None or cost < best[0]:
+                    best = (cost, index, form, f0, f1)
+        if table in (0, mask):
+            best = (UNREACHABLE, None, "constant", table, table)
+        self.decompositions[key] = best
+        return best
+
+    def build(self, builder: GateBuilder, n: int, table: int, leaves: list[int], label: str) -> int:
+        '''
+            literal of the cheapest implementation of a function of n inputs, leaves are the literals of its inputs
+        '''
+        if n <= EXACT_INPUTS:
+            return self.build_exact(builder, n, table, leaves, label)
+        _, index, form, f0, f1 = self.decompose(n, table)
+        x = leaves[index]
+        rest = leaves[:index] + leaves[index + 1:]
+        if form == "same":
+            return self.build(builder, n - 1, f0, rest, label)
+        if form in ("and", "or_not"):
+            other = self.build(builder, n - 1, f1, rest, f"{label}$f1")
+        else:
+            other = self.build(builder, n - 1, f0, rest, f"{label}$f0")
+        if form == "and":
+            return builder.and2(x, other, label)
+        if form == "or":
+            return builder.or2(x, other, label)
+        if form == "and_not":
+            return builder.and2(x ^ 1, other, label)
+        if form == "or_not":
+            return builder.or2(x ^ 1, other, label)
+        if form == "xor":
+            return builder.xor2(x, other, label)
+        positive = builder.and2(x, self.build(builder, n - 1, f1, rest, f"{label}$f1"), f"{label}$x1")
+        negative = builder.and2(x ^ 1, other, f"{label}$x0")
+        return builder.or2(positive, negative, label)
+
+    def build_exact(self, builder: GateBuilder, n: int, table: int, leaves: list[int], label: str) -> int:
+        # the tree of the enumeration is built with an explicit stack, every function once
+        _, operation, first, second = self.exact[n]
+        literals = {}
+        stack = [table]
+        while len(stack) > 0:
+            node = stack[-1]
+            code = int(operation[node])
+            if code == VAR:
+                literals[node] = leaves[int(first[node])]
+                stack.pop()
+                continue
+            operands = [int(first[node])] if code == NOT else [int(first[node]), int(second[node])]
+            pending = [operand for operand in operands if operand not in literals]
+            if len(pending) > 0:
+                stack.extend(pending)
+                continue
+            stack.pop()
+            name = label if node == table else f"{label}${node}"
+            if code == NOT:
+                literals[node] = literals[operands[0]] ^ 1
+            elif code == AND:
+                literals[node] = builder.and2(literals[operands[0]], literals[operands[1]], name)
+            elif code == OR:
+                literals[node] = builder.or2(literals[operands[0]], literals[operands[1]], name)
+            else:
+                literals[node] = builder.xor2(literals[operands[0]], literals[operands[1]], name)
+        return literals[table]
+
+def cofactors(n: int, table: int, index: int) -> tuple[int, int]:
+    # truth tables of a function with input index set to 0 and 1, as functions of the other n - 1 inputs
+    f0 = f1 = 0
+    position = 0
+    for m in range(1 << n):
+        if m >> index & 1:
+            continue
+        f0 |= (table >> m & 1) << position
+        f1 |= (table >> (m | 1 << index) & 1) << position
+        position = position + 1
+    return f0, f1
+
+def expand(table: int, cut: tuple, merged: tuple) -> int:
+    # truth table over cut as a function of the signals of merged, a superset of cut
+    if cut == merged:
+        return table
+    key = (len(merged), tuple(merged.index(leaf) for leaf in cut))
+    minterms = EXPANSIONS.get(key)
+    if minterms is None:
+        minterms = [sum((m >> position & 1) << j for j, position in enumerate(key[1])) for m in range(1 << len(merged))]
+        EXPANSIONS[key] = minterms
+    return sum((table >> minterm & 1) << m for m, minterm in enumerate(minterms))
+
+
+class CutEnumeration():
+    '''
+        k-feasible cuts of every signal of a flat circuit (see Netlist.flat_gates) and their truth tables
+
+        cuts: signal : cuts as tuples of signals, the trivial cut (signal,) first
+        tables: signal : truth table of the signal over every cut, bit m for minterm m of the cut (see projections)
+        reused: gates whose cuts and tables were taken from the enumeration of the previous round
+
+        The cuts of a gate are merged from the cuts of its inputs and the truth table over a merged cut is computed
+        from the tables of the two input cuts it was merged from, expanded to the signals of the merged cut. Gates
+        are identified by their structure (type and identities of the inputs), so the enumeration of the previous
+        round hands out the cuts and tables of every gate whose cone is unchanged.
+    '''
+    def __init__(self, num_inputs: int, gate_types: list[int], gate_inputs: list[list[int]], cutSize: int=4, maxCuts: int=8,
+                 previous: "CutEnumeration"=None):
+        self.cutSize = cutSize
+        self.maxCuts = maxCuts
+        reusable = previous is not None and (previous.cutSize, previous.maxCuts) == (cutSize, maxCuts)
+        self.identities = previous.identities if reusable else {}      # structure : identity
+        known = previous.nodes if reusable else {}
+        self.nodes = {}         # identity : (cuts over identities, truth tables)
+        self.reused = 0
+
+        identity = []
+        for signal in range(num_inputs):
+            node = self.identify((-1, signal))
+            identity.append(node)
+            self.nodes[node] = ([(node,)], [TRIVIAL])
+        for code, inputs in zip(gate_types, gate_inputs):
+            # equal gates of a circuit that is not structurally hashed are told apart by their occurrence
+            structure = (code, *sorted(identity[input] for input in inputs))
+            occurrence = 0
+            while self.identities.get((*structure, occurrence)) in self.nodes:
+                occurrence = occurrence + 1
+            node = self.identify((*structure, occurrence))
+            identity.append(node)
+            if node in known:
+                self.nodes[node] = known[node]
+                self.reused = self.reused + 1
+            else:
+                self.nodes[node] = self.merge(node, code, [self.nodes[identity[input]] for input in inputs])
+
+        # identities are unique within the circuit, so cuts map back to signals
+        signal_of = {node: signal for signal, node in enumerate(identity)}
+        self.cuts = [[tuple(signal_of[leaf] for leaf in cut) for cut in self.nodes[node][0]] for node in identity]
+        self.tables = [self.nodes[node][1] for node in identity]
+
+    def identify(self, structure: tuple) -> int:
+        return self.identities.setdefault(structure, len(self.identities))
+
+    def merge(self, node: int, code: int, operands: list[tuple]) -> tuple[list[tuple], list[int]]:
+        # cuts and truth tables of a gate from the (cuts, tables) of its inputs
+        if len(operands) == 1:
+            merged = {cut: (table,) for cut, table in zip(*operands[0])}
+        else:
+            merged = {}
+            for a, a_table in zip(*operands[0]):
+                for b, b_table in zip(*operands[1]):
+                    cut = tuple(sorted(set(a) | set(b)))
+                    if len(cut) <= self.cutSize and cut not in merged:
+                        merged[cut] = (a, a_table, b, b_table)
+        # cuts containing a smaller cut are dominated
+        kept = []
+        for cut in sorted(merged, key=lambda cut: (len(cut), cut)):
+            if not any(set(smaller) <= set(cut) for smaller in kept):
+                kept.append(cut)
+        kept = kept[:self.maxCuts]
+
+        tables = [TRIVIAL]
+        for cut in kept:
+            if len(operands) == 1:
+                mask = (1 << (1 << len(cut))) - 1
+                tables.append(merged[cut][0] ^ mask if code == NOT else merged[cut][0])
+                continue
+            a, a_table, b, b_table = merged[cut]
+            tables.append(OPERATIONS[code](expand(a_table, a, cut), expand(b_table, b, cut)))
+        return [(node,)] + kept, tables
+
+def fanout_free_cone(signal: int, cut: tuple, num_inputs: int, gate_inputs: list[list[int]], references: list[int]) -> list[int]:
+    # gates of the cone of signal over cut that no signal outside of the cone reads (signal included)
+    leaves = set(cut)
+    removed = {}
+    cone = [signal]
+    pending = [signal]
+    while len(pending) > 0:
+        node = pending.pop()
+        for input in set(gate_inputs[node - num_inputs]):
+            if input in leaves or input < num_inputs:
+                continue
+            removed[input] = removed.get(input, 0) + 1
+            if removed[input] == references[input]:
+                cone.append(input)
+                pending.append(input)
+    return cone
+
+def replacements(flat: tuple, num_inputs: int, library: CostLibrary, cuts: CutEnumeration) -> dict:
+    '''
+        chooses the cones to replace, the largest savings first and without overlapping cones, cones computing a
+        constant are kept
+
+        returns:
+            signal : (cut, truth table, steps saved)
+    '''
+    _, gate_types, gate_inputs, outputs, _ = flat
+    references = [0] * (num_inputs + len(gate_types))
+    for inputs in gate_inputs:
+        for signal in set(inputs):
+            references[signal] = references[signal] + 1
+    for signal in outputs:
+        references[signal] = references[signal] + 1
+    steps = [STEPS[code] for code in gate_types]
+
+    candidates = []
+    for signal in range(num_inputs, num_inputs + len(gate_types)):
+        best = None
+        for cut, table in zip(cuts.cuts[signal][1:], cuts.tables[signal][1:]):
+            if table in (0, (1 << (1 << len(cut))) - 1):
+                continue
+            cost = library.cost(len(cut), table)
+            if cost >= UNREACHABLE:
+                continue
+            cone = fanout_free_cone(signal, cut, num_inputs, gate_inputs, references)
+            saved = sum(steps[node - num_inputs] for node in cone) - cost
+            if saved > 0 and (best is None or saved > best[3]):
+                best = (cut, table, cone, saved)
+        if best is not None:
+            candidates.append((signal, *best))
+
+    chosen = {}
+    claimed = set()     # gates removed by a chosen replacement, their roots included
+    leaves = set()      # signals read by chosen replacements
+    for signal, cut, table, cone, saved in sorted(candidates, key=lambda candidate: candidate[4], reverse=True):
+        interior = set(cone) - {signal}
+        if claimed & set(cone) or leaves & interior or (claimed - set(chosen)) & set(cut):
+            continue
+        chosen[signal] = (cut, table, saved)
+        claimed |= set(cone)
+        leaves |= set(cut)
+    return chosen
+
+def rebuild(flat: tuple, num_inputs: int, library: CostLibrary, chosen: dict, maxGatesPerStage: int=1) -> netlist_io.Netlist:
+    # circuit with the chosen cones replaced, gates only the replaced cones read are removed
+    labels, gate_types, gate_inputs, outputs, output_labels = flat
+    builder = GateBuilder(labels[:num_inputs])
+    literals = [builder.input(signal) for signal in range(num_inputs)]
+    for gate, (code, inputs) in enumerate(zip(gate_types, gate_inputs)):
+        signal = num_inputs + gate
+        label = labels[signal]
+        if signal in chosen:
+            cut, table, _ = chosen[signal]
+            literals.append(library.build(builder, len(cut), table, [literals[leaf] for leaf in cut], label))
+            continue
+        operands = [literals[input] for input in inputs]
+        if code == NOT:
+            literals.append(operands[0] ^ 1)
+        elif code == AND:
+            literals.append(builder.and2(operands[0], operands[1], label))
+        elif code == OR:
+            literals.append(builder.or2(operands[0], operands[1], label))
+        else:
+            literals.append(builder.xor2(operands[0], operands[1], label))
+    return builder.netlist([literals[signal] for signal in outputs], output_labels, maxGatesPerStage)
+
+def resynthesize(netlist: netlist_io.Netlist, cutSize: int=4, maxCuts: int=8, objective: str="lines", parallelism: int=1,
+                 rounds: int=8, library: CostLibrary=None) -> tuple[netlist_io.Netlist, list[dict]]:
+    '''
+        replaces cones by cheaper implementations as long as the compiled costs go down and the inputs of the
+        circuit stay the same
+
+        expects:
+            cutSize: largest number of inputs of a replaced cone (at most 6)
+            objective: cost that has to go down for a round to be kept, "lines", "memristors" or "steps"
+
+        returns:
+            netlist: resynthesised circuit (the given one if no round improved it)
+            history: {"round", "replaced", "saved_steps", "lines", "memristors", "steps", "gates"} of every kept round,
+                     starting with the costs of the given circuit
+    '''
+    if objective not in approx_synth.OBJECTIVES:
+        raise Exception(f"ERROR: Unknown objective {objective}, expected one of {list(approx_synth.OBJECTIVES)}!")
+    if not 2 <= cutSize <= 6:
+        raise Exception(f"ERROR: Cut size {cutSize} is not supported, expected 2 to 6!")
+    library = CostLibrary() if library is None else library
+    keys = approx_synth.OBJECTIVES[objective]
+
+    costs = dse.estimate_costs(netlist, parallelism)
+    history = [{"round": 0, "replaced": 0, "saved_steps": 0, **costs, "gates": netlist.num_gates() - netlist.num_outputs()}]
+    cuts = None
+    for round in range(1, rounds + 1):
+        flat = netlist.flat_gates()
+        cuts = CutEnumeration(netlist.num_inputs, flat[1], flat[2], cutSize, maxCuts, previous=cuts)
+        chosen = replacements(flat, netlist.num_inputs, library, cuts)
+        candidate = rebuild(flat, netlist.num_inputs, library, chosen, parallelism)
+        # an output folded to a constant would be read from an added CONST input, moving the operands
+        if candidate.input_registers() != netlist.input_registers():
+            break
+        candidate_costs = dse.estimate_costs(candidate, parallelism)
+        if tuple(candidate_costs[key] for key in keys) >= tuple(costs[key] for key in keys):
+            break
+        netlist, costs = candidate, candidate_costs
+        history.append({"round": round, "replaced": len(chosen), "saved_steps": sum(saved for _, _, saved in chosen.values()),
+                        **costs, "gates": netlist.num_gates() - netlist.num_outputs()})
+    return netlist, history
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(description="Cut-based resynthesis of small cones by truth table rewriting")
+    parser.add_argument("config", nargs="?", default=None, help="config file (.json, .jsonl or .npz) or circuit to import, else --circuit is built")
+    parser.add_argument("--circuit", choices=list(CIRCUITS), default="mac")
+    parser.add_argument("--cut-size", type=int, default=4, help="largest number of inputs of a replaced cone (2 to 6)")
+    parser.add_argument("--cuts", type=int, default=8, help="cuts kept per gate")
+    parser.add_argument("--objective", choices=list(approx_synth.OBJECTIVES), default="lines")
+    parser.add_argument("--parallelism", type=int, default=1)
+    parser.add_argument("--rounds", type=int, default=8)
+    parser.add_argument("--out", default=None, help="write the resynthesised circuit to this config (.json, .jsonl or .npz)")
+    parser.add_argument("--json", default=None, help="write the costs of every round to this file")
+    args = parser.parse_args(argv)
+
+    if args.config is not None:
+        netlist = netlist_io.load_netlist(args.config, args.parallelism)
+    else:
+        function, widths = CIRCUITS[args.circuit]
+        netlist, _ = approx_synth.build_circuit(function, widths, args.parallelism)
+    resynthesized, history = resynthesize(netlist, args.cut_size, args.cuts, args.objective, args.parallelism, args.rounds)
+    for step in history:
+        print(f"round {step['round']:2d}  replaced {step['replaced']:5d}  gates {step['gates']:6d}  steps {step['steps']:7d}  lines {step['lines']:7d}  memristors {step['memristors']:5d}")
+
+    if args.out is not None:
+        if args.out.endswith(".npz"):
+            resynthesized.save(args.out)
+        else:
+            netlist_io.write_config(args.out, resynthesized.input_registers(), resynthesized.labelled_stages())
+    if args.json is not None:
+        with open(args.json, "w") as f:
+            json.dump(history, f, indent=4)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+"""
+Timing analysis of a circuit in imply steps: arrival times, critical path, slack and output latencies
+
+    python timing.py config.npz --top 10
+    python timing.py config.npz --parallelism 2 --json timing.json --csv gates.csv
+
+Every gate costs the imply steps of its template in compiler.py (OR 6, AND 4, XOR 14, NOT 2, OUT 0).
+
+    arrival      steps after which a signal is computed if every gate starts as soon as its inputs are
+                 computed (unlimited lanes), the largest arrival of an output is the critical path length
+    required     latest step a signal can be computed at without delaying the critical path length
+    slack        required - arrival, 0 on the critical path
+    ready_line   line after which a signal is computed in the compiled program, with the stages of the
+                 netlist laid out like compiler.process_stage does for the given parallelism
+
+For circuits built in memory the results can be looked up by Register:
+
+    netlist = gates.CircuitConfig().toNetlist()
+    analysis = TimingAnalysis(netlist)
+    analysis.arrival_of(outputs[0]), analysis.critical_path(), analysis.blocks()
+
+blocks() sums the steps of the critical path per call path of the gates (see gates.traceCalls), so the
+subcircuits worth optimising first (like the carry chain of traceable16x16_adder) stand out.
+"""
+
+import argparse
+import csv
+import json
+
+import numpy as np
+
+import compiler
+import netlist_io
+
+TEMPLATE_STEPS = np.array([template.length for template in compiler.gate_templates], dtype=np.int64)
+
+
+class TimingAnalysis():
+    '''
+        arrival, required, slack, ready_line: per signal of the netlist (inputs arrive at 0)
+        steps: imply steps of every gate
+        stage: stage of every gate
+    '''
+    def __init__(self, netlist: netlist_io.Netlist, parallelism: int=1):
+        if netlist.num_instances() > 0:
+            raise Exception("ERROR: Instances of modules have to be flattened first!")
+        self.netlist = netlist
+        self.parallelism = parallelism
+        num_inputs = netlist.num_inputs
+        gate_types = np.asarray(netlist.gate_types, dtype=np.int64)
+        gate_inputs = np.asarray(netlist.gate_inputs, dtype=np.int64).reshape(-1, 2)
+        num_signals = num_inputs + len(gate_types)
+        self.steps = TEMPLATE_STEPS[gate_types]
+        self.stage = np.repeat(np.arange(netlist.num_stages()), np.diff(np.asarray(netlist.stage_offsets)))
+
+        # gates are in topological order, gate g computes signal num_inputs + g
+        self.arrival = np.zeros(num_signals, dtype=np.int64)
+        self.critical_input = np.full(num_signals, netlist_io.NO_SIGNAL, dtype=np.int64)
+        arrival = self.arrival.tolist()
+        critical_input = self.critical_input.tolist()
+        for gate, (inputs, steps) in enumerate(zip(gate_inputs.tolist(), self.steps.tolist())):
+            latest = max((signal for signal in inputs if signal != netlist_io.NO_SIGNAL), key=lambda signal: arrival[signal])
+            arrival[num_inputs + gate] = arrival[latest] + steps
+            critical_input[num_inputs + gate] = latest
+        self.arrival[:] = arrival
+        self.critical_input[:] = critical_input
+
+        self.outputs = np.asarray(netlist.output_signals(), dtype=np.int64)
+        self.length = int(self.arrival[self.outputs].max()) if len(self.outputs) > 0 else 0
+        required = [self.length] * num_signals
+        for gate in range(len(gate_types) - 1, -1, -1):
+            start = required[num_inputs + gate] - int(self.steps[gate])
+            for signal in gate_inputs[gate].tolist():
+                if signal != netlist_io.NO_SIGNAL and start < required[signal]:
+                    required[signal] = start
+        self.required = np.array(required, dtype=np.int64)
+        self.slack = self.required - self.arrival
+
+        # lines of the compiled program: longest gates first, parallelism gates per chunk of a stage
+        self.ready_line = np.zeros(num_signals, dtype=np.int64)
+        offsets = np.asarray(netlist.stage_offsets).tolist()
+        steps = self.steps.tolist()
+        line = 0
+        for stage in range(netlist.num_stages()):
+            gates = sorted(range(offsets[stage], offsets[stage + 1]), key=lambda gate: steps[gate], reverse=True)
+            stage_lines = 0
+            for position, gate in enumerate(gates):
+                if position % parallelism == 0:
+                    chunk = stage_lines
+                    stage_lines = stage_lines + steps[gate]
+                self.ready_line[num_inputs + gate] = line + chunk + steps[gate]
+            line = line + stage_lines
+        self.num_lines = line
+        # OUT gates only rename, their signal is ready with the signal they read
+        out_gates = np.flatnonzero(gate_types == netlist_io.OUT_CODE)
+        self.ready_line[num_inputs + out_gates] = self.ready_line[gate_inputs[out_gates, 0]]
+
+    def signal(self, key) -> int:
+        # signal id of a label, a Register (netlists built in memory) or a signal id
+        if isinstance(key, (int, np.integer)):
+            return int(key)
+        return self.netlist.signal_id(key)
+
+    def arrival_of(self, key) -> int:
+        return int(self.arrival[self.signal(key)])
+
+    def slack_of(self, key) -> int:
+        return int(self.slack[self.signal(key)])
+
+    def critical_path(self, output=None) -> list[dict]:
+        '''
+            chain of gates determining the arrival of output (by default the latest output), from the inputs on
+
+            returns:
+                list of gate records, see gate_record
+        '''
+        signal = int(self.outputs[np.argmax(self.arrival[self.outputs])]) if output is None else self.signal(output)
+        paths = self.netlist.paths()
+        path = []
+        while signal >= self.netlist.num_inputs:
+            gate = signal - self.netlist.num_inputs
+            if self.netlist.gate_types[gate] != netlist_io.OUT_CODE:
+                path.append(self.gate_record(gate, paths))
+            signal = int(self.critical_input[signal])
+        path.reverse()
+        return path
+
+    def gate_record(self, gate: int, paths: list[str]=None) -> dict:
+        signal = self.netlist.num_inputs + gate
+        paths = self.netlist.paths() if paths is None else paths
+        return {"signal": str(self.netlist.labels[signal]),
+                "type": netlist_io.GATE_TYPES[int(self.netlist.gate_types[gate])],
+                "path": paths[gate],
+                "stage": int(self.stage[gate]),
+                "steps": int(self.steps[gate]),
+                "arrival": int(self.arrival[signal]),
+                "required": int(self.required[signal]),
+                "slack": int(self.slack[signal]),
+                "ready_line": int(self.ready_line[signal])}
+
+    def gate_records(self) -> list[dict]:
+        paths = self.netlist.paths()
+        return [self.gate_record(gate, paths) for gate in range(self.netlist.num_gates())]
+
+    def output_latencies(self) -> dict:
+        # output label : {"arrival", "slack", "ready_line"}
+        gates = np.flatnonzero(np.asarray(self.netlist.gate_types) == netlist_io.OUT_CODE)
+        return {str(self.netlist.labels[self.netlist.num_inputs + gate]): {"arrival": int(self.arrival[signal]),
+                                                                           "slack": int(self.slack[signal]),
+                                                                           "ready_line": int(self.ready_line[signal])}
+                for gate, signal in zip(gates.tolist(), self.outputs.tolist())}
+
+    def blocks(self, output=None) -> dict:
+        # call path : {"gates", "steps"} of the critical path, most steps first
+        blocks = {}
+        for record in self.critical_path(output):
+            block = blocks.setdefault(record["path"], {"gates": 0, "steps": 0})
+            block["gates"] = block["gates"] + 1
+            block["steps"] = block["steps"] + record["steps"]
+        return dict(sorted(blocks.items(), key=lambda item: item[1]["steps"], reverse=True))
+
+    def summary(self) -> dict:
+        return {"critical_path_steps": self.length,
+                "lines": self.num_lines,
+                "parallelism": self.parallelism,
+                "critical_gates": int(np.count_nonzero(self.slack[self.netlist.num_inputs:] == 0)),
+                "outputs": self.output_latencies(),
+                "critical_path": self.critical_path(),
+                "blocks": self.blocks()}
+
+    def to_json(self, path: str) -> None:
+        with open(path, "w") as f:
+            json.dump(self.summary(), f, indent=4)
+
+    def to_csv(self, path: str) -> None:
+        # one row per gate
+        records = self.gate_records()
+        with open(path, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(["signal", "type", "path", "stage", "steps", "arrival", "required", "slack", "ready_line"])
+            writer.writerows([list(record.values()) for record in records])
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(description="Critical path, slack and output latencies of a circuit in imply steps")
+    parser.add_argument("config", help="config file (.json, .jsonl or .npz) or circuit to import (.blif, .aag or .aig)")
+    parser.add_argument("--parallelism", type=int, default=1, help="lanes the ready lines of the compiled program are computed for")
+    parser.add_argument("--top", type=int, default=5, help="number of latest outputs to print")
+    parser.add_argument("--json", default=None, help="write the summary to this file")
+    parser.add_argument("--csv", default=None, help="write arrival, required time and slack of every gate to this file")
+    args = parser.parse_args(argv)
+
+    analysis = TimingAnalysis(netlist_io.load_netlist(args.config, args.parallelism), args.parallelism)
+    if args.json is not None:
+        analysis.to_json(args.json)
+    if args.csv is not None:
+        analysis.to_csv(args.csv)
+
+    print(f"critical path: {analysis.length} steps, {len(analysis.critical_path())} gates")
+    print(f"lines: {analysis.num_lines} (parallelism {args.parallelism})")
+    latest = sorted(analysis.output_latencies().items(), key=lambda item: item[1]["arrival"], reverse=True)
+    for label, latency in latest[:args.top]:
+        print(f"{label:<16} arrival {latency['arrival']:>6}  ready line {latency['ready_line']:>7}  slack {latency['slack']:>6}")
+    for path, block in analysis.blocks().items():
+        print(f"{path if path else '(untraced)':<60} {block['steps']:>6} steps {block['gates']:>5} gates")
+
+if __name__ == "__main__":
+    main()